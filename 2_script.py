@@ -2,22 +2,104 @@
 Functions:
     list_files()
     read_data()
+    scan_data()
+    is_cached()
+    build_cache()
+    clear_cache()
+    stream_data()
+    aggregate_student_vle()
+    build_click_cube()
+    load_all()          (OULADDataset)
 
 Author:
     Mélina Verger - Oct. 2021
 """
 
+import hashlib
+import json
+import os
+import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
+from instrument import instrumented
+
 
 DATA_PATH = '~/Documents/work/2021_Internship/Work/OLC_tracking/' \
             'project/data/open_olc/anonymised_data/'
 
+# columnar copies of the data tables (Arrow IPC/Feather files)
+CACHE_PATH = DATA_PATH + 'cache/'
+
 files = ['assessments.csv', 'courses.csv', 'studentAssessment.csv',
          'studentInfo.csv', 'studentRegistration.csv', 'studentVle.csv',
          'vle.csv']
 
+modules = ['AAA', 'BBB', 'CCC', 'DDD', 'EEE', 'FFF', 'GGG']
+presentations = ['2013B', '2013J', '2014B', '2014J']
+regions = ['East Anglian Region', 'Scotland', 'North Western Region',
+           'South East Region', 'West Midlands Region', 'Wales',
+           'North Region', 'South Region', 'Ireland', 'South West Region',
+           'East Midlands Region', 'Yorkshire Region', 'London Region']
+educations = ['No Formal quals', 'Lower Than A Level',
+              'A Level or Equivalent', 'HE Qualification',
+              'Post Graduate Qualification']
+imd_bands = ['0-10%', '10-20', '20-30%', '30-40%', '40-50%', '50-60%',
+             '60-70%', '70-80%', '80-90%', '90-100%']  # '10-20' as in the csv
+age_bands = ['0-35', '35-55', '55<=']
+final_results = ['Pass', 'Withdrawn', 'Fail', 'Distinction']
+assessment_types = ['TMA', 'CMA', 'Exam']
+activity_types = ['dataplus', 'dualpane', 'externalquiz', 'folder', 'forumng',
+                  'glossary', 'homepage', 'htmlactivity', 'oucollaborate',
+                  'oucontent', 'ouelluminate', 'ouwiki', 'page',
+                  'questionnaire', 'quiz', 'repeatactivity', 'resource',
+                  'sharedsubpage', 'subpage', 'url']
+
+module = pd.CategoricalDtype(modules)
+presentation = pd.CategoricalDtype(presentations)
+
+# dtypes of the data tables, applied when parsing the csv files
+# (nullable integers where values can be missing)
+schemas = {
+    'assessments.csv': {
+        'code_module': module, 'code_presentation': presentation,
+        'id_assessment': 'int32',
+        'assessment_type': pd.CategoricalDtype(assessment_types),
+        'date': 'Int16', 'weight': 'float32'},
+    'courses.csv': {
+        'code_module': module, 'code_presentation': presentation,
+        'module_presentation_length': 'int16'},
+    'studentAssessment.csv': {
+        'id_assessment': 'int32', 'id_student': 'int32',
+        'date_submitted': 'int16', 'is_banked': 'int8', 'score': 'Int16'},
+    'studentInfo.csv': {
+        'code_module': module, 'code_presentation': presentation,
+        'id_student': 'int32', 'gender': pd.CategoricalDtype(['M', 'F']),
+        'region': pd.CategoricalDtype(regions),
+        'highest_education': pd.CategoricalDtype(educations, ordered=True),
+        'imd_band': pd.CategoricalDtype(imd_bands, ordered=True),
+        'age_band': pd.CategoricalDtype(age_bands, ordered=True),
+        'num_of_prev_attempts': 'int16', 'studied_credits': 'int16',
+        'disability': pd.CategoricalDtype(['N', 'Y']),
+        'final_result': pd.CategoricalDtype(final_results)},
+    'studentRegistration.csv': {
+        'code_module': module, 'code_presentation': presentation,
+        'id_student': 'int32', 'date_registration': 'Int16',
+        'date_unregistration': 'Int16'},
+    'studentVle.csv': {
+        'code_module': module, 'code_presentation': presentation,
+        'id_student': 'int32', 'id_site': 'int32', 'date': 'int16',
+        'sum_click': 'int32'},
+    'vle.csv': {
+        'id_site': 'int32', 'code_module': module,
+        'code_presentation': presentation,
+        'activity_type': pd.CategoricalDtype(activity_types),
+        'week_from': 'Int16', 'week_to': 'Int16'},
+}
+
+enrollment = ['id_student', 'code_module', 'code_presentation']
+
 
 def list_files():
     """
@@ -27,14 +109,38 @@ def list_files():
     print('\nTotal:', len(files))
 
 
-def read_data(file_name):
+def check_file_name(file_name):
+    if file_name not in files:
+        raise NameError("file_name argument must be included in:"
+                        " {}".format(', '.join(files)))
+
+
+def zip_path(file_name):
+    return os.path.expanduser(DATA_PATH + file_name + '.zip')
+
+
+###############################################################################
+@instrumented
+def read_data(file_name, columns=None, cache=True, memory_map=False):
     """
-    Return a data table in csv format as a pandas DataFrame.
+    Return a data table in csv format as a pandas DataFrame, with the dtypes
+    declared in schemas.
+
+    The first read of a table converts it to a columnar file in CACHE_PATH
+    (pyarrow required, otherwise the csv is always parsed). Next reads are
+    served from this file as long as the zip archive is unchanged.
 
     Parameters
     ----------
     file_name : str
         The name of the csv file
+    columns : list, optional
+        The names of the columns to load (all columns by default)
+    cache : bool, default True
+        Whether to use the columnar cache
+    memory_map : bool, default False
+        Whether to memory-map the cache file instead of reading it in memory
+        (the columns of the DataFrame are then read-only)
 
     Returns
     ----------
@@ -46,10 +152,498 @@ def read_data(file_name):
     NameError
         If file_name is not in files List
     """
-    if file_name in files:
-        zf = zipfile.ZipFile(DATA_PATH + file_name + '.zip')
-        data = pd.read_csv(zf.open(file_name))
-        return data
+    check_file_name(file_name)
+    if cache and pyarrow_available():
+        if not is_cached(file_name):
+            build_cache(file_name)
+        return read_cache(file_name, columns, memory_map)
+    return read_csv(file_name, columns)
+
+
+@instrumented
+def scan_data(file_name, columns=None):
+    """
+    Return a data table as a polars LazyFrame on its memory-mapped columnar
+    cache (built if needed), for the polars engine (see engine.py).
+
+    The categorical columns are polars Enums with the declared categories (and
+    their order) of schemas.
+
+    Parameters
+    ----------
+    file_name : str
+        The name of the csv file
+    columns : list, optional
+        The names of the columns to load (all columns by default)
+
+    Returns
+    ----------
+    pl.LazyFrame
+        The data table as pl.LazyFrame (read when collected)
+
+    Raises
+    ------
+    NameError
+        If file_name is not in files List
+    """
+    import polars as pl
+
+    check_file_name(file_name)
+    if pyarrow_available():
+        from pyarrow import feather
+
+        if not is_cached(file_name):
+            build_cache(file_name)
+        # read through pyarrow: pl.scan_ipc() rejects the codes of the
+        # missing values written by pandas in the dictionary columns
+        frame = pl.from_arrow(feather.read_table(
+            cache_paths(file_name)[0], columns=columns, memory_map=True))
     else:
-        raise NameError("file_name argument must be included in:"
-                        " {}".format(', '.join(files)))
+        frame = pl.from_pandas(read_csv(file_name, columns))
+    names = frame.columns
+    frame = frame.lazy()
+    return frame.with_columns(
+        pl.col(column).cast(pl.String).cast(pl.Enum(list(dtype.categories)))
+        for column, dtype in schemas[file_name].items()
+        if column in names and isinstance(dtype, pd.CategoricalDtype))
+
+
+def read_csv(file_name, columns=None):
+    with zipfile.ZipFile(zip_path(file_name)) as zf:
+        with zf.open(file_name) as f:
+            data = pd.read_csv(f, usecols=columns, na_values=['?'],
+                               dtype=parse_dtypes(file_name))
+    return apply_schema(data, file_name)
+
+
+###############################################################################
+def parse_dtypes(file_name):
+    # categories are inferred while parsing and checked in apply_schema
+    return {column: 'category' if isinstance(dtype, pd.CategoricalDtype)
+            else dtype for column, dtype in schemas[file_name].items()}
+
+
+def apply_schema(data, file_name):
+    """
+    Set the declared categories (and their order) of the categorical columns
+    of a parsed data table.
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        The data table parsed with parse_dtypes()
+    file_name : str
+        The name of the csv file
+
+    Returns
+    ----------
+    pd.DataFrame
+        The data table with the dtypes of schemas
+
+    Raises
+    ------
+    ValueError
+        If a categorical column contains undeclared values
+    """
+    for column, dtype in schemas[file_name].items():
+        if column in data and isinstance(dtype, pd.CategoricalDtype):
+            unknown = data[column].cat.categories.difference(dtype.categories)
+            if len(unknown) > 0:
+                raise ValueError("unexpected values in column {} of {}: {}"
+                                 .format(column, file_name,
+                                         ', '.join(map(str, unknown))))
+            data[column] = data[column].cat.set_categories(
+                dtype.categories, ordered=dtype.ordered)
+    return data
+
+
+def schema_signature(file_name):
+    schema = [(column, str(dtype), list(getattr(dtype, 'categories', [])))
+              for column, dtype in schemas[file_name].items()]
+    return hashlib.sha256(repr(schema).encode()).hexdigest()
+
+
+###############################################################################
+def pyarrow_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def cache_paths(file_name):
+    base = os.path.join(os.path.expanduser(CACHE_PATH),
+                        os.path.splitext(file_name)[0])
+    return base + '.feather', base + '.json'
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def source_fingerprint(file_name):
+    path = zip_path(file_name)
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha256': file_hash(path)}
+
+
+def temporary_file(path):
+    # unique file next to path, so that concurrent writers do not collide
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                               prefix=os.path.basename(path) + '.',
+                               suffix='.tmp')
+    os.close(fd)
+    return tmp
+
+
+def write_meta(meta_file, meta):
+    tmp = temporary_file(meta_file)
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, meta_file)
+
+
+def is_cached(file_name):
+    """
+    Return True if the columnar copy of a data table is up to date.
+
+    The copy is outdated when the size or the content (sha256) of the zip
+    archive changed, or when its schema changed. The hash is only recomputed
+    when the modification time changed.
+
+    Parameters
+    ----------
+    file_name : str
+        The name of the csv file
+
+    Returns
+    ----------
+    bool
+        Whether the cache file can be used
+
+    Raises
+    ------
+    NameError
+        If file_name is not in files List
+    """
+    check_file_name(file_name)
+    data_file, meta_file = cache_paths(file_name)
+    if not (os.path.exists(data_file) and os.path.exists(meta_file)):
+        return False
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if meta.get('schema') != schema_signature(file_name):
+        return False
+    path = zip_path(file_name)
+    stat = os.stat(path)
+    if stat.st_size != meta['size']:
+        return False
+    if stat.st_mtime_ns != meta['mtime_ns']:
+        if file_hash(path) != meta['sha256']:
+            return False
+        # only touched: keep the cache and remember the new mtime
+        meta['mtime_ns'] = stat.st_mtime_ns
+        write_meta(meta_file, meta)
+    return True
+
+
+@instrumented
+def build_cache(file_name):
+    """
+    Parse a data table from its zip archive and store it as an uncompressed
+    Arrow IPC (Feather v2) file, which can be memory-mapped and read per
+    column.
+
+    Parameters
+    ----------
+    file_name : str
+        The name of the csv file
+
+    Returns
+    ----------
+    str
+        The path of the cache file
+
+    Raises
+    ------
+    NameError
+        If file_name is not in files List
+    """
+    from pyarrow import feather
+
+    check_file_name(file_name)
+    data_file, meta_file = cache_paths(file_name)
+    os.makedirs(os.path.dirname(data_file), exist_ok=True)
+    meta = source_fingerprint(file_name)
+    meta['schema'] = schema_signature(file_name)
+    data = read_csv(file_name)
+    tmp = temporary_file(data_file)
+    feather.write_feather(data, tmp, compression='uncompressed')
+    os.replace(tmp, data_file)
+    write_meta(meta_file, meta)
+    return data_file
+
+
+def read_cache(file_name, columns=None, memory_map=False):
+    from pyarrow import feather
+
+    data_file, _ = cache_paths(file_name)
+    table = feather.read_table(data_file, columns=columns,
+                               memory_map=memory_map)
+    if memory_map:
+        return table.to_pandas(split_blocks=True)  # read-only columns
+    # the columns converted from Arrow are read-only even in memory
+    return table.to_pandas().copy()
+
+
+@instrumented
+def clear_cache(file_name=None):
+    """
+    Remove the cache files of a data table (of all data tables by default).
+
+    Parameters
+    ----------
+    file_name : str, optional
+        The name of the csv file
+
+    Returns
+    ----------
+    None
+
+    Raises
+    ------
+    NameError
+        If file_name is not in files List
+    """
+    names = files if file_name is None else [file_name]
+    for name in names:
+        check_file_name(name)
+        for path in cache_paths(name):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+###############################################################################
+def stream_data(file_name, chunksize=1000000, columns=None):
+    """
+    Yield a data table in csv format as successive pandas DataFrames (with the
+    dtypes of schemas), read directly from the zip archive, so that the whole
+    table is never in memory.
+
+    Parameters
+    ----------
+    file_name : str
+        The name of the csv file
+    chunksize : int, default 1000000
+        The number of rows per chunk
+    columns : list, optional
+        The names of the columns to load (all columns by default)
+
+    Yields
+    ----------
+    pd.DataFrame
+        The successive chunks of the data table
+
+    Raises
+    ------
+    NameError
+        If file_name is not in files List
+    """
+    check_file_name(file_name)
+    with zipfile.ZipFile(zip_path(file_name)) as zf:
+        with zf.open(file_name) as f:
+            for chunk in pd.read_csv(f, usecols=columns, na_values=['?'],
+                                     dtype=parse_dtypes(file_name),
+                                     chunksize=chunksize):
+                yield apply_schema(chunk, file_name)
+
+
+def fold(partials, keys, column):
+    # combine partial sums sharing the same keys
+    return pd.concat(partials).groupby(keys, observed=True,
+                                       sort=False)[column].sum().reset_index()
+
+
+@instrumented
+def aggregate_student_vle(vle=None, chunksize=1000000):
+    """
+    Return the students' activity in the VLE per module presentation, computed
+    chunk by chunk from 'studentVle.csv'.
+
+    Only the clicks per (enrollment, day) and per (enrollment, activity type)
+    are kept between chunks, so memory does not grow with the number of rows
+    of the click log.
+
+    Parameters
+    ----------
+    vle : pd.DataFrame, optional
+        The 'vle.csv' data table (read if not given)
+    chunksize : int, default 1000000
+        The number of rows per chunk
+
+    Returns
+    ----------
+    pd.DataFrame
+        One row per (id_student, code_module, code_presentation) with
+        total_clicks, active_days, first_date, last_date and one
+        'clicks_<activity_type>' column per activity type
+    """
+    if vle is None:
+        vle = read_data('vle.csv', columns=['id_site', 'activity_type'])
+    activity = vle.set_index('id_site')['activity_type']
+
+    days, activities = [], []
+    n_days = n_activities = 0
+    for chunk in stream_data('studentVle.csv', chunksize):
+        chunk['activity_type'] = chunk['id_site'].map(activity)
+        day = chunk.groupby(enrollment + ['date'], observed=True,
+                            sort=False)['sum_click'].sum().reset_index()
+        act = chunk.groupby(enrollment + ['activity_type'], observed=True,
+                            sort=False)['sum_click'].sum().reset_index()
+        days.append(day)
+        activities.append(act)
+        n_days += len(day)
+        n_activities += len(act)
+        # compact the partial results when they outgrow a chunk
+        if n_days > chunksize:
+            days = [fold(days, enrollment + ['date'], 'sum_click')]
+            n_days = len(days[0])
+        if n_activities > chunksize:
+            activities = [fold(activities, enrollment + ['activity_type'],
+                               'sum_click')]
+            n_activities = len(activities[0])
+
+    days = fold(days, enrollment + ['date'], 'sum_click')
+    activities = fold(activities, enrollment + ['activity_type'], 'sum_click')
+
+    result = days.groupby(enrollment, observed=True).agg(
+        total_clicks=('sum_click', 'sum'), active_days=('date', 'size'),
+        first_date=('date', 'min'), last_date=('date', 'max'))
+    per_activity = activities.pivot_table(index=enrollment,
+                                          columns='activity_type',
+                                          values='sum_click', aggfunc='sum',
+                                          fill_value=0, observed=True)
+    per_activity.columns = ['clicks_' + str(c) for c in per_activity.columns]
+    result = result.join(per_activity).fillna(0)
+    return result.reset_index()
+
+
+@instrumented
+def build_click_cube(path, chunksize=1000000, first_day=-25, last_day=269):
+    """
+    Build the sparse cube of the clicks per enrollment x day x activity type
+    of 'studentVle.csv' in a directory, streamed chunk by chunk (see
+    build_cube() in clicks.py).
+
+    Parameters
+    ----------
+    path : str
+        The directory of the cube
+    chunksize : int, default 1000000
+        The number of rows per chunk
+    first_day : int, default -25
+        The first day of the cube
+    last_day : int, default 269
+        The last day of the cube
+
+    Returns
+    ----------
+    ClickCube
+        The cube, memory-mapped (load it again with load_cube() in clicks.py)
+    """
+    from clicks import build_cube
+
+    return build_cube(path, stream_data('studentVle.csv', chunksize),
+                      read_data('vle.csv', columns=['id_site',
+                                                    'activity_type']),
+                      read_data('courses.csv'), first_day, last_day)
+
+
+###############################################################################
+class OULADDataset:
+    """
+    The OULAD data tables, read concurrently in background threads.
+
+    Each table is available as an attribute named after its csv file
+    (e.g. dataset.studentInfo) or by file name (dataset['studentInfo.csv']),
+    which only waits for this table to be read. The same DataFrame is
+    returned at each access.
+
+    Parameters
+    ----------
+    tables : list, optional
+        The names of the csv files to read (all files by default)
+    max_workers : int, optional
+        The number of threads (one per table by default)
+    cache : bool, default True
+        Whether to use the columnar cache (see read_data())
+
+    Raises
+    ------
+    NameError
+        If a table is not in files List
+    """
+
+    def __init__(self, tables=None, max_workers=None, cache=True):
+        self.tables = list(files if tables is None else tables)
+        for file_name in self.tables:
+            check_file_name(file_name)
+        executor = ThreadPoolExecutor(max_workers=max_workers or
+                                      len(self.tables))
+        self.futures = {file_name: executor.submit(read_data, file_name,
+                                                   cache=cache)
+                        for file_name in self.tables}
+        # the threads stop once all submitted tables are read
+        executor.shutdown(wait=False)
+
+    def __getitem__(self, file_name):
+        check_file_name(file_name)
+        if file_name not in self.futures:
+            raise KeyError(file_name)
+        return self.futures[file_name].result()
+
+    def __getattr__(self, name):
+        futures = self.__dict__.get('futures', {})
+        if name + '.csv' in futures:
+            return futures[name + '.csv'].result()
+        raise AttributeError(name)
+
+    def __dir__(self):
+        return list(super().__dir__()) + [os.path.splitext(file_name)[0]
+                                          for file_name in self.tables]
+
+    def wait(self):
+        """
+        Wait until all the tables are read and return the dataset.
+        """
+        for future in self.futures.values():
+            future.result()
+        return self
+
+
+@instrumented
+def load_all(tables=None, max_workers=None, cache=True):
+    """
+    Return all the OULAD data tables, read concurrently.
+
+    Parameters
+    ----------
+    tables : list, optional
+        The names of the csv files to read (all files by default)
+    max_workers : int, optional
+        The number of threads (one per table by default)
+    cache : bool, default True
+        Whether to use the columnar cache (see read_data())
+
+    Returns
+    ----------
+    OULADDataset
+        The dataset with all the tables read
+    """
+    return OULADDataset(tables, max_workers, cache).wait()
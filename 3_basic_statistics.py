@@ -1,48 +1,316 @@
 """
 Functions:
     dataset_population()
+    count_cube()        (CountCube, polars_count_cube)
     how_many()          (_students, _modules, _presentations, _genders)
     ratio()             (_gender, _region, _education, _imd, _age, _disability)
     disability_per_gender()
     imd_per_region()
     ed_per_age()
+    render_report()
 
 Author:
     Mélina Verger - Oct. 2021
 """
 
+import hashlib
+import json
+import os
+
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
-from tabulate import tabulate
 
-plt.rcParams['axes.facecolor'] = 'white'
+from engine import INDEX, column_names, finish, is_polars, lazy, use_polars
+from instrument import instrumented
+from population import distinct_students
+
+
+def pyplot():
+    """
+    Return matplotlib.pyplot, imported (and configured) on the first plot.
+    """
+    import matplotlib.pyplot as plt
+
+    if not getattr(pyplot, 'configured', False):
+        plt.rcParams['axes.facecolor'] = 'white'
+        pyplot.configured = True
+    return plt
 
 
 ###############################################################################
-def dataset_population(dataframe0):
+@instrumented
+def dataset_population(dataframe0, engine=None):
     """
     Return a new dataframe with students' information only (distinct students).
 
     Parameters
     ----------
     dataframe0 : pd.DataFrame
-        The initial dataframe
+        The initial dataframe (or a polars DataFrame or LazyFrame)
+    engine : str, optional
+        'pandas' or 'polars' (the current engine of engine.py by default)
 
     Returns
     ----------
     pd.DataFrame
-        The final dataframe
+        The final dataframe (of the kind of dataframe0)
     """
     columns = ['id_student', 'gender', 'region', 'highest_education',
                'imd_band', 'age_band', 'disability']
-    dataframe = dataframe0[columns]
-    # drop rows when same students' id (redundant students' info)
-    return dataframe.drop_duplicates(subset=['id_student'], keep='first')
+    if use_polars(dataframe0, engine):
+        query = lazy(dataframe0).unique(subset=['id_student'], keep='first',
+                                        maintain_order=True)
+        return finish(query.select([INDEX] + columns), dataframe0)
+    # first row of each student, computed once per dataframe
+    return distinct_students(dataframe0)[columns]
 
 
 ###############################################################################
-def how_many(col_name, dataframe):
+cube_columns = ['gender', 'region', 'highest_education', 'imd_band',
+                'age_band', 'disability', 'final_result']
+
+
+class CountCube:
+    """
+    The numbers of distinct students for every combination of values of
+    demographic columns, as a dense N-dimensional array.
+
+    Any count, ratio or crosstab over these columns is a sum over some axes of
+    the array (see marginal() and crosstab()). Missing values are counted
+    under a NaN label at the end of an axis.
+
+    Parameters
+    ----------
+    counts : np.array
+        The counts, one axis per column
+    axes : dict
+        The labels (pd.Index) of each axis by column name, in axis order
+    appearance : dict, optional
+        The labels (pd.Index) of each column in order of first appearance
+        among the distinct students, missing values left out (see order())
+    """
+
+    def __init__(self, counts, axes, appearance=None):
+        self.counts = counts
+        self.axes = axes
+        self.appearance = appearance or {}
+
+    def total(self):
+        """
+        Return the number of distinct students.
+        """
+        return int(self.counts.sum())
+
+    def marginal(self, *columns, where=None, dropna=True):
+        """
+        Return the numbers of distinct students per value of the columns.
+
+        Parameters
+        ----------
+        *columns : str
+            The names of the columns kept
+        where : dict, optional
+            The value (or list of values) of other columns to select, e.g.
+            {'disability': 'Y'}
+        dropna : bool, default True
+            Whether to leave out the missing values of the kept columns
+
+        Returns
+        ----------
+        pd.Series or pd.DataFrame
+            The counts indexed by the values of the column (Series), of the 2
+            columns (DataFrame, first column as index) or of the columns
+            (Series with a MultiIndex)
+
+        Raises
+        ------
+        ValueError
+            If a column is not an axis of the cube
+        """
+        names = list(self.axes)
+        for column in list(columns) + list(where or {}):
+            if column not in self.axes:
+                raise ValueError("columns must be included in:"
+                                 " {}".format(', '.join(names)))
+        counts = self.counts
+        for column, values in (where or {}).items():
+            values = values if isinstance(values, list) else [values]
+            positions = self.axes[column].get_indexer(values)
+            if (positions == -1).any():
+                raise ValueError("unknown values of column {}".format(column))
+            counts = counts.take(positions, axis=names.index(column))
+        others = tuple(i for i, name in enumerate(names)
+                       if name not in columns)
+        counts = counts.sum(axis=others)
+        # axes in the order of columns
+        order = [name for name in names if name in columns]
+        counts = np.moveaxis(counts, [order.index(c) for c in columns],
+                             range(len(columns)))
+
+        indexes = [self.axes[column] for column in columns]
+        if dropna:
+            for axis, labels in enumerate(indexes):
+                kept = np.flatnonzero(labels.notna())
+                counts = counts.take(kept, axis=axis)
+                indexes[axis] = labels[kept]
+
+        if len(columns) == 1:
+            table = pd.Series(counts, index=indexes[0])
+        elif len(columns) == 2:
+            table = pd.DataFrame(counts, index=indexes[0], columns=indexes[1])
+        else:
+            table = pd.Series(counts.ravel(),
+                              index=pd.MultiIndex.from_product(indexes))
+        return table
+
+    def crosstab(self, index, columns, where=None, dropna=True):
+        """
+        Return the crosstab of the numbers of distinct students of 2 columns
+        (as pd.crosstab on the population of distinct students).
+        """
+        return self.marginal(index, columns, where=where, dropna=dropna)
+
+    def order(self, column):
+        """
+        Return the values of a column in order of first appearance among the
+        distinct students (as unique() on the population of distinct
+        students), in axis order if unknown.
+        """
+        if column in self.appearance:
+            return self.appearance[column]
+        return self.axes[column].dropna()
+
+    def value_counts(self, column):
+        """
+        Return the numbers of distinct students per value of a column, as
+        value_counts() on the population of distinct students: values in
+        decreasing order of counts, ties in order of first appearance, values
+        without student left out.
+        """
+        counts = self.marginal(column).reindex(self.order(column))
+        return counts.sort_values(ascending=False, kind='stable')
+
+    def lines(self, index, columns):
+        """
+        Return the crosstab of 2 columns drawn by plot_per_group(): one row
+        per value of index in order of first appearance, without the rows
+        without student.
+        """
+        table = self.crosstab(index, columns).reindex(self.order(index))
+        return table[table.sum(axis=1) > 0]
+
+
+@instrumented
+def count_cube(dataframe0, columns=None, engine=None):
+    """
+    Return the CountCube of the population of distinct students, built in one
+    pass.
+
+    Parameters
+    ----------
+    dataframe0 : pd.DataFrame
+        The initial dataframe (or a polars DataFrame or LazyFrame)
+    columns : list, optional
+        The columns of the cube (the columns of cube_columns found in
+        dataframe0 by default)
+    engine : str, optional
+        'pandas' or 'polars' (the current engine of engine.py by default)
+
+    Returns
+    ----------
+    CountCube
+        The counts of distinct students
+
+    Raises
+    ------
+    TypeError
+        If dataframe type is not pandas.DataFrame (or polars)
+    """
+    if not isinstance(dataframe0, pd.DataFrame) and not is_polars(dataframe0):
+        raise TypeError('dataframe type must be pandas.DataFrame')
+    if columns is None:
+        names = column_names(dataframe0)
+        columns = [column for column in cube_columns if column in names]
+    if use_polars(dataframe0, engine):
+        return polars_count_cube(dataframe0, columns)
+    # first row of each student (as dataset_population())
+    dataframe = distinct_students(dataframe0)[columns]
+
+    code = np.zeros(len(dataframe), dtype=np.int64)
+    axes, appearance = {}, {}
+    for column in columns:
+        values = dataframe[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes, labels = values.cat.codes.to_numpy(), values.cat.categories
+        else:
+            codes, labels = pd.factorize(values, sort=True)
+        labels = list(labels)
+        seen = pd.unique(codes)
+        appearance[column] = pd.Index(labels, name=column, dtype=object)[
+            seen[seen >= 0]]
+        if (codes == -1).any():
+            codes = np.where(codes == -1, len(labels), codes)
+            labels.append(np.nan)
+        axes[column] = pd.Index(labels, name=column, dtype=object)
+        code = code * len(labels) + codes
+
+    shape = tuple(len(labels) for labels in axes.values())
+    counts = np.bincount(code, minlength=int(np.prod(shape))).reshape(shape)
+    return CountCube(counts, axes, appearance)
+
+
+def polars_count_cube(dataframe0, columns):
+    # the distinct students and their counts per combination of values are
+    # computed by polars, the cube from the (few) combinations
+    import polars as pl
+
+    population = lazy(dataframe0).unique(subset=['id_student'], keep='first',
+                                         maintain_order=True)
+    # combinations in order of first appearance
+    groups = population.group_by(columns, maintain_order=True).agg(
+        pl.len().alias(INDEX))
+    groups = groups.collect().to_pandas()
+    schema = lazy(dataframe0).collect_schema() if is_polars(dataframe0) \
+        else None
+
+    code = np.zeros(len(groups), dtype=np.int64)
+    axes, appearance = {}, {}
+    for column in columns:
+        values = pd.Index(groups[column].astype(object))
+        appearance[column] = pd.Index(values.dropna().unique(), name=column,
+                                      dtype=object)
+        if not is_polars(dataframe0) and isinstance(dataframe0[column].dtype,
+                                                    pd.CategoricalDtype):
+            labels = list(dataframe0[column].cat.categories)
+        elif is_polars(dataframe0) and isinstance(schema[column], pl.Enum):
+            labels = schema[column].categories.to_list()
+        else:
+            labels = sorted(values.dropna().unique())
+        codes = pd.Index(labels).get_indexer(values)
+        if (codes == -1).any():
+            codes = np.where(codes == -1, len(labels), codes)
+            labels.append(np.nan)
+        axes[column] = pd.Index(labels, name=column, dtype=object)
+        code = code * len(labels) + codes
+
+    shape = tuple(len(labels) for labels in axes.values())
+    counts = np.bincount(code, weights=groups[INDEX].to_numpy(),
+                         minlength=int(np.prod(shape)))
+    return CountCube(counts.astype(np.int64).reshape(shape), axes,
+                     appearance)
+
+
+def as_cube(dataframe0, engine=None):
+    if isinstance(dataframe0, CountCube):
+        return dataframe0
+    if isinstance(dataframe0, pd.DataFrame) or is_polars(dataframe0):
+        return count_cube(dataframe0, engine=engine)
+    raise TypeError('dataframe type must be pandas.DataFrame or CountCube')
+
+
+###############################################################################
+@instrumented
+def how_many(col_name, dataframe, engine=None):
     """
     Return the number of (unique) instances asked in input.
 
@@ -51,7 +319,9 @@ def how_many(col_name, dataframe):
     col_name : str
         The name of the relative column
     dataframe : pd.DataFrame
-        The initial dataframe
+        The initial dataframe (or a polars DataFrame or LazyFrame)
+    engine : str, optional
+        'pandas' or 'polars' (the current engine of engine.py by default)
 
     Returns
     ----------
@@ -66,8 +336,14 @@ def how_many(col_name, dataframe):
         If col_name is not in the list names
     """
     names = ['id_student', 'code_module', 'code_presentation', 'gender']
-    if isinstance(dataframe, pd.DataFrame):
-        if col_name in names:
+    if isinstance(dataframe, pd.DataFrame) or is_polars(dataframe):
+        if col_name in names and use_polars(dataframe, engine):
+            import polars as pl
+
+            query = lazy(dataframe).select(
+                pl.col(col_name).drop_nulls().n_unique())
+            return query.collect().item()
+        elif col_name in names:
             column = col_name
             elems = pd.Series(dataframe[column].unique())
             return len(elems) - elems.isna().sum()  # substract 0 or 1 if NaN value in elems
@@ -107,7 +383,8 @@ def how_many_genders(dataframe):
 
 
 ###############################################################################
-def ratio(col_name, dataframe0):
+@instrumented
+def ratio(col_name, dataframe0, ax=None, engine=None):
     """
     Display a table and a plot of the ratios of the information asked among the
     population of distinct students.
@@ -116,8 +393,12 @@ def ratio(col_name, dataframe0):
     ----------
     col_name : str
         The name of the relative column
-    dataframe0 : pd.DataFrame
-        The initial dataframe
+    dataframe0 : pd.DataFrame or CountCube
+        The initial dataframe (or its count cube)
+    ax : matplotlib Axes, optional
+        The axes of the plot (the current pyplot axes by default)
+    engine : str, optional
+        'pandas' or 'polars' (the current engine of engine.py by default)
 
     Returns
     ----------
@@ -126,32 +407,32 @@ def ratio(col_name, dataframe0):
     Raises
     ------
     TypeError
-        If dataframe type is not pandas.DataFrame
+        If dataframe type is not pandas.DataFrame or CountCube
     ValueError
         If col_name is not in the list names
     """
     names = ['gender', 'region', 'highest_education', 'imd_band', 'age_band',
              'disability']
-    if isinstance(dataframe0, pd.DataFrame):
+    if isinstance(dataframe0, (pd.DataFrame, CountCube)) or is_polars(
+            dataframe0):
         if col_name in names:
-            # new dataset
-            dataframe = dataset_population(dataframe0)
+            cube = as_cube(dataframe0, engine)
 
             column = col_name
-            ind = list(dataframe[column].value_counts().index)
-            counts = list(dataframe[column].value_counts())
-            percentages = [round(x/sum(counts)*100, 2) for x in counts]
-            table = np.stack((ind, counts, percentages), axis=1)
-            print(tabulate(table, headers=[column, "# distinct students",
-                                           "percentage (%)"]))
-
-            dataframe[column].value_counts().plot(kind='bar', color='b')
-            plt.ylabel('# distinct students')
+            value_counts = cube.value_counts(column)
+            from tabulate import tabulate
+
+            print(tabulate(ratio_table(value_counts),
+                           headers=[column, "# distinct students",
+                                    "percentage (%)"]))
+
+            plot_ratio(value_counts, pyplot().gca() if ax is None else ax)
         else:
             raise ValueError("col_name argument must be included in:"
                              " {}".format(', '.join(names)))
     else:
-        raise TypeError('dataframe type must be pandas.DataFrame')
+        raise TypeError('dataframe type must be pandas.DataFrame or '
+                        'CountCube')
 
 
 def ratio_gender(dataframe):
@@ -197,14 +478,15 @@ def ratio_disability(dataframe):
 
 
 ###############################################################################
+@instrumented
 def disability_per_gender(dataframe0):
     """
     Display a table of the disability ratio within the M and F populations.
 
     Parameters
     ----------
-    dataframe0 : pd.DataFrame
-        The initial dataframe
+    dataframe0 : pd.DataFrame or CountCube
+        The initial dataframe (or its count cube)
 
     Returns
     ----------
@@ -213,32 +495,30 @@ def disability_per_gender(dataframe0):
     Raises
     ------
     TypeError
-        If dataframe type is not pandas.DataFrame
+        If dataframe type is not pandas.DataFrame or CountCube
     """
-    if isinstance(dataframe0, pd.DataFrame):
-        # new dataset
-        dataframe = dataset_population(dataframe0)
+    cube = as_cube(dataframe0)
+    disabled = cube.marginal('gender', where={'disability': 'Y'})
 
-        Y_male = len(dataframe[(dataframe.gender == 'M') &
-                               (dataframe.disability == "Y")])
-        Y_female = len(dataframe[(dataframe.gender == 'F') &
-                                 (dataframe.disability == "Y")])
-        print(f"M: {Y_male} ({round(Y_male/(Y_male+Y_female)*100, 2)}%)")
-        print(f"F: {Y_female} ({round(Y_female/(Y_male+Y_female)*100, 2)}%)")
-    else:
-        raise TypeError('dataframe type must be pandas.DataFrame')
+    Y_male = int(disabled.get('M', 0))
+    Y_female = int(disabled.get('F', 0))
+    print(f"M: {Y_male} ({round(Y_male/(Y_male+Y_female)*100, 2)}%)")
+    print(f"F: {Y_female} ({round(Y_female/(Y_male+Y_female)*100, 2)}%)")
 
 
 ###############################################################################
-def imd_per_region(dataframe0):
+@instrumented
+def imd_per_region(dataframe0, ax=None):
     """
     Display a plot of the distribution of the students among the IMD indices
     per region.
 
     Parameters
     ----------
-    dataframe0 : pd.DataFrame
-        The initial dataframe
+    dataframe0 : pd.DataFrame or CountCube
+        The initial dataframe (or its count cube)
+    ax : matplotlib Axes, optional
+        The axes of the plot (a new pyplot figure, then shown, by default)
 
     Returns
     ----------
@@ -247,42 +527,35 @@ def imd_per_region(dataframe0):
     Raises
     ------
     TypeError
-        If dataframe type is not pandas.DataFrame
+        If dataframe type is not pandas.DataFrame or CountCube
     """
-    if isinstance(dataframe0, pd.DataFrame):
-        # new dataset
-        dataframe = dataset_population(dataframe0)
-        # reduce new dataset
-        df = dataframe[['region', 'imd_band']]
+    cube = as_cube(dataframe0)
+    table = cube.lines('region', 'imd_band')
 
-        i = 1
+    if ax is None:
+        plt = pyplot()
         fig = plt.figure(figsize=(10, 7))
         #fig.patch.set_facecolor('white')
-        for region in df['region'].unique():
-            if i <= 10:
-                df[df['region'] == region]['imd_band'].value_counts().sort_index().plot(linestyle='-', marker='o', label=region)
-            else:
-                df[df['region'] == region]['imd_band'].value_counts().sort_index().plot(linestyle='--', marker='o', label=region)
-            i += 1
-        plt.legend(bbox_to_anchor=(1, 0.75))
-        plt.ylabel('# distinct students')
-        plt.xlabel('IMD')
+        plot_per_group(table, 'IMD', plt.gca(), solid=10)
         plt.xticks()
         plt.show()
     else:
-        raise TypeError('dataframe type must be pandas.DataFrame')
+        plot_per_group(table, 'IMD', ax, solid=10)
 
 
 ###############################################################################
-def ed_per_age(dataframe0):
+@instrumented
+def ed_per_age(dataframe0, ax=None):
     """
     Display a plot of the distribution of the students among the age intervals
     per education.
 
     Parameters
     ----------
-    dataframe0 : pd.DataFrame
-        The initial dataframe
+    dataframe0 : pd.DataFrame or CountCube
+        The initial dataframe (or its count cube)
+    ax : matplotlib Axes, optional
+        The axes of the plot (a new pyplot figure, then shown, by default)
 
     Returns
     ----------
@@ -291,20 +564,186 @@ def ed_per_age(dataframe0):
     Raises
     ------
     TypeError
-        If dataframe type is not pandas.DataFrame
+        If dataframe type is not pandas.DataFrame or CountCube
     """
-    if isinstance(dataframe0, pd.DataFrame):
-        # new dataset
-        dataframe = dataset_population(dataframe0)
-        # reduce new dataset
-        df = dataframe[['highest_education', 'age_band']]
-
-        for ed in df['highest_education'].unique():
-            df[df['highest_education'] == ed]['age_band'].value_counts().sort_index().plot(linestyle='-', marker='o', label=ed)
-        plt.legend(bbox_to_anchor=(1, 0.75))
-        plt.ylabel('# distinct students')
-        plt.xlabel('Age')
+    cube = as_cube(dataframe0)
+    table = cube.lines('highest_education', 'age_band')
+
+    if ax is None:
+        plt = pyplot()
+        plot_per_group(table, 'Age', plt.gca())
         plt.xticks()
         plt.show()
     else:
-        raise TypeError('dataframe type must be pandas.DataFrame')
+        plot_per_group(table, 'Age', ax)
+
+
+###############################################################################
+def ratio_table(value_counts):
+    """
+    Return the table of counts and percentages displayed by ratio().
+    """
+    counts = list(value_counts)
+    percentages = [round(x/sum(counts)*100, 2) for x in counts]
+    return np.stack((list(value_counts.index), counts, percentages), axis=1)
+
+
+def plot_ratio(value_counts, ax):
+    value_counts.plot(kind='bar', color='b', ax=ax)
+    ax.set_ylabel('# distinct students')
+
+
+def plot_per_group(table, xlabel, ax, solid=None):
+    # one line per row of table, dashed after the first solid rows, through
+    # its non-zero counts in sorted order of the columns
+    for i, label in enumerate(table.index):
+        linestyle = '-' if solid is None or i < solid else '--'
+        values = table.loc[label]
+        values[values > 0].sort_index().plot(linestyle=linestyle, marker='o',
+                                             label=label, ax=ax)
+    ax.legend(bbox_to_anchor=(1, 0.75))
+    ax.set_ylabel('# distinct students')
+    ax.set_xlabel(xlabel)
+
+
+def render_chart(chart, path, formats):
+    """
+    Draw a chart of render_report() on its own Figure (no pyplot state, no
+    display) and save it in each format.
+    """
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(10, 7))
+    ax = fig.subplots()
+    ax.set_facecolor('white')
+    if chart['kind'] == 'ratio':
+        plot_ratio(chart['table'], ax)
+    else:
+        plot_per_group(chart['table'], chart['xlabel'], ax,
+                       solid=chart.get('solid'))
+    for fmt in formats:
+        fig.savefig('{}.{}'.format(path, fmt), bbox_inches='tight',
+                    facecolor='white')
+
+
+def report_charts(cube):
+    charts = []
+    for column in ['gender', 'region', 'highest_education', 'imd_band',
+                   'age_band', 'disability']:
+        charts.append({'name': column, 'kind': 'ratio',
+                       'table': cube.value_counts(column)})
+    charts.append({'name': 'imd_per_region', 'kind': 'lines', 'xlabel': 'IMD',
+                   'solid': 10, 'table': cube.lines('region', 'imd_band')})
+    charts.append({'name': 'ed_per_age', 'kind': 'lines', 'xlabel': 'Age',
+                   'table': cube.lines('highest_education', 'age_band')})
+    return charts
+
+
+def chart_hash(chart, formats):
+    content = repr((sorted((k, v) for k, v in chart.items() if k != 'table'),
+                    list(formats), chart['table'].to_csv()))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+@instrumented
+def render_report(dataframe0, output_dir, formats=('png', 'svg'), n_jobs=-1):
+    """
+    Render all the statistics tables and charts to files, without display:
+    one image per chart and format, and index.md / index.html with the tables
+    and the images.
+
+    The charts are rendered in parallel processes. A chart is not rendered
+    again if its input data (and formats) did not change since the last
+    report in output_dir.
+
+    Parameters
+    ----------
+    dataframe0 : pd.DataFrame or CountCube
+        The initial dataframe (or its count cube)
+    output_dir : str
+        The directory of the report
+    formats : tuple, default ('png', 'svg')
+        The image formats
+    n_jobs : int, default -1
+        The number of processes (joblib convention)
+
+    Returns
+    ----------
+    dict
+        The names of the 'rendered' and 'skipped' charts
+
+    Raises
+    ------
+    TypeError
+        If dataframe type is not pandas.DataFrame or CountCube
+    """
+    from joblib import Parallel, delayed
+
+    cube = as_cube(dataframe0)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_file = os.path.join(output_dir, 'report.json')
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    charts = report_charts(cube)
+    rendered, skipped = [], []
+    for chart in charts:
+        chart['hash'] = chart_hash(chart, formats)
+        path = os.path.join(output_dir, chart['name'])
+        if manifest.get(chart['name']) == chart['hash'] and all(
+                os.path.exists('{}.{}'.format(path, fmt)) for fmt in formats):
+            skipped.append(chart['name'])
+        else:
+            rendered.append(chart)
+    Parallel(n_jobs=n_jobs)(
+        delayed(render_chart)(chart, os.path.join(output_dir, chart['name']),
+                              formats)
+        for chart in rendered)
+
+    tables = [('Disability per gender',
+               cube.marginal('gender', where={'disability': 'Y'}).rename(
+                   '# disabled students')),
+              ('Region per IMD', cube.crosstab('region', 'imd_band')),
+              ('Age per education',
+               cube.crosstab('age_band', 'highest_education'))]
+    write_report_index(output_dir, charts, tables, cube.total(), formats[0])
+
+    manifest = {chart['name']: chart['hash'] for chart in charts}
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return {'rendered': [chart['name'] for chart in rendered],
+            'skipped': skipped}
+
+
+def write_report_index(output_dir, charts, tables, total, image_format):
+    from tabulate import tabulate
+
+    markdown = ['## Basic statistics', '',
+                'Distinct students: {}'.format(total), '']
+    html = ['<html><body>', '<h2>Basic statistics</h2>',
+            '<p>Distinct students: {}</p>'.format(total)]
+    for chart in charts:
+        image = '{}.{}'.format(chart['name'], image_format)
+        markdown.append('### {}'.format(chart['name']))
+        html.append('<h3>{}</h3>'.format(chart['name']))
+        if chart['kind'] == 'ratio':
+            headers = [chart['name'], '# distinct students', 'percentage (%)']
+            rows = ratio_table(chart['table'])
+            markdown += ['', tabulate(rows, headers=headers,
+                                      tablefmt='pipe'), '']
+            html.append(tabulate(rows, headers=headers, tablefmt='html'))
+        markdown += ['![{0}]({1})'.format(chart['name'], image), '']
+        html.append('<img src="{0}" alt="{1}">'.format(image, chart['name']))
+    for title, table in tables:
+        table = table.to_frame() if isinstance(table, pd.Series) else table
+        markdown += ['### {}'.format(title), '',
+                     tabulate(table, headers='keys', tablefmt='pipe'), '']
+        html += ['<h3>{}</h3>'.format(title),
+                 tabulate(table, headers='keys', tablefmt='html')]
+    html.append('</body></html>')
+    with open(os.path.join(output_dir, 'index.md'), 'w') as f:
+        f.write('\n'.join(markdown))
+    with open(os.path.join(output_dir, 'index.html'), 'w') as f:
+        f.write('\n'.join(html))
@@ -1,25 +1,35 @@
 """
 Functions:
     prepare_dataset()
-    add_protected_imd()     (encode_imd)
-    add_protected_gender()  (encode_gender)
+    prepare_enrollment_dataset()
+    AssessmentTimeline
+    early_features()
+    write_feature_matrix()
+    add_protected_imd()
+    add_protected_gender()
     filter_final_result()
-    encode_variables()      (encode_final_result, encode_disability,
-                             encode_education, encode_age, encode_region)
+    encode_variables()    (polars_encode)
+    VariableEncoder     (encodings)
     split()
+    split_rows()
 
 Author:
     Mélina Verger - Oct. 2021
 """
 
+import numpy as np
 import pandas as pd
-from sklearn.model_selection import train_test_split
+from engine import INDEX, column_names, finish, is_lazy, lazy, use_polars
+from enrollment import course_index, enrollment_key
+from instrument import instrumented
+from population import distinct_students
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
 ###############################################################################
-def prepare_dataset(dataframe0):
+@instrumented
+def prepare_dataset(dataframe0, engine=None):
     """
     Return a new dataframe with all columns except 'id_student', 'code_module'
     and 'code_presentation' and with distinct students' information only.
@@ -27,40 +37,515 @@ def prepare_dataset(dataframe0):
     Parameters
     ----------
     dataframe0 : pd.DataFrame
-        The initial dataframe
+        The initial dataframe (or a polars DataFrame or LazyFrame)
+    engine : str, optional
+        'pandas' or 'polars' (the current engine of engine.py by default)
 
     Returns
     ----------
     pd.DataFrame
-        The final dataframe
+        The final dataframe (of the kind of dataframe0)
     """
     columns = ['id_student', 'gender', 'region', 'highest_education',
                'imd_band', 'age_band', 'num_of_prev_attempts',
                'studied_credits', 'disability', 'final_result']
-    dataframe = dataframe0[columns]
-    # drop rows when same students' id (redundant students' info)
-    dataframe = dataframe.drop_duplicates(subset=['id_student'], keep='first')
+    if use_polars(dataframe0, engine):
+        query = lazy(dataframe0).unique(subset=['id_student'], keep='first',
+                                        maintain_order=True)
+        return finish(query.select([INDEX] + columns[1:]), dataframe0)
+    # first row of each student (redundant students' info), computed once
+    # per dataframe
+    dataframe = distinct_students(dataframe0)[columns]
 
     return dataframe.drop(columns=['id_student'])
 
 
 ###############################################################################
-def encode_imd(x):
-    if x in ['0-10%', '10-20', '20-30%', '30-40%', '40-50%']:
-        return 1
-    elif x in ['50-60%', '60-70%', '70-80%', '80-90%', '90-100%']:
-        return 0
-    else:
-        raise ValueError("missing values should have been removed")
+# features counting submissions or clicks (with the 'clicks_*' columns)
+count_features = ['n_assessments', 'n_late', 'n_banked', 'total_clicks',
+                  'active_days']
+
+
+def submissions(student_assessment, assessments, courses, exam):
+    # one row per submission with its enrollment key and day
+    if not exam:
+        assessments = assessments[assessments['assessment_type'] != 'Exam']
+    # position of the assessment of each submission
+    pos = pd.Index(assessments['id_assessment']).get_indexer(
+        student_assessment['id_assessment'])
+    submitted = student_assessment[pos != -1]
+    pos = pos[pos != -1]
+
+    course = course_index(assessments, courses)[pos]
+    weight = assessments['weight'].to_numpy('float64')[pos]
+    deadline = assessments['date'].astype('float64').to_numpy()[pos]
+    score = submitted['score'].astype('float64').to_numpy()
+    delay = submitted['date_submitted'].to_numpy('float64') - deadline
+
+    student = submitted['id_student'].to_numpy('int64')
+    return pd.DataFrame({
+        'key': student * len(courses) + course,
+        'day': submitted['date_submitted'].to_numpy('int64'),
+        'n_assessments': 1,
+        'mean_score': score,
+        'weighted_score': score * weight,
+        'weight': np.where(np.isnan(score), 0, weight),
+        'n_late': delay > 0,
+        'mean_delay': delay,
+        'n_banked': submitted['is_banked'].to_numpy()})
+
+
+def fill_counts(features):
+    # an enrollment without submission or click counts 0 of them, but its
+    # scores, delays and days of activity are unknown (left NaN): day 0 is
+    # the course start and 0 a score
+    counts = [column for column in features.columns
+              if column in count_features or column.startswith('clicks_')]
+    return features.fillna(dict.fromkeys(counts, 0))
+
+
+def assessment_features(student_assessment, assessments, courses, exam):
+    features = submissions(student_assessment, assessments, courses,
+                           exam).drop(columns=['day'])
+    features = features.groupby('key').agg(
+        {'n_assessments': 'sum', 'mean_score': 'mean', 'weighted_score': 'sum',
+         'weight': 'sum', 'n_late': 'sum', 'mean_delay': 'mean',
+         'n_banked': 'sum'})
+    features['weighted_score'] = (features['weighted_score'] /
+                                  features.pop('weight').replace(0, np.nan))
+    return features
+
+
+@instrumented
+def prepare_enrollment_dataset(student_info, student_registration,
+                               student_assessment, assessments, courses,
+                               vle_activity=None, exam=False):
+    """
+    Return a new dataframe with one row per enrollment (module presentation
+    followed by a student): the columns of prepare_dataset() followed by
+    registration, course, assessment and VLE features.
+
+    The tables are joined on an integer enrollment key (see enrollment_key()
+    in enrollment.py) instead of merges on the 3 key columns. The index is the
+    one of student_info. The counts of an enrollment without submission or
+    click (n_assessments, total_clicks...) are 0, its scores, delays and
+    first/last days of activity are left NaN, as an unknown registration
+    date.
+
+    It replaces prepare_dataset() before filter_final_result() and
+    encode_variables(), with the other tables as arguments: where
+    prepare_dataset() keeps the first enrollment of each student of
+    student_info, it keeps all the enrollments (the columns of
+    prepare_dataset() come first).
+
+    Parameters
+    ----------
+    student_info : pd.DataFrame
+        The 'studentInfo.csv' data table
+    student_registration : pd.DataFrame
+        The 'studentRegistration.csv' data table
+    student_assessment : pd.DataFrame
+        The 'studentAssessment.csv' data table
+    assessments : pd.DataFrame
+        The 'assessments.csv' data table
+    courses : pd.DataFrame
+        The 'courses.csv' data table
+    vle_activity : pd.DataFrame, optional
+        The VLE activity per enrollment (see aggregate_student_vle() in
+        2_script.py)
+    exam : bool, default False
+        Whether to use the exam scores (which determine the final result)
+
+    Returns
+    ----------
+    pd.DataFrame
+        The final dataframe
+    """
+    columns = ['gender', 'region', 'highest_education', 'imd_band',
+               'age_band', 'num_of_prev_attempts', 'studied_credits',
+               'disability', 'final_result']
+    dataframe = student_info[columns].copy()
+    key = enrollment_key(student_info, courses)
+
+    # 'date_unregistration' is left out as it reveals withdrawals
+    registration = pd.Series(
+        student_registration['date_registration'].astype('float64').to_numpy(),
+        index=enrollment_key(student_registration, courses))
+    # an unknown registration date stays NaN: day 0 is the course start
+    dataframe['date_registration'] = registration.reindex(key).to_numpy()
+    dataframe['module_presentation_length'] = (
+        courses['module_presentation_length'].to_numpy()[
+            course_index(student_info, courses)])
+
+    features = [assessment_features(student_assessment, assessments, courses,
+                                    exam)]
+    if vle_activity is not None:
+        keys = ['id_student', 'code_module', 'code_presentation']
+        features.append(vle_activity.drop(columns=keys).set_axis(
+            enrollment_key(vle_activity, courses)))
+    for feature in features:
+        dataframe = dataframe.join(
+            fill_counts(feature.reindex(key).set_axis(dataframe.index)))
+    return dataframe
+
+
+###############################################################################
+class AssessmentTimeline:
+    """
+    Running sums of the assessment submissions of each enrollment, ordered by
+    submission day, computed once: the assessment features of
+    prepare_enrollment_dataset() at any cutoff day are then differences of two
+    running sums (see at()).
+
+    Parameters
+    ----------
+    student_assessment : pd.DataFrame
+        The 'studentAssessment.csv' data table
+    assessments : pd.DataFrame
+        The 'assessments.csv' data table
+    courses : pd.DataFrame
+        The 'courses.csv' data table
+    exam : bool, default False
+        Whether to use the exam scores (which determine the final result)
+    """
+
+    sums = ['n_assessments', 'scored', 'score', 'weighted_score', 'weight',
+            'n_late', 'delayed', 'delay', 'n_banked']
+
+    @instrumented
+    def __init__(self, student_assessment, assessments, courses, exam=False):
+        rows = submissions(student_assessment, assessments, courses, exam)
+        score = rows['mean_score'].to_numpy()
+        delay = rows['mean_delay'].to_numpy()
+        values = {'n_assessments': rows['n_assessments'].to_numpy(),
+                  'scored': ~np.isnan(score),
+                  'score': np.nan_to_num(score),
+                  'weighted_score': np.nan_to_num(
+                      rows['weighted_score'].to_numpy()),
+                  'weight': rows['weight'].to_numpy(),
+                  'n_late': rows['n_late'].to_numpy(),
+                  'delayed': ~np.isnan(delay),
+                  'delay': np.nan_to_num(delay),
+                  'n_banked': rows['n_banked'].to_numpy()}
+
+        key = rows['key'].to_numpy()
+        day = rows['day'].to_numpy()
+        self.first_day = int(day.min()) if len(day) else 0
+        # days per key in the sort key (the last one after all submissions)
+        self.span = int(day.max()) - self.first_day + 2 if len(day) else 1
+        order = np.lexsort((day, key))
+        self.sort_key = (key * self.span + day - self.first_day)[order]
+        self.cumsum = {name: np.concatenate([[0], np.cumsum(
+            values[name][order], dtype='float64')]) for name in self.sums}
+
+    @instrumented
+    def at(self, keys, cutoff):
+        """
+        Return the assessment features of enrollments from their submissions
+        before a cutoff day.
+
+        Parameters
+        ----------
+        keys : np.array
+            The enrollment keys (see enrollment_key() in enrollment.py)
+        cutoff : int
+            The cutoff day (submissions on days < cutoff are counted)
+
+        Returns
+        ----------
+        pd.DataFrame
+            One row per key with the assessment features of
+            prepare_enrollment_dataset() (NaN means without submission)
+        """
+        base = np.asarray(keys, dtype='int64') * self.span
+        lo = np.searchsorted(self.sort_key, base)
+        hi = np.searchsorted(self.sort_key, base + int(np.clip(
+            cutoff - self.first_day, 0, self.span - 1)))
+        sums = {name: cumsum[hi] - cumsum[lo]
+                for name, cumsum in self.cumsum.items()}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return pd.DataFrame({
+                'n_assessments': sums['n_assessments'],
+                'mean_score': sums['score'] / sums['scored'],
+                'weighted_score': np.where(
+                    sums['weight'] > 0,
+                    sums['weighted_score'] / sums['weight'], np.nan),
+                'n_late': sums['n_late'],
+                'mean_delay': sums['delay'] / sums['delayed'],
+                'n_banked': sums['n_banked']})
+
+
+@instrumented
+def early_features(dataframe, keys, courses, cutoff, timeline, cube=None):
+    """
+    Return the features of the enrollments known at a cutoff day of their
+    module presentation: the columns of dataframe followed by the assessment
+    features and the clicks before the cutoff.
+
+    The submissions and clicks are only sliced at the cutoff (see
+    AssessmentTimeline and ClickCube in clicks.py, built once for all
+    cutoffs). The counts of an enrollment without submission or click before
+    the cutoff are 0, its scores and delays are left NaN.
+
+    Parameters
+    ----------
+    dataframe : pd.DataFrame
+        The features known from the start, one row per enrollment (e.g. the
+        encoded columns of prepare_dataset() of 'studentInfo.csv')
+    keys : pd.DataFrame
+        The 'id_student', 'code_module' and 'code_presentation' of the rows of
+        dataframe
+    courses : pd.DataFrame
+        The 'courses.csv' data table
+    cutoff : int
+        The cutoff day (submissions and clicks on days < cutoff are counted)
+    timeline : AssessmentTimeline
+        The running sums of the submissions
+    cube : ClickCube, optional
+        The clicks (see build_click_cube() in 2_script.py), no click features
+        if None
+
+    Returns
+    ----------
+    pd.DataFrame
+        The final dataframe
+    """
+    features = [timeline.at(enrollment_key(keys, courses), cutoff)]
+    if cube is not None:
+        rows = cube.rows(keys)
+        mix = cube.activity_mix(None, cutoff, rows=rows)
+        features.append(pd.DataFrame({
+            'total_clicks': mix.sum(axis=1),
+            'clicks_last_week': cube.range_sum(cutoff - 7, cutoff,
+                                               rows=rows)}))
+        features.append(mix.add_prefix('clicks_'))
+    features = fill_counts(pd.concat(features, axis=1))
+    return dataframe.join(features.set_axis(dataframe.index))
+
+
+###############################################################################
+@instrumented
+def write_feature_matrix(path, features, keys, courses, vle_chunks=(),
+                         bin_days=7, first_day=-25, last_day=269):
+    """
+    Write the feature matrix of enrollments to a .npy file: the columns of
+    features followed by the clicks per period of bin_days days, summed chunk
+    by chunk from the click log.
+
+    The matrix is filled in place through a memory map, so memory holds one
+    chunk of the click log at a time, whatever its size.
+
+    Parameters
+    ----------
+    path : str
+        The .npy file of the matrix (float32)
+    features : pd.DataFrame
+        The numerical features, one row per enrollment
+    keys : pd.DataFrame
+        The 'id_student', 'code_module' and 'code_presentation' of the rows of
+        features (e.g. student_info)
+    courses : pd.DataFrame
+        The 'courses.csv' data table
+    vle_chunks : iterable, default ()
+        The chunks of 'studentVle.csv' (see stream_data() in 2_script.py)
+    bin_days : int, default 7
+        The number of days per click column
+    first_day : int, default -25
+        The first day of the click columns (clicks before are counted in the
+        first column)
+    last_day : int, default 269
+        The last day of the click columns (clicks after are counted in the
+        last column)
+
+    Returns
+    ----------
+    np.memmap
+        The feature matrix (opened read-only)
+    list
+        The names of its columns
+
+    Raises
+    ------
+    ValueError
+        If keys does not have one distinct enrollment per row of features
+    """
+    key = pd.Index(enrollment_key(keys, courses))
+    if len(key) != len(features) or not key.is_unique:
+        raise ValueError("keys must have one distinct enrollment per row of "
+                         "features")
+    n_bins = (last_day - first_day) // bin_days + 1
+    columns = list(features.columns) + [
+        'clicks_day_{}'.format(first_day + i * bin_days)
+        for i in range(n_bins)]
+    n_features = features.shape[1]
+
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype='float32',
+                                       shape=(len(features), len(columns)))
+    matrix[:, :n_features] = features.to_numpy(dtype='float32')
+    matrix[:, n_features:] = 0
+    for chunk in vle_chunks:
+        row = key.get_indexer(enrollment_key(chunk, courses))
+        day = np.clip(chunk['date'].to_numpy('int64'), first_day, last_day)
+        # sum the clicks of the chunk per (row, column) before writing them
+        cell = (row * n_bins + (day - first_day) // bin_days)[row != -1]
+        cell, inverse = np.unique(cell, return_inverse=True)
+        clicks = np.bincount(inverse, weights=chunk['sum_click'].to_numpy(
+            'float64')[row != -1])
+        matrix[cell // n_bins, n_features + cell % n_bins] += clicks
+    matrix.flush()
+    del matrix
+    return np.load(path, mmap_mode='r'), columns
+
+
+###############################################################################
+# codes of the categorical variables
+encodings = {
+    'gender': {'M': 1, 'F': 0},
+    # low IMD (1) and high IMD (0), '10-20' is written without % in the csv
+    'imd_band': {'0-10%': 1, '10-20': 1, '10-20%': 1, '20-30%': 1,
+                 '30-40%': 1, '40-50%': 1, '50-60%': 0, '60-70%': 0,
+                 '70-80%': 0, '80-90%': 0, '90-100%': 0},
+    'final_result': {'Pass': 1, 'Fail': 0},
+    'disability': {'Y': 1, 'N': 0},
+    'highest_education': {'No Formal quals': 0,
+                          'Lower Than A Level': 1,
+                          'A Level or Equivalent': 2,
+                          'HE Qualification': 3,
+                          'Post Graduate Qualification': 4},
+    'age_band': {'0-35': 0, '35-55': 1, '55<=': 2},
+    'region': {'East Anglian Region': 0,
+               'Scotland': 1,
+               'North Western Region': 2,
+               'South East Region': 3,
+               'West Midlands Region': 4,
+               "Wales": 5,
+               "North Region": 6,
+               "South Region": 7,
+               "Ireland": 8,
+               "South West Region": 9,
+               "East Midlands Region": 10,
+               "Yorkshire Region": 11,
+               "London Region": 12}}
+
+
+class VariableEncoder:
+    """
+    Encode categorical variables with the codes of encodings, all values of a
+    column at once (through category codes).
 
+    fit() builds the lookup tables once, so that a fitted encoder can be
+    reused at scoring time or inside a sklearn Pipeline (the sklearn
+    estimator interface is implemented without importing sklearn).
 
-def encode_gender(x):
-    if x == 'M':
-        return 1
-    else:
-        return 0
+    Parameters
+    ----------
+    columns : list, optional
+        The columns to encode (the columns of encodings found in the fitted
+        dataframe by default)
+    """
 
+    def __init__(self, columns=None):
+        self.columns = columns
+
+    def __repr__(self):
+        return 'VariableEncoder(columns={!r})'.format(self.columns)
+
+    def get_params(self, deep=True):
+        return {'columns': self.columns}
+
+    def set_params(self, **params):
+        for name, value in params.items():
+            if name != 'columns':
+                raise ValueError("invalid parameter {}".format(name))
+            setattr(self, name, value)
+        return self
+
+    def fit_transform(self, X, y=None):
+        return self.fit(X, y).transform(X)
+
+    @instrumented
+    def fit(self, X, y=None):
+        """
+        Build the lookup tables of the columns to encode.
+
+        Parameters
+        ----------
+        X : pd.DataFrame
+            The dataframe to encode
+        y : None
+            Ignored
+
+        Returns
+        ----------
+        VariableEncoder
+            The fitted encoder
+
+        Raises
+        ------
+        ValueError
+            If a column has no encoding or is not in X
+        """
+        if self.columns is None:
+            columns = [column for column in encodings if column in X]
+        else:
+            columns = list(self.columns)
+        for column in columns:
+            if column not in encodings:
+                raise ValueError("no encoding for column {}, columns must be "
+                                 "included in: {}".format(
+                                     column, ', '.join(encodings)))
+            if column not in X:
+                raise ValueError("column {} is not in the dataframe"
+                                 .format(column))
+        self.columns_ = columns
+        self.categories_ = {column: pd.Index(list(encodings[column]))
+                            for column in columns}
+        self.codes_ = {column: np.array(list(encodings[column].values()))
+                       for column in columns}
+        return self
+
+    @instrumented
+    def transform(self, X):
+        """
+        Return a copy of X with the encoded columns.
+
+        Parameters
+        ----------
+        X : pd.DataFrame
+            The dataframe to encode
+
+        Returns
+        ----------
+        pd.DataFrame
+            The encoded dataframe
+
+        Raises
+        ------
+        ValueError
+            If a column contains missing values or values without encoding
+        """
+        if not hasattr(self, 'columns_'):
+            raise ValueError("this VariableEncoder is not fitted yet, call "
+                             "fit() first")
+        X = X.copy()
+        for column in self.columns_:
+            values = X[column]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                # recode the category codes (-1 for missing or unseen values)
+                codes = np.append(self.categories_[column].get_indexer(
+                    values.cat.categories), -1)[values.cat.codes.to_numpy()]
+            else:
+                codes = self.categories_[column].get_indexer(values)
+            if (codes == -1).any():
+                unknown = pd.unique(X[column].to_numpy()[codes == -1])
+                raise ValueError("missing or unseen values in column {}: {}"
+                                 .format(column, ', '.join(map(str, unknown))))
+            X[column] = self.codes_[column][codes]
+        return X
 
+
+###############################################################################
+@instrumented
 def add_protected_imd(dataframe):
     """
     Apply encoding for IMD protected attribute.
@@ -78,10 +563,10 @@ def add_protected_imd(dataframe):
     # remove when IMD missing
     new_dataframe = dataframe.dropna(subset=['imd_band'])
 
-    new_dataframe.loc[:, 'imd_band'] = new_dataframe.imd_band.apply(encode_imd)  # specific syntax to avoid SettingWithCopyWarning
-    return new_dataframe
+    return VariableEncoder(['imd_band']).fit_transform(new_dataframe)
 
 
+@instrumented
 def add_protected_gender(dataframe):
     """
     Apply encoding for gender protected attribute.
@@ -96,86 +581,41 @@ def add_protected_gender(dataframe):
     pd.DataFrame
         The final dataframe
     """
-    dataframe.loc[:, 'gender'] = dataframe.gender.apply(encode_gender)  # specific syntax to avoid SettingWithCopyWarning
-    return dataframe
+    return VariableEncoder(['gender']).fit_transform(dataframe)
 
 
 ###############################################################################
-def filter_final_result(dataframe):
+@instrumented
+def filter_final_result(dataframe, engine=None):
     """
     Return the dataframe filtered on final_result column.
 
     Parameters
     ----------
     dataframe : pd.DataFrame
-        The initial pd.DataFrame
+        The initial pd.DataFrame (or a polars DataFrame or LazyFrame)
+    engine : str, optional
+        'pandas' or 'polars' (the current engine of engine.py by default)
 
     Returns
     ----------
     pd.DataFrame
-        The final pd.DataFrame
+        The final pd.DataFrame (of the kind of dataframe)
     """
     column = 'final_result'
     options = ['Pass', 'Fail']
+    if use_polars(dataframe, engine):
+        import polars as pl
+
+        query = lazy(dataframe).filter(
+            pl.col(column).cast(pl.String).is_in(options))
+        return finish(query, dataframe)
     return dataframe[dataframe[column].isin(options)]  # keep associated rows
 
 
 ###############################################################################
-def encode_final_result(x):
-    if x == "Pass":
-        return 1
-    else:  # "Fail"
-        return 0
-
-
-def encode_disability(x):
-    if x == "Y":
-        return 1
-    else:  # "N"
-        return 0
-
-
-def encode_education(x):
-    if x == "No Formal quals":
-        return 0
-    elif x == "Lower Than A Level":
-        return 1
-    elif x == "A Level or Equivalent":
-        return 2
-    elif x == "HE Qualification":
-        return 3
-    else:  # "Post Graduate Qualification"
-        return 4
-
-
-def encode_age(x):
-    if x == "0-35":
-        return 0
-    elif x == "35-55":
-        return 1
-    else:  # "55<="
-        return 2
-
-
-def encode_region(dataframe):
-    dict_region = {'East Anglian Region': 0,
-                   'Scotland': 1,
-                   'North Western Region': 2,
-                   'South East Region': 3,
-                   'West Midlands Region': 4,
-                   "Wales": 5,
-                   "North Region": 6,
-                   "South Region": 7,
-                   "Ireland": 8,
-                   "South West Region": 9,
-                   "East Midlands Region": 10,
-                   "Yorkshire Region": 11,
-                   "London Region": 12}
-    dataframe['region'] = dataframe.region.map(dict_region)
-    return dataframe
-
-
-def encode_variables(dataframe):
+@instrumented
+def encode_variables(dataframe, engine=None):
     """
     Apply encoding for all variables except protected attributes and numerical
     variables.
@@ -183,23 +623,60 @@ def encode_variables(dataframe):
     Parameters
     ----------
     dataframe : pd.DataFrame
-        The initial dataframe
+        The initial dataframe (or a polars DataFrame or LazyFrame)
+    engine : str, optional
+        'pandas' or 'polars' (the current engine of engine.py by default)
 
     Returns
     ----------
     pd.DataFrame
-        The final dataframe
+        The final dataframe (of the kind of dataframe)
+
+    Raises
+    ------
+    ValueError
+        If a column is missing or contains missing values or values without
+        encoding (when it is collected for a LazyFrame)
     """
-    dataframe.loc[:, 'final_result'] = dataframe.final_result.apply(encode_final_result)  # specific syntax to avoid SettingWithCopyWarning
-    dataframe.loc[:, 'disability'] = dataframe.disability.apply(encode_disability)
-    dataframe.loc[:, 'highest_education'] = dataframe.highest_education.apply(encode_education)
-    dataframe.loc[:, 'age_band'] = dataframe.age_band.apply(encode_age)
-    dataframe = encode_region(dataframe)
-    return dataframe
+    columns = ['final_result', 'disability', 'highest_education', 'age_band',
+               'region']
+    if use_polars(dataframe, engine):
+        return polars_encode(dataframe, columns)
+    return VariableEncoder(columns).fit_transform(dataframe)
+
+
+def polars_encode(dataframe, columns):
+    # same codes and errors as VariableEncoder, as one polars query
+    import polars as pl
+
+    names = column_names(dataframe)
+    for column in columns:
+        if column not in names:
+            raise ValueError("column {} is not in the dataframe"
+                             .format(column))
+    values = {column: pl.col(column).cast(pl.String) for column in columns}
+    if not is_lazy(dataframe):
+        unknown = lazy(dataframe).select(
+            values[column].filter(values[column].is_null() | ~values[column]
+                                  .is_in(list(encodings[column])))
+            .unique(maintain_order=True).implode() for column in columns)
+        for column, missing in unknown.collect().row(0, named=True).items():
+            if missing:
+                raise ValueError("missing or unseen values in column {}: {}"
+                                 .format(column, ', '.join(
+                                     'nan' if value is None else value
+                                     for value in missing)))
+    query = lazy(dataframe).with_columns(
+        values[column].replace_strict(list(encodings[column]),
+                                      list(encodings[column].values()),
+                                      return_dtype=pl.Int64).alias(column)
+        for column in columns)
+    return finish(query, dataframe, changed=columns)
 
 
 ###############################################################################
-def split(dataframe, test_=0.3):
+@instrumented
+def split(dataframe, test_=0.3, random_state=0):
     """
     Apply encoding for all variables except protected attributes and numerical
     variables.
@@ -208,6 +685,10 @@ def split(dataframe, test_=0.3):
     ----------
     dataframe : pd.DataFrame
         The initial dataframe
+    test_ : float, default 0.3
+        The proportion of test instances
+    random_state : int, default 0
+        The seed of the split
 
     Returns
     ----------
@@ -216,7 +697,36 @@ def split(dataframe, test_=0.3):
     X_test : pd.DataFrame
     y_test : pd.Series
     """
+    from sklearn.model_selection import train_test_split
+
     return train_test_split(dataframe.drop(columns=['final_result']),  # X
                             dataframe['final_result'],  # y
                             test_size=test_,
-                            random_state=0)
+                            random_state=random_state)
+
+
+@instrumented
+def split_rows(n_rows, test_=0.3, random_state=0):
+    """
+    Return the positions of the train and test rows of split() for a
+    dataframe of n_rows rows (e.g. to split a feature matrix on disk the same
+    way).
+
+    Parameters
+    ----------
+    n_rows : int
+        The number of rows
+    test_ : float, default 0.3
+        The proportion of test instances
+    random_state : int, default 0
+        The seed of the split
+
+    Returns
+    ----------
+    train : np.array
+    test : np.array
+    """
+    from sklearn.model_selection import train_test_split
+
+    return train_test_split(np.arange(n_rows), test_size=test_,
+                            random_state=random_state)
@@ -3,57 +3,382 @@ Author:
     Mélina Verger - Oct. 2021
 """
 
+import os
+from itertools import combinations
+
+import numpy as np
 import pandas as pd
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import (accuracy_score, recall_score, precision_score,
-                             confusion_matrix)
+
+from instrument import instrumented
+
+# scikit-learn and joblib are imported by the functions using them, on their
+# first call
 
 
 ###############################################################################
-def rf_model():
-    return RandomForestClassifier(random_state=0)
+def rf_model(random_state=0, n_jobs=None):
+    from sklearn.ensemble import RandomForestClassifier
 
+    return RandomForestClassifier(random_state=random_state, n_jobs=n_jobs)
 
+
+@instrumented
 def train(model, X_train, y_train):
     return model.fit(X_train, y_train)
 
 
+@instrumented
 def pred(model, X_test):
     return model.predict(X_test)
 
 
+@instrumented
 def pred_proba(model, X_test):
     return model.predict_proba(X_test)
 
 
 ###############################################################################
+# Model artifacts: the trees of a fitted forest are stored as flat arrays
+# (one .npy file per node attribute), so that np.load(..., mmap_mode='r')
+# shares a single copy of them between the processes scoring with the model
+# (a pickled sklearn forest is copied into each process when loaded).
+forest_arrays = ['roots', 'left', 'right', 'feature', 'threshold',
+                 'missing_left', 'proba']
+
+
+class FlatForest:
+    """
+    Forest of a fitted RandomForestClassifier stored as flat arrays of nodes,
+    returning the same probabilities as the forest.
+
+    Parameters
+    ----------
+    arrays : dict
+        The np.array of each name of forest_arrays
+    classes : list
+        The classes of the forest
+    features : list
+        The columns of the dataframes to score, in the order of the training
+    encoded : list
+        The columns encoded by the VariableEncoder of the model
+    """
+
+    def __init__(self, arrays, classes, features, encoded):
+        for name in forest_arrays:
+            setattr(self, name, arrays[name])
+        self.classes_ = np.asarray(classes)
+        self.features = list(features)
+        self.encoded = list(encoded)
+
+    @classmethod
+    def from_model(cls, model, features, encoded=()):
+        """
+        Return the flat arrays of the trees of a fitted forest.
+
+        Parameters
+        ----------
+        model : RandomForestClassifier
+            The fitted forest
+        features : list
+            The columns the forest was trained on
+        encoded : list, default ()
+            The columns encoded by the VariableEncoder of the model
+
+        Returns
+        ----------
+        FlatForest
+            The flat forest
+        """
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        sizes = np.array([tree.node_count for tree in trees])
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+        def children(tree, offset, side):
+            child = getattr(tree, side)
+            return np.where(child == -1, -1, child + offset)
+
+        # probabilities of each node, as returned by tree.predict_proba()
+        values = np.concatenate([tree.value[:, 0, :] for tree in trees])
+        total = values.sum(axis=1, keepdims=True)
+        arrays = {
+            'roots': offsets.astype('int32'),
+            'left': np.concatenate([children(tree, offset, 'children_left')
+                                    for tree, offset in zip(trees, offsets)])
+            .astype('int32'),
+            'right': np.concatenate([children(tree, offset, 'children_right')
+                                     for tree, offset in zip(trees, offsets)])
+            .astype('int32'),
+            'feature': np.concatenate([tree.feature for tree in trees])
+            .astype('int32'),
+            'threshold': np.concatenate([tree.threshold for tree in trees]),
+            'missing_left': np.concatenate(
+                [tree.missing_go_to_left for tree in trees]).astype(bool),
+            'proba': values / np.where(total == 0, 1, total)}
+        return cls(arrays, model.classes_, features, encoded)
+
+    def predict_proba(self, X):
+        """
+        Return the probabilities of the classes, averaged over the trees.
+
+        All the trees are walked down at once, one level per iteration.
+
+        Parameters
+        ----------
+        X : np.array of shape (n_instances, n_features)
+            The instances to score (columns in the order of features)
+
+        Returns
+        ----------
+        np.array of shape (n_instances, n_classes)
+            The probabilities of the classes
+
+        Raises
+        ------
+        ValueError
+            If X does not have one column per feature
+        """
+        # the trees compare float32 values (as sklearn does)
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != len(self.features):
+            raise ValueError("X must have {} columns: {}".format(
+                len(self.features), ', '.join(self.features)))
+        rows = np.broadcast_to(np.arange(len(X)), (len(self.roots), len(X)))
+        node = np.repeat(np.asarray(self.roots)[:, None], len(X), axis=1)
+        rows = rows.ravel()
+        node = node.ravel()
+        inner = np.flatnonzero(np.asarray(self.left)[node] != -1)
+        while len(inner):
+            index = node[inner]
+            value = X[rows[inner], self.feature[index]]
+            go_left = ((value <= self.threshold[index]) |
+                       (np.isnan(value) & self.missing_left[index]))
+            node[inner] = np.where(go_left, self.left[index],
+                                   self.right[index])
+            inner = inner[self.left[node[inner]] != -1]
+        return (np.asarray(self.proba)[node]
+                .reshape(len(self.roots), len(X), -1).mean(axis=0))
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+@instrumented
+def save_model(path, model, encoder, features):
+    """
+    Save a fitted forest and its fitted VariableEncoder in a directory (flat
+    arrays of the trees and a model.json with the columns).
+
+    Parameters
+    ----------
+    path : str
+        The directory of the model (created if needed)
+    model : RandomForestClassifier
+        The fitted forest
+    encoder : VariableEncoder
+        The fitted encoder of the categorical columns
+    features : list
+        The columns the forest was trained on, in order
+
+    Returns
+    ----------
+    FlatForest
+        The saved forest
+    """
+    import json
+    import sklearn
+
+    forest = FlatForest.from_model(model, features, encoder.columns_)
+    os.makedirs(path, exist_ok=True)
+    for name in forest_arrays:
+        np.save(os.path.join(path, name + '.npy'), getattr(forest, name))
+    meta = {'classes': forest.classes_.tolist(), 'features': forest.features,
+            'encoded': forest.encoded, 'n_trees': len(forest.roots),
+            'sklearn': sklearn.__version__}
+    tmp = os.path.join(path, 'model.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, os.path.join(path, 'model.json'))
+    return forest
+
+
+@instrumented
+def load_model(path, mmap_mode='r'):
+    """
+    Load a model saved by save_model().
+
+    The encoder of the model is VariableEncoder(model.encoded) (the codes are
+    the ones of encodings, in 4_preprocessing.py).
+
+    Parameters
+    ----------
+    path : str
+        The directory of the model
+    mmap_mode : str or None, default 'r'
+        The mode of np.load() (None loads the arrays in memory)
+
+    Returns
+    ----------
+    FlatForest
+        The loaded forest
+    """
+    import json
+
+    with open(os.path.join(path, 'model.json')) as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(path, name + '.npy'),
+                            mmap_mode=mmap_mode)
+              for name in forest_arrays}
+    return FlatForest(arrays, meta['classes'], meta['features'],
+                      meta['encoded'])
+
+
+###############################################################################
+# Out-of-core training on a feature matrix on disk (see write_feature_matrix()
+# in 4_preprocessing.py): only one batch of rows is in memory at a time.
+def row_batches(rows, batch_size):
+    # sorted positions, so that a batch reads close pages of the matrix
+    rows = np.sort(rows)
+    for start in range(0, len(rows), batch_size):
+        yield rows[start:start + batch_size]
+
+
+def incremental_model(random_state=0):
+    from sklearn.linear_model import SGDClassifier
+
+    return SGDClassifier(loss='log_loss', random_state=random_state)
+
+
+@instrumented
+def train_incremental(model, X, y, rows, batch_size=65536, n_epochs=5,
+                      scale=True, random_state=0):
+    """
+    Train an estimator with partial_fit() on batches of rows of a feature
+    matrix (e.g. memory-mapped), so that memory does not grow with the
+    number of rows.
+
+    Parameters
+    ----------
+    model : estimator
+        An estimator with partial_fit() (e.g. incremental_model())
+    X : np.array of shape (n_rows, n_features)
+        The feature matrix
+    y : np.array of shape (n_rows,)
+        The target of all the rows
+    rows : np.array
+        The positions of the training rows (e.g. from split_rows() in
+        4_preprocessing.py)
+    batch_size : int, default 65536
+        The number of rows per batch
+    n_epochs : int, default 5
+        The number of passes over the training rows
+    scale : bool, default True
+        Whether to standardize the features (fitted in a first pass)
+    random_state : int, default 0
+        The seed of the order of the batches
+
+    Returns
+    ----------
+    estimator
+        The fitted model (a Pipeline with the StandardScaler if scale)
+
+    Raises
+    ------
+    ValueError
+        If model has no partial_fit() method
+    """
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    if not hasattr(model, 'partial_fit'):
+        raise ValueError("model must have a partial_fit() method")
+    y = np.asarray(y)
+    classes = np.unique(y[rows])
+    batches = list(row_batches(rows, batch_size))
+    scaler = StandardScaler() if scale else None
+    if scale:
+        for batch in batches:
+            scaler.partial_fit(X[batch])
+
+    rng = np.random.default_rng(random_state)
+    for _ in range(n_epochs):
+        for i in rng.permutation(len(batches)):
+            X_batch = X[batches[i]]
+            if scale:
+                X_batch = scaler.transform(X_batch)
+            model.partial_fit(X_batch, y[batches[i]], classes=classes)
+    return make_pipeline(scaler, model) if scale else model
+
+
+@instrumented
+def pred_batches(model, X, rows, batch_size=65536, proba=False):
+    """
+    Return the predictions (or the probabilities) of rows of a feature matrix,
+    computed batch by batch, in the order of rows.
+
+    Parameters
+    ----------
+    model : estimator
+        The fitted model
+    X : np.array of shape (n_rows, n_features)
+        The feature matrix
+    rows : np.array
+        The positions of the rows to predict
+    batch_size : int, default 65536
+        The number of rows per batch
+    proba : bool, default False
+        Whether to return predict_proba() instead of predict()
+
+    Returns
+    ----------
+    np.array
+        The predictions (or probabilities) of rows
+    """
+    rows = np.asarray(rows)
+    order = np.argsort(rows, kind='stable')
+    method = model.predict_proba if proba else model.predict
+    parts = [method(X[batch]) for batch in row_batches(rows, batch_size)]
+    predictions = np.concatenate(parts) if parts else np.empty(0)
+    # back to the order of rows
+    result = np.empty_like(predictions)
+    result[order] = predictions
+    return result
+
+
+###############################################################################
+@instrumented
 def accuracy(Y, Ypred):
+    from sklearn.metrics import accuracy_score
+
     return accuracy_score(Y, Ypred)
 
 
+@instrumented
 def recall(Y, Ypred):
+    from sklearn.metrics import recall_score
+
     return recall_score(Y, Ypred, average='binary')
 
 
+@instrumented
 def precision(Y, Ypred):
+    from sklearn.metrics import precision_score
+
     return precision_score(Y, Ypred, average='binary')
 
 
+@instrumented
 def demographic_parity(Y, Ypred):
+    from sklearn.metrics import confusion_matrix
+
     tn, fp, fn, tp = confusion_matrix(Y, Ypred).ravel()
     return (tp + fp) / (tn + fp + fn + tp)
 
 
 ###############################################################################
+@instrumented
 def metric_group(func, ind_group, Y, Ypred):
-    y_ind = list(Y.index)
-    Y, Ypred = list(Y), list(Ypred)
-    new_Y, new_Ypred = [], []
-    for i in range(len(y_ind)):
-        if y_ind[i] in ind_group:
-            new_Y.append(Y[i])
-            new_Ypred.append(Ypred[i])
-    return func(new_Y, new_Ypred)
+    in_group = Y.index.isin(ind_group)
+    return func(np.asarray(Y)[in_group], np.asarray(Ypred)[in_group])
 
 
 def accuracy_per_group(ind_group, Y, Ypred):
@@ -72,6 +397,824 @@ def demog_parity_per_group(ind_group, Y, Ypred):
     return metric_group(demographic_parity, ind_group, Y, Ypred)
 
 
+###############################################################################
+metrics = ['accuracy', 'recall', 'precision', 'demographic_parity']
+
+
+def confusion_per_code(codes, n_codes, Y, Ypred):
+    """
+    Return the confusion matrices of binary predictions for each code, in one
+    pass.
+
+    Parameters
+    ----------
+    codes : np.array
+        The code of each instance, in [0, n_codes) (-1 for instances left out)
+    n_codes : int
+        The number of codes
+    Y : array-like
+        The true labels (0 or 1)
+    Ypred : array-like
+        The predicted labels (0 or 1)
+
+    Returns
+    ----------
+    np.array of shape (n_codes, 4)
+        The (tn, fp, fn, tp) counts of each code
+    """
+    codes = np.asarray(codes)
+    kept = codes >= 0
+    cell = (codes[kept] * 4 + np.asarray(Y)[kept].astype(np.int64) * 2 +
+            np.asarray(Ypred)[kept].astype(np.int64))
+    return np.bincount(cell, minlength=n_codes * 4).reshape(n_codes, 4)
+
+
+def metrics_from_confusion(confusion):
+    """
+    Return the metrics computed from (tn, fp, fn, tp) counts (NaN when a
+    metric is undefined).
+
+    Parameters
+    ----------
+    confusion : np.array of shape (..., 4)
+        The (tn, fp, fn, tp) counts
+
+    Returns
+    ----------
+    dict
+        The arrays of accuracy, recall, precision and demographic_parity
+    """
+    confusion = np.asarray(confusion, dtype=np.float64)
+    tn, fp, fn, tp = np.moveaxis(confusion, -1, 0)
+    n = tn + fp + fn + tp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {'accuracy': (tp + tn) / n,
+                'recall': tp / (tp + fn),
+                'precision': tp / (tp + fp),
+                'demographic_parity': (tp + fp) / n}
+
+
+@instrumented
+def group_metrics(Y, Ypred, groups):
+    """
+    Return the metrics of each group of each protected attribute and their
+    gap with the metrics of all instances.
+
+    The confusion matrices of all the groups of an attribute are counted in
+    one pass (np.bincount over group code x label x prediction).
+
+    Parameters
+    ----------
+    Y : array-like
+        The true labels (0 or 1)
+    Ypred : array-like
+        The predicted labels (0 or 1)
+    groups : pd.DataFrame or pd.Series
+        The protected attribute(s) of each instance, in the order of Y (e.g.
+        X_test[['gender', 'imd_band']]); instances with a missing value are
+        left out for this attribute
+
+    Returns
+    ----------
+    pd.DataFrame
+        One row per (attribute, group, metric) with the number of instances of
+        the group, the metric value and its gap (value - value of all
+        instances); the first rows are the metrics of all instances
+    """
+    if isinstance(groups, pd.Series):
+        groups = groups.to_frame()
+    overall = metrics_from_confusion(
+        confusion_per_code(np.zeros(len(Y), dtype=np.int64), 1, Y, Ypred))
+
+    tables = [pd.DataFrame({'attribute': 'all', 'group': 'all', 'n': len(Y),
+                            'metric': metrics,
+                            'value': [overall[m][0] for m in metrics]})]
+    for attribute in groups.columns:
+        codes, uniques = pd.factorize(groups[attribute], sort=True)
+        confusion = confusion_per_code(codes, len(uniques), Y, Ypred)
+        values = metrics_from_confusion(confusion)
+        tables.append(pd.DataFrame({
+            'attribute': attribute,
+            'group': np.repeat(np.asarray(uniques, dtype=object),
+                               len(metrics)),
+            'n': np.repeat(confusion.sum(axis=1), len(metrics)),
+            'metric': np.tile(metrics, len(uniques)),
+            'value': np.stack([values[m] for m in metrics], axis=1).ravel()}))
+    table = pd.concat(tables, ignore_index=True)
+    table['gap'] = table['value'] - table['metric'].map(
+        {m: overall[m][0] for m in metrics})
+    return table
+
+
+def group_gap(table, attribute, group, reference):
+    """
+    Return the difference of the metrics between two groups of a protected
+    attribute (as the +/- columns of 5_PREDICTION.md).
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        The output of group_metrics()
+    attribute : str
+        The protected attribute
+    group : object
+        The group
+    reference : object
+        The reference group
+
+    Returns
+    ----------
+    pd.Series
+        The metric values of group minus the ones of reference
+    """
+    values = table[table['attribute'] == attribute].pivot(
+        index='metric', columns='group', values='value')
+    return (values[group] - values[reference]).reindex(metrics)
+
+
+@instrumented
+def subgroup_audit(Y, Ypred, attributes, max_depth=2, min_support=30,
+                   rank_by='accuracy'):
+    """
+    Return the metrics of every intersectional subgroup (e.g. gender=F and
+    age_band=0-35) defined by up to max_depth attributes, ranked by their gap
+    with the metrics of all instances.
+
+    The confusion matrices of all the subgroups of a combination of attributes
+    are counted in one pass (see confusion_per_code()). Subgroups with less
+    than min_support instances are left out, and so are their own subgroups.
+
+    Parameters
+    ----------
+    Y : array-like
+        The true labels (0 or 1)
+    Ypred : array-like
+        The predicted labels (0 or 1)
+    attributes : pd.DataFrame
+        The demographic attributes of each instance, in the order of Y
+    max_depth : int, default 2
+        The maximum number of attributes defining a subgroup
+    min_support : int, default 30
+        The minimum number of instances of a subgroup
+    rank_by : str, default 'accuracy'
+        The metric whose absolute gap ranks the subgroups
+
+    Returns
+    ----------
+    pd.DataFrame
+        One row per subgroup with its depth, the value of each attribute (None
+        if not used), its number of instances, the metrics and their gaps
+        ('gap_<metric>')
+
+    Raises
+    ------
+    ValueError
+        If rank_by is not in metrics
+    """
+    if rank_by not in metrics:
+        raise ValueError("rank_by argument must be included in:"
+                         " {}".format(', '.join(metrics)))
+    overall = metrics_from_confusion(
+        confusion_per_code(np.zeros(len(Y), dtype=np.int64), 1, Y, Ypred))
+    factorized = {column: pd.factorize(attributes[column], sort=True)
+                  for column in attributes.columns}
+
+    tables = []
+    for depth in range(1, max_depth + 1):
+        for columns in combinations(attributes.columns, depth):
+            # mixed radix code of the subgroup of each instance
+            code = np.zeros(len(Y), dtype=np.int64)
+            missing = np.zeros(len(Y), dtype=bool)
+            for column in columns:
+                codes, uniques = factorized[column]
+                code = code * len(uniques) + codes
+                missing |= codes == -1
+            code[missing] = -1
+            subgroup, observed = pd.factorize(code[~missing])
+            codes = np.full(len(Y), -1, dtype=np.int64)
+            codes[~missing] = subgroup
+            confusion = confusion_per_code(codes, len(observed), Y, Ypred)
+            support = confusion.sum(axis=1)
+            kept = support >= min_support
+            if not kept.any():
+                continue
+
+            table = pd.DataFrame({'depth': depth}, index=range(kept.sum()))
+            remainder = np.asarray(observed)[kept]
+            for column in reversed(columns):
+                uniques = factorized[column][1]
+                table[column] = np.asarray(uniques, dtype=object)[
+                    remainder % len(uniques)]
+                remainder = remainder // len(uniques)
+            table['n'] = support[kept]
+            values = metrics_from_confusion(confusion[kept])
+            for metric in metrics:
+                table[metric] = values[metric]
+                table['gap_' + metric] = values[metric] - overall[metric][0]
+            tables.append(table)
+
+    columns = (['depth'] + list(attributes.columns) + ['n'] + metrics +
+               ['gap_' + metric for metric in metrics])
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    table = pd.concat(tables, ignore_index=True).reindex(columns=columns)
+    table[list(attributes.columns)] = table[list(attributes.columns)].astype(
+        object).where(table[list(attributes.columns)].notna(), None)
+    order = table['gap_' + rank_by].abs().sort_values(ascending=False,
+                                                      na_position='last')
+    return table.loc[order.index].reset_index(drop=True)
+
+
+def bootstrap_batch(incidence, weights, size, seed):
+    """
+    Return the confusion counts of a batch of bootstrap replicates.
+
+    The instances with the same cells for every attribute are exchangeable,
+    so a replicate only draws how many times each combination of cells is
+    resampled (multinomial counts), without resampling the instances: the
+    memory of a batch is size x n_combinations, whatever the number of
+    instances.
+
+    Parameters
+    ----------
+    incidence : np.array of shape (n_combinations, n_cells)
+        Whether each distinct combination of cells contains each cell
+    weights : np.array of shape (n_combinations,)
+        The number of instances of each combination
+    size : int
+        The number of replicates
+    seed : np.random.SeedSequence or int
+        The seed of the replicates
+
+    Returns
+    ----------
+    np.array of shape (size, n_cells)
+        The counts of each cell in each replicate
+    """
+    rng = np.random.default_rng(seed)
+    n = weights.sum()
+    draws = rng.multinomial(n, weights / n, size=size)
+    return draws @ incidence
+
+
+@instrumented
+def bootstrap_group_metrics(Y, Ypred, groups, n_boot=1000, alpha=0.05,
+                            seed=0, batch_size=50, n_jobs=-1):
+    """
+    Return bootstrap confidence intervals of the metrics of each group of each
+    protected attribute, and of the gaps between groups with their p-values.
+
+    Replicates are drawn in batches; the confusion matrices of all groups of
+    all replicates of a batch are counted at once (from multinomial counts of
+    the combinations of groups and confusion cells, see bootstrap_batch()) and
+    the batches are spread over n_jobs processes. Results only depend on
+    seed, not on n_jobs.
+
+    Parameters
+    ----------
+    Y : array-like
+        The true labels (0 or 1)
+    Ypred : array-like
+        The predicted labels (0 or 1)
+    groups : pd.DataFrame or pd.Series
+        The protected attribute(s) of each instance, in the order of Y
+    n_boot : int, default 1000
+        The number of bootstrap replicates
+    alpha : float, default 0.05
+        The confidence intervals are [alpha/2, 1 - alpha/2] percentiles
+    seed : int, default 0
+        The seed of the replicates
+    batch_size : int, default 50
+        The number of replicates counted at once
+    n_jobs : int, default -1
+        The number of processes (joblib convention)
+
+    Returns
+    ----------
+    pd.DataFrame
+        One row per (attribute, group, metric) and per (attribute, group,
+        reference group, metric) for the gaps (group - reference), with the
+        value, ci_low, ci_high and, for the gaps, the two-sided p-value of a
+        null gap
+    """
+    from joblib import Parallel, delayed
+
+    if isinstance(groups, pd.Series):
+        groups = groups.to_frame()
+    label = np.asarray(Y).astype(np.int64) * 2 + np.asarray(Ypred).astype(
+        np.int64)
+
+    blocks, cells = [], []
+    offset = 0
+    for attribute in ['all'] + list(groups.columns):
+        if attribute == 'all':
+            codes, uniques = np.zeros(len(label), dtype=np.int64), ['all']
+        else:
+            codes, uniques = pd.factorize(groups[attribute], sort=True)
+        cells.append(np.where(codes >= 0, offset + codes * 4 + label, -1))
+        blocks.append((attribute, list(uniques), offset))
+        offset += len(uniques) * 4
+    cells = np.stack(cells)
+
+    point = np.bincount(cells[cells >= 0], minlength=offset)
+    # distinct combinations of the cells of all attributes
+    combinations, weights = np.unique(cells.T, axis=0, return_counts=True)
+    incidence = np.zeros((len(combinations), offset), dtype=np.int64)
+    for column in combinations.T:
+        kept = column >= 0
+        incidence[np.flatnonzero(kept), column[kept]] = 1
+    sizes = [batch_size] * (n_boot // batch_size)
+    if n_boot % batch_size:
+        sizes.append(n_boot % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    counts = np.concatenate(Parallel(n_jobs=n_jobs)(
+        delayed(bootstrap_batch)(incidence, weights, size, batch_seed)
+        for size, batch_seed in zip(sizes, seeds)))
+
+    quantiles = [alpha / 2, 1 - alpha / 2]
+    rows = []
+    for attribute, uniques, start in blocks:
+        stop = start + len(uniques) * 4
+        values = metrics_from_confusion(
+            point[start:stop].reshape(len(uniques), 4))
+        replicates = metrics_from_confusion(
+            counts[:, start:stop].reshape(n_boot, len(uniques), 4))
+        for metric in metrics:
+            low, high = np.nanquantile(replicates[metric], quantiles, axis=0)
+            for i, group in enumerate(uniques):
+                rows.append((attribute, group, None, metric,
+                             values[metric][i], low[i], high[i], np.nan))
+            for i, reference in enumerate(uniques):
+                for j in range(i + 1, len(uniques)):
+                    gaps = replicates[metric][:, j] - replicates[metric][:, i]
+                    gaps = gaps[~np.isnan(gaps)]
+                    if len(gaps) == 0:
+                        low = high = p_value = np.nan
+                    else:
+                        low, high = np.quantile(gaps, quantiles)
+                        # two-sided bootstrap p-value of a null gap
+                        p_value = min(1.0, 2 * (min((gaps <= 0).sum(),
+                                                    (gaps >= 0).sum()) + 1) /
+                                      (len(gaps) + 1))
+                    rows.append((attribute, uniques[j], reference, metric,
+                                 values[metric][j] - values[metric][i],
+                                 low, high, p_value))
+    table = pd.DataFrame(rows, dtype=object,
+                         columns=['attribute', 'group', 'reference', 'metric',
+                                  'value', 'ci_low', 'ci_high', 'p_value'])
+    numbers = ['value', 'ci_low', 'ci_high', 'p_value']
+    table[numbers] = table[numbers].astype(np.float64)
+    return table
+
+
+###############################################################################
+def run_experiment(X, y, groups, protected, name, model, seed, test_):
+    """
+    Split, train and evaluate one model with one seed (see run_experiments()).
+    """
+    from sklearn.base import clone
+    from sklearn.model_selection import train_test_split
+
+    X_train, X_test, y_train, y_test, _, groups_test = train_test_split(
+        X, y, groups, test_size=test_, random_state=seed)
+    model = clone(model)
+    if 'random_state' in model.get_params():
+        model.set_params(random_state=seed)
+    model.fit(X_train, y_train)
+    table = group_metrics(y_test, model.predict(X_test),
+                          pd.DataFrame(groups_test, columns=protected))
+    table.insert(0, 'seed', seed)
+    table.insert(0, 'model', name)
+    return table
+
+
+@instrumented
+def run_experiments(dataframe, models, seeds, protected=('gender', 'imd_band'),
+                    test_=0.3, n_jobs=-1):
+    """
+    Return the global and per-group metrics of every model trained with every
+    seed (split and model seed), the runs being spread over processes.
+
+    The arrays are memory-mapped by joblib and shared with the processes
+    instead of being copied. Each model's own n_jobs is set so that processes
+    x model threads do not exceed the number of cores.
+
+    Parameters
+    ----------
+    dataframe : pd.DataFrame
+        The encoded dataframe (see encode_variables() in 4_preprocessing.py)
+        with the 'final_result' target and the protected attributes
+    models : dict
+        The sklearn models (not fitted) by name, e.g. {'rf': rf_model()}
+    seeds : list
+        The seeds
+    protected : tuple, default ('gender', 'imd_band')
+        The protected attributes, not used for the prediction
+    test_ : float, default 0.3
+        The proportion of test instances
+    n_jobs : int, default -1
+        The number of processes (joblib convention)
+
+    Returns
+    ----------
+    pd.DataFrame
+        The output of group_metrics() of each run, with its model name and
+        seed
+    """
+    from joblib import Parallel, delayed
+
+    protected = list(protected)
+    X = dataframe.drop(columns=['final_result'] + protected).to_numpy()
+    y = dataframe['final_result'].to_numpy()
+    groups = dataframe[protected].to_numpy()
+
+    runs = [(name, seed) for seed in seeds for name in models]
+    n_workers, models = limit_threads(models, len(runs), n_jobs)
+    tables = Parallel(n_jobs=n_workers, max_nbytes='1M', mmap_mode='r')(
+        delayed(run_experiment)(X, y, groups, protected, name, models[name],
+                                seed, test_)
+        for name, seed in runs)
+    return pd.concat(tables, ignore_index=True)
+
+
+def limit_threads(models, n_tasks, n_jobs):
+    """
+    Return the number of processes and copies of the models whose n_jobs is
+    set so that processes x model threads do not exceed the number of cores.
+    """
+    from joblib import cpu_count, effective_n_jobs
+    from sklearn.base import clone
+
+    # the number of processes joblib starts (-2 is all cores but one...)
+    n_cpus = cpu_count()
+    n_workers = max(1, min(n_tasks, effective_n_jobs(n_jobs)))
+    threads = max(1, n_cpus // n_workers)
+    limited = {}
+    for name, model in models.items():
+        limited[name] = clone(model)
+        if 'n_jobs' in limited[name].get_params():
+            limited[name].set_params(n_jobs=threads)
+    return n_workers, limited
+
+
+###############################################################################
+def run_cutoff(X, y, groups, protected, train_, test, model, cutoff):
+    """
+    Train and evaluate one model on the features of one cutoff day (see
+    run_cutoffs()).
+    """
+    from sklearn.base import clone
+
+    model = clone(model).fit(X[train_], y[train_])
+    table = group_metrics(y[test], model.predict(X[test]),
+                          pd.DataFrame(groups[test], columns=protected))
+    table.insert(0, 'cutoff', cutoff)
+    return table
+
+
+@instrumented
+def run_cutoffs(datasets, model=None, protected=('gender', 'imd_band'),
+                test_=0.3, random_state=0, n_jobs=-1):
+    """
+    Return the global and per-group metrics of one early-warning model per
+    cutoff day, the models being trained in parallel processes.
+
+    All the cutoffs share the same train and test rows, so that their metrics
+    can be compared. The arrays are memory-mapped by joblib and shared with
+    the processes instead of being copied.
+
+    Parameters
+    ----------
+    datasets : dict
+        The encoded dataframe of each cutoff day (see early_features() in
+        4_preprocessing.py) with the 'final_result' target and the protected
+        attributes, all with the same rows
+    model : sklearn model, optional
+        The model (not fitted) trained for each cutoff (rf_model() by default)
+    protected : tuple, default ('gender', 'imd_band')
+        The protected attributes, not used for the prediction
+    test_ : float, default 0.3
+        The proportion of test instances
+    random_state : int, default 0
+        The seed of the split
+    n_jobs : int, default -1
+        The number of processes (joblib convention)
+
+    Returns
+    ----------
+    pd.DataFrame
+        The output of group_metrics() of each cutoff, with its cutoff day
+
+    Raises
+    ------
+    ValueError
+        If the datasets do not have the same rows
+    """
+    from joblib import Parallel, delayed
+    from sklearn.model_selection import train_test_split
+
+    protected = list(protected)
+    first = next(iter(datasets.values()))
+    if any(not dataset.index.equals(first.index)
+           for dataset in datasets.values()):
+        raise ValueError("datasets must have the same rows")
+    y = first['final_result'].to_numpy()
+    groups = first[protected].to_numpy()
+    # same rows as split_rows() in 4_preprocessing.py
+    train_, test = train_test_split(np.arange(len(first)), test_size=test_,
+                                    random_state=random_state)
+
+    n_workers, models = limit_threads(
+        {'model': rf_model() if model is None else model}, len(datasets),
+        n_jobs)
+    tables = Parallel(n_jobs=n_workers, max_nbytes='1M', mmap_mode='r')(
+        delayed(run_cutoff)(
+            dataset.drop(columns=['final_result'] + protected).to_numpy(),
+            y, groups, protected, train_, test, models['model'], cutoff)
+        for cutoff, dataset in datasets.items())
+    return pd.concat(tables, ignore_index=True)
+
+
+###############################################################################
+def fold_scores(X, y, groups, protected, train_, test, model):
+    """
+    Return the accuracy of a model trained on a fold and its gaps (largest
+    minus smallest group value) for each protected attribute and metric.
+    """
+    from sklearn.base import clone
+
+    model = clone(model).fit(X[train_], y[train_])
+    Ypred = model.predict(X[test])
+    scores = {'accuracy': accuracy(y[test], Ypred)}
+    for k, attribute in enumerate(protected):
+        codes, uniques = pd.factorize(groups[test, k], sort=True)
+        values = metrics_from_confusion(
+            confusion_per_code(codes, len(uniques), y[test], Ypred))
+        for metric in metrics:
+            scores['gap_{}_{}'.format(attribute, metric)] = (
+                np.nanmax(values[metric]) - np.nanmin(values[metric]))
+    return scores
+
+
+def dominated(summary, tolerance):
+    """
+    Return whether each configuration is beaten by another one by more than
+    tolerance on the accuracy and on every gap.
+    """
+    gaps = [column for column in summary.columns if column.startswith('gap_')]
+    # objectives to minimize
+    values = np.column_stack([-summary['accuracy'].to_numpy()] +
+                             [summary[gap].abs().to_numpy() for gap in gaps])
+    # beaten[j, i]: j is at least tolerance better than i on every objective
+    margin = values[None, :, :] - tolerance
+    beaten = ((values[:, None, :] <= margin).all(axis=2) &
+              (values[:, None, :] < margin).any(axis=2))
+    return beaten.any(axis=0)
+
+
+def pareto_front(summary, gap):
+    """
+    Return the configurations of a fairness_sweep() summary which are not
+    dominated on accuracy and on the given gap, by increasing gap.
+
+    Parameters
+    ----------
+    summary : pd.DataFrame
+        The summary returned by fairness_sweep()
+    gap : str
+        The gap column, e.g. 'gap_gender_recall'
+
+    Returns
+    ----------
+    pd.DataFrame
+        The rows of summary on the Pareto front
+    """
+    candidates = summary[summary['complete']]
+    candidates = candidates.assign(abs_gap=candidates[gap].abs()).sort_values(
+        ['abs_gap', 'accuracy'], ascending=[True, False])
+    # along increasing gaps, keep strictly increasing accuracies
+    best = candidates['accuracy'].cummax().shift(fill_value=-np.inf)
+    return candidates[candidates['accuracy'] > best].drop(columns='abs_gap')
+
+
+@instrumented
+def fairness_sweep(dataframe, configurations, n_splits=5,
+                   protected=('gender', 'imd_band'), tolerance=0.01,
+                   min_folds=2, seed=0, n_jobs=-1):
+    """
+    Return the cross-validated accuracy and fairness gaps of model
+    configurations.
+
+    The folds are built once from the encoded dataframe and shared with the
+    processes (memory-mapped). Folds are evaluated one after the other for all
+    remaining configurations in parallel; after min_folds folds, the
+    configurations beaten by another one by more than tolerance on the mean
+    accuracy and on every mean gap are dropped.
+
+    Parameters
+    ----------
+    dataframe : pd.DataFrame
+        The encoded dataframe (see encode_variables() in 4_preprocessing.py)
+        with the 'final_result' target and the protected attributes
+    configurations : dict
+        The sklearn models (not fitted) by name, e.g.
+        {str(p): rf_model().set_params(**p) for p in ParameterGrid(grid)}
+    n_splits : int, default 5
+        The number of folds (stratified on the target)
+    protected : tuple, default ('gender', 'imd_band')
+        The protected attributes, not used for the prediction
+    tolerance : float, default 0.01
+        The margin of the domination used to drop configurations
+    min_folds : int, default 2
+        The number of folds evaluated before dropping configurations
+    seed : int, default 0
+        The seed of the folds
+    n_jobs : int, default -1
+        The number of processes (joblib convention)
+
+    Returns
+    ----------
+    results : pd.DataFrame
+        The scores of each evaluated (configuration, fold)
+    summary : pd.DataFrame
+        The mean scores of each configuration, its number of evaluated folds,
+        whether it was evaluated on all folds ('complete') and whether it is on
+        the Pareto front of accuracy against each gap ('pareto_<gap>')
+    """
+    from joblib import Parallel, delayed
+    from sklearn.model_selection import StratifiedKFold
+
+    protected = list(protected)
+    X = dataframe.drop(columns=['final_result'] + protected).to_numpy()
+    y = dataframe['final_result'].to_numpy()
+    groups = dataframe[protected].to_numpy()
+    folds = list(StratifiedKFold(n_splits, shuffle=True,
+                                 random_state=seed).split(X, y))
+
+    n_workers, configurations = limit_threads(configurations,
+                                              len(configurations), n_jobs)
+    remaining = list(configurations)
+    rows = []
+    with Parallel(n_jobs=n_workers, max_nbytes='1M',
+                  mmap_mode='r') as parallel:
+        for fold, (train_, test) in enumerate(folds):
+            scores = parallel(
+                delayed(fold_scores)(X, y, groups, protected, train_, test,
+                                     configurations[name])
+                for name in remaining)
+            rows += [dict(configuration=name, fold=fold, **score)
+                     for name, score in zip(remaining, scores)]
+            if fold + 1 >= min_folds and fold + 1 < n_splits:
+                means = pd.DataFrame(rows).groupby('configuration').mean()
+                means = means.drop(columns='fold').loc[remaining]
+                remaining = list(means.index[~dominated(means, tolerance)])
+
+    results = pd.DataFrame(rows)
+    summary = results.drop(columns='fold').groupby('configuration',
+                                                   sort=False).mean()
+    summary.insert(0, 'n_folds', results.groupby('configuration',
+                                                 sort=False).size())
+    summary.insert(1, 'complete', summary['n_folds'] == n_splits)
+    for gap in [column for column in summary.columns
+                if column.startswith('gap_')]:
+        summary['pareto_' + gap] = summary.index.isin(
+            pareto_front(summary, gap).index)
+    return results, summary
+
+
+###############################################################################
+@instrumented
+def group_threshold_curves(Y, Yproba, groups):
+    """
+    Return, for each group of each protected attribute, the metrics obtained
+    by predicting success when the probability of success is at least t, for
+    every distinct probability t of the group, and for t = inf (predicting
+    no success, the end point of every curve).
+
+    The probabilities are sorted once per attribute (by group, then by
+    decreasing probability) and the confusion counts of all thresholds are
+    cumulative sums, i.e. O(n log n) per attribute.
+
+    Parameters
+    ----------
+    Y : array-like
+        The true labels (0 or 1)
+    Yproba : np.array of shape (n_instances, n_classes) or (n_instances,)
+        The output of pred_proba() or the probabilities of success
+    groups : pd.DataFrame or pd.Series
+        The protected attribute(s) of each instance, in the order of Y
+
+    Returns
+    ----------
+    pd.DataFrame
+        One row per (attribute, group, threshold) with tpr (recall), fpr,
+        precision, positive_rate (demographic parity) and accuracy; the first
+        rows are the curves of all instances
+    """
+    if isinstance(groups, pd.Series):
+        groups = groups.to_frame()
+    Yproba = np.asarray(Yproba)
+    score = Yproba[:, 1] if Yproba.ndim == 2 else Yproba
+    Y = np.asarray(Y).astype(np.int64)
+
+    tables = []
+    for attribute in ['all'] + list(groups.columns):
+        if attribute == 'all':
+            codes, uniques = np.zeros(len(Y), dtype=np.int64), ['all']
+        else:
+            codes, uniques = pd.factorize(groups[attribute], sort=True)
+        kept = np.flatnonzero(codes >= 0)
+        order = kept[np.lexsort((-score[kept], codes[kept]))]
+        code, proba, label = codes[order], score[order], Y[order]
+
+        # counts of each group and position of its first instance
+        size = np.bincount(code, minlength=len(uniques))
+        positives = np.bincount(code, weights=label, minlength=len(uniques))
+        start = np.concatenate(([0], np.cumsum(size)[:-1]))
+        cum_label = np.cumsum(label)
+        before = np.concatenate(([0], cum_label))[start]
+        # last instance of each distinct (group, probability)
+        last = np.flatnonzero(np.append((code[1:] != code[:-1]) |
+                                        (proba[1:] != proba[:-1]), True))
+        # preceded by the end point (no prediction) of each group
+        g = np.concatenate((np.arange(len(uniques)), code[last]))
+        threshold = np.concatenate((np.full(len(uniques), np.inf),
+                                    proba[last]))
+        predicted = np.concatenate((np.zeros(len(uniques), dtype=np.int64),
+                                    last + 1 - start[code[last]]))
+        tp = np.concatenate((np.zeros(len(uniques)),
+                             cum_label[last] - before[code[last]]))
+        # by group, then by decreasing threshold
+        order = np.lexsort((-threshold, g))
+        g, threshold = g[order], threshold[order]
+        predicted, tp = predicted[order], tp[order]
+        fp = predicted - tp
+        n, P = size[g], positives[g]
+        N = n - P
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tables.append(pd.DataFrame({
+                'attribute': attribute,
+                'group': np.asarray(uniques, dtype=object)[g],
+                'threshold': threshold,
+                'tpr': tp / P,
+                'fpr': fp / N,
+                'precision': tp / predicted,
+                'positive_rate': predicted / n,
+                'accuracy': (tp + N - fp) / n}))
+    return pd.concat(tables, ignore_index=True)
+
+
+@instrumented
+def parity_thresholds(curves, attribute, metric='positive_rate', target=None):
+    """
+    Return, for each group of a protected attribute, the threshold whose
+    metric is the closest to a common target (e.g. the same positive rate for
+    demographic parity, the same tpr for equality of opportunity).
+
+    Parameters
+    ----------
+    curves : pd.DataFrame
+        The output of group_threshold_curves()
+    attribute : str
+        The protected attribute
+    metric : str, default 'positive_rate'
+        The metric to equalize: 'tpr', 'fpr', 'precision', 'positive_rate'
+        or 'accuracy'
+    target : float, optional
+        The target value (by default, the metric of all instances at the
+        operating point of predict(): success when the probability of success
+        is > 0.5)
+
+    Returns
+    ----------
+    pd.DataFrame
+        The row of curves chosen for each group (the most accurate one among
+        equally close thresholds)
+
+    Raises
+    ------
+    ValueError
+        If metric is not a column of curves
+    """
+    names = ['tpr', 'fpr', 'precision', 'positive_rate', 'accuracy']
+    if metric not in names:
+        raise ValueError("metric argument must be included in:"
+                         " {}".format(', '.join(names)))
+    if target is None:
+        # smallest threshold above 0.5, the end point (inf) when no
+        # probability is above 0.5
+        overall = curves[(curves['attribute'] == 'all') &
+                         (curves['threshold'] > 0.5)]
+        target = overall.loc[overall['threshold'].idxmin(), metric]
+    candidates = curves[curves['attribute'] == attribute]
+    candidates = candidates.assign(distance=(candidates[metric] -
+                                             target).abs())
+    chosen = candidates.sort_values(['distance', 'accuracy'],
+                                    ascending=[True, False]).groupby(
+        'group', sort=True).head(1)
+    return chosen.sort_values('group').drop(columns='distance')
+
+
 # formulas
 # from sklearn.metrics import confusion_matrix
 # tn, fp, fn, tp = confusion_matrix(y_test, pred).ravel()
@@ -88,6 +1231,7 @@ def demog_parity_per_group(ind_group, Y, Ypred):
 ###############################################################################
 
 
+@instrumented
 def predicted_proba_success(Ytest, Yproba):
     """
     Return the predicted probabilites of success (1) with the
@@ -141,8 +1285,49 @@ def group_outcome_predicted_proba_success(ind_group, ind_outcome, df_pps):
     list
         The filtered probabilities of success
     """
-    group_proba = []
-    for i in range(len(df_pps)):
-        if (df_pps.loc[i, "ind"] in ind_group) and (df_pps.loc[i, "ind"] in ind_outcome):
-            group_proba.append(df_pps.loc[i, "proba_success"])
-    return group_proba
+    ind = df_pps["ind"]
+    kept = ind.isin(ind_group) & ind.isin(ind_outcome)
+    return list(df_pps.loc[kept, "proba_success"])
+
+
+@instrumented
+def group_outcome_probas(df_pps, groups, outcomes):
+    """
+    Return the predicted probabilites of success (1) of every combination of
+    group and true outcome at once.
+
+    Parameters
+    ----------
+    df_pps : pd.DataFrame
+        The 2-column dataframe (indices, probabilities of success) returned by
+        predicted_proba_success()
+    groups : pd.Series
+        The group of each test instance, indexed by instance indices (e.g.
+        X_test['gender'])
+    outcomes : pd.Series
+        The true outcome of each test instance, indexed by instance indices
+        (e.g. y_test)
+
+    Returns
+    ----------
+    dict
+        The np.array of probabilities of success per (group, outcome)
+    """
+    ind = df_pps["ind"]
+    group_codes, group_values = pd.factorize(groups.reindex(ind), sort=True)
+    outcome_codes, outcome_values = pd.factorize(outcomes.reindex(ind),
+                                                 sort=True)
+    n_outcomes = len(outcome_values)
+    codes = group_codes * n_outcomes + outcome_codes
+    codes[(group_codes == -1) | (outcome_codes == -1)] = -1
+
+    # sort the probabilities by combination once and cut the sorted array
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes[codes >= 0],
+                         minlength=len(group_values) * n_outcomes)
+    n_left_out = len(codes) - counts.sum()
+    probas = np.split(df_pps["proba_success"].to_numpy()[order[n_left_out:]],
+                      np.cumsum(counts)[:-1])
+    return {(group, outcome): probas[i * n_outcomes + j]
+            for i, group in enumerate(group_values)
+            for j, outcome in enumerate(outcome_values)}
@@ -0,0 +1,271 @@
+"""
+Command-line pipeline of the experiment (instead of running the notebook):
+
+    load -> stats ----------------------------------------> report
+         -> prepare -> encode -> split -> train -> evaluate -^
+                                               -> export
+
+Each stage output is stored in the cache directory under a key computed
+from its parameters, the code of its script and the keys of its inputs, so
+that only the stages whose inputs changed are run again (e.g. changing the
+model only runs train, evaluate and report).
+
+Usage:
+    python 6_pipeline.py --data-path DIR [--n-estimators 100] [--seed 0] ...
+
+Functions:
+    run_pipeline()
+    main()
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import pickle
+import time
+
+import instrument
+from oulad import HERE, load_script
+
+logger = logging.getLogger('pipeline')
+
+
+###############################################################################
+def stage_load(params):
+    data = load_script('2_script.py')
+    if params['data_path'] is not None:
+        data.DATA_PATH = os.path.join(params['data_path'], '')
+        data.CACHE_PATH = data.DATA_PATH + 'cache/'
+    return data.read_data('studentInfo.csv')
+
+
+def stage_stats(params, data):
+    return load_script('3_basic_statistics.py').count_cube(data)
+
+
+def stage_prepare(params, data):
+    preprocessing = load_script('4_preprocessing.py')
+    dataframe = preprocessing.prepare_dataset(data)
+    dataframe = preprocessing.add_protected_gender(dataframe)
+    dataframe = preprocessing.add_protected_imd(dataframe)
+    return preprocessing.filter_final_result(dataframe)
+
+
+def stage_encode(params, dataframe):
+    return load_script('4_preprocessing.py').encode_variables(dataframe)
+
+
+def stage_split(params, dataframe):
+    return load_script('4_preprocessing.py').split(
+        dataframe, params['test_size'], random_state=params['seed'])
+
+
+def stage_train(params, split):
+    prediction = load_script('5_prediction.py')
+    X_train, _, y_train, _ = split
+    model = prediction.rf_model(random_state=params['seed'],
+                                n_jobs=params['n_jobs'])
+    model.set_params(n_estimators=params['n_estimators'],
+                     max_depth=params['max_depth'])
+    return prediction.train(model, X_train.drop(columns=protected), y_train)
+
+
+def stage_evaluate(params, model, split):
+    prediction = load_script('5_prediction.py')
+    _, X_test, _, y_test = split
+    Ypred = prediction.pred(model, X_test.drop(columns=protected))
+    return prediction.group_metrics(y_test, Ypred, X_test[protected])
+
+
+def stage_report(params, cube, metrics):
+    statistics = load_script('3_basic_statistics.py')
+    output = params['output']
+    charts = statistics.render_report(cube, output, n_jobs=params['n_jobs'])
+    with open(os.path.join(output, 'metrics.md'), 'w') as f:
+        f.write(metrics.to_markdown(index=False))
+    return charts
+
+
+def stage_export(params, model, split):
+    preprocessing = load_script('4_preprocessing.py')
+    X_train = split[0].drop(columns=protected)
+    encoder = preprocessing.VariableEncoder(
+        [column for column in preprocessing.encodings
+         if column in X_train]).fit(X_train)
+    path = os.path.join(params['output'], 'model')
+    load_script('5_prediction.py').save_model(path, model, encoder,
+                                              list(X_train.columns))
+    return path
+
+
+protected = ['gender', 'imd_band']
+
+# stage -> (function, scripts, parameters, input stages)
+stages = {
+    'load': (stage_load, ['2_script.py'], ['data_path'], []),
+    'stats': (stage_stats, ['3_basic_statistics.py', 'population.py',
+                            'engine.py'], [], ['load']),
+    'prepare': (stage_prepare, ['4_preprocessing.py', 'population.py',
+                                'engine.py', 'enrollment.py'], [], ['load']),
+    'encode': (stage_encode, ['4_preprocessing.py', 'engine.py'], [],
+               ['prepare']),
+    'split': (stage_split, ['4_preprocessing.py'], ['test_size', 'seed'],
+              ['encode']),
+    'train': (stage_train, ['5_prediction.py'],
+              ['seed', 'n_estimators', 'max_depth'], ['split']),
+    'evaluate': (stage_evaluate, ['5_prediction.py'], [],
+                 ['train', 'split']),
+    'report': (stage_report, ['3_basic_statistics.py'], ['output'],
+               ['stats', 'evaluate']),
+    'export': (stage_export, ['5_prediction.py'], ['output'],
+               ['train', 'split']),
+}
+
+# stages always run (their outputs are files outside the cache)
+uncached = ['report', 'export']
+
+defaults = {'data_path': None, 'test_size': 0.3, 'seed': 0,
+            'n_estimators': 100, 'max_depth': None, 'output': 'report',
+            'n_jobs': None}
+
+
+###############################################################################
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def data_fingerprint(params):
+    # size and modification time of the zip archive of the loaded table
+    data = load_script('2_script.py')
+    data_path = params['data_path']
+    path = (os.path.join(os.path.expanduser(data_path), 'studentInfo.csv.zip')
+            if data_path is not None else data.zip_path('studentInfo.csv'))
+    stat = os.stat(path)
+    return (path, stat.st_size, stat.st_mtime_ns)
+
+
+def stage_keys(params):
+    """
+    Return the cache key of each stage.
+    """
+    keys = {}
+    for name, (_, files, names, inputs) in stages.items():
+        content = [name, [file_digest(os.path.join(HERE, f)) for f in files],
+                   [(p, params[p]) for p in names],
+                   [keys[stage] for stage in inputs]]
+        if name == 'load':
+            content.append(data_fingerprint(params))
+        keys[name] = hashlib.sha256(repr(content).encode()).hexdigest()[:16]
+    return keys
+
+
+def run_pipeline(params=None, targets=None, cache_dir='.pipeline', force=()):
+    """
+    Run the stages needed by targets, reusing the cached outputs of the
+    stages whose key did not change.
+
+    Parameters
+    ----------
+    params : dict, optional
+        The parameters (see defaults)
+    targets : list, optional
+        The stages to compute (all stages by default)
+    cache_dir : str, default '.pipeline'
+        The directory of the stage outputs
+    force : tuple, default ()
+        The stages to run even if their output is cached
+
+    Returns
+    ----------
+    dict
+        The outputs of the target stages
+
+    Raises
+    ------
+    ValueError
+        If a target or forced stage is not in stages
+    """
+    params = dict(defaults, **(params or {}))
+    targets = list(stages) if targets is None else list(targets)
+    for name in list(targets) + list(force):
+        if name not in stages:
+            raise ValueError("stages must be included in:"
+                             " {}".format(', '.join(stages)))
+    keys = stage_keys(params)
+    outputs = {}
+
+    def output(name):
+        if name in outputs:
+            return outputs[name]
+        function, _, _, inputs = stages[name]
+        path = os.path.join(cache_dir, name, keys[name] + '.pkl')
+        start = time.perf_counter()
+        if (name not in uncached and name not in force and
+                os.path.exists(path)):
+            with open(path, 'rb') as f:
+                outputs[name] = pickle.load(f)
+            logger.info('%-8s cached   %8.3fs  %s', name,
+                        time.perf_counter() - start, keys[name])
+            return outputs[name]
+        values = [output(stage) for stage in inputs]
+        start = time.perf_counter()
+        with instrument.stage('pipeline.' + name):
+            outputs[name] = function(params, *values)
+        logger.info('%-8s computed %8.3fs  %s', name,
+                    time.perf_counter() - start, keys[name])
+        if name not in uncached:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(outputs[name], f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        return outputs[name]
+
+    return {name: output(name) for name in targets}
+
+
+###############################################################################
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--data-path', help='directory of the zipped tables '
+                        '(DATA_PATH of 2_script.py by default)')
+    parser.add_argument('--test-size', type=float,
+                        default=defaults['test_size'])
+    parser.add_argument('--seed', type=int, default=defaults['seed'])
+    parser.add_argument('--n-estimators', type=int,
+                        default=defaults['n_estimators'])
+    parser.add_argument('--max-depth', type=int, default=defaults['max_depth'])
+    parser.add_argument('--n-jobs', type=int, default=defaults['n_jobs'])
+    parser.add_argument('--output', default=defaults['output'],
+                        help='directory of the report')
+    parser.add_argument('--cache-dir', default='.pipeline')
+    parser.add_argument('--force', nargs='*', default=[], choices=list(stages),
+                        help='stages to run even if cached')
+    parser.add_argument('--targets', nargs='*', choices=list(stages),
+                        help='stages to compute (all by default)')
+    parser.add_argument('--trace', metavar='FILE.jsonl',
+                        help='record the time and memory of the stages and '
+                        'of the functions they call as JSON lines')
+    parser.add_argument('--profile', metavar='STAGE',
+                        help='profile a stage or function with cProfile '
+                        '(e.g. pipeline.train or 4_preprocessing.split)')
+    parser.add_argument('--no-trace-memory', action='store_true',
+                        help='do not trace the memory allocations (which '
+                        'slows them down)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.trace or args.profile:
+        instrument.configure(args.trace or os.devnull, args.profile,
+                             os.path.join(args.cache_dir, 'profiles'),
+                             memory=not args.no_trace_memory)
+    params = {name: getattr(args, name) for name in defaults}
+    start = time.perf_counter()
+    run_pipeline(params, args.targets, args.cache_dir, args.force)
+    logger.info('total             %8.3fs', time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""
+Local scoring service of a model saved by save_model() (5_prediction.py):
+
+    POST /score   [{studentInfo record}, ...] -> {"proba_success": [...]}
+    GET  /stats   p50/p99 latency (ms) and throughput of the scored requests
+
+Concurrent requests are scored together: a batching thread collects the
+requests arriving within --max-wait-ms (up to --max-batch records) and calls
+predict_proba() once for all of them. The arrays of the model are
+memory-mapped, so several services started on the same model share one
+copy of the trees.
+
+Usage:
+    python 7_serving.py --model DIR [--port 8000] [--max-batch 256] ...
+    python 7_serving.py --model DIR --benchmark RECORDS.csv [--requests 2000]
+
+Functions:
+    Scorer
+    MicroBatcher
+    LatencyStats
+    serve()
+    benchmark()
+    main()
+"""
+
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+import numpy as np
+import pandas as pd
+
+from oulad import load_script
+
+logger = logging.getLogger('serving')
+
+
+###############################################################################
+class Scorer:
+    """
+    Probabilities of success of raw studentInfo records with a saved model.
+
+    Parameters
+    ----------
+    path : str
+        The directory of the model (see save_model() in 5_prediction.py)
+    mmap_mode : str or None, default 'r'
+        The mode of np.load() for the arrays of the model
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        prediction = load_script('5_prediction.py')
+        preprocessing = load_script('4_preprocessing.py')
+        self.model = prediction.load_model(path, mmap_mode=mmap_mode)
+        encoded = self.model.encoded
+        encoder = preprocessing.VariableEncoder(encoded).fit(
+            pd.DataFrame(columns=encoded))
+        # lookup tables of the encoder, to encode a few records without
+        # building a dataframe
+        self.lookups = {column: dict(zip(encoder.categories_[column],
+                                         encoder.codes_[column].tolist()))
+                        for column in encoded}
+        # success is the class encoded 1 (Pass)
+        self.success = list(self.model.classes_).index(1)
+
+    def features(self, records):
+        """
+        Return the feature matrix of records (list of dicts).
+
+        Raises
+        ------
+        ValueError
+            If a feature is missing or a categorical value has no encoding
+        """
+        features = self.model.features
+        X = np.empty((len(records), len(features)))
+        for i, record in enumerate(records):
+            for j, column in enumerate(features):
+                if column not in record:
+                    raise ValueError("missing column {}".format(column))
+                value = record[column]
+                lookup = self.lookups.get(column)
+                if lookup is not None:
+                    if value not in lookup:
+                        raise ValueError("missing or unseen value in column "
+                                         "{}: {}".format(column, value))
+                    value = lookup[value]
+                try:
+                    X[i, j] = value
+                except (TypeError, ValueError):
+                    raise ValueError("invalid value in column {}: {}"
+                                     .format(column, value))
+        return X
+
+    def __call__(self, X):
+        return self.model.predict_proba(X)[:, self.success]
+
+
+class MicroBatcher:
+    """
+    Score the feature matrices submitted by concurrent threads in batches.
+
+    Parameters
+    ----------
+    score : callable
+        The function returning one value per row of a feature matrix
+    max_batch : int, default 256
+        The maximum number of rows of a batch (a larger request is scored
+        alone)
+    max_wait : float, default 0.002
+        The time (s) to wait for other requests after the first one of a
+        batch
+    """
+
+    def __init__(self, score, max_batch=256, max_wait=0.002):
+        self.score = score
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, X):
+        """
+        Return a Future of the scores of the rows of X.
+        """
+        future = Future()
+        self.requests.put((X, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:
+                    request = (self.requests.get(timeout=timeout)
+                               if timeout > 0 else self.requests.get_nowait())
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self.batches += 1
+            try:
+                scores = self.score(np.concatenate([X for X, _ in batch]))
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            start = 0
+            for X, future in batch:
+                future.set_result(scores[start:start + len(X)])
+                start += len(X)
+
+
+class LatencyStats:
+    """
+    Latencies of the last requests (at most size) and throughput since the
+    start (or the last reset).
+    """
+
+    def __init__(self, size=100000):
+        self.latencies = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies.clear()
+            self.requests = 0
+            self.records = 0
+            self.start = time.perf_counter()
+
+    def add(self, latency, records):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+            self.records += records
+
+    def summary(self):
+        """
+        Return the number of requests and records, the p50 and p99 latencies
+        (ms) and the throughput (requests and records per second).
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            elapsed = time.perf_counter() - self.start
+            requests, records = self.requests, self.records
+        p50, p99 = (np.percentile(latencies, [50, 99]) * 1000
+                    if len(latencies) else (np.nan, np.nan))
+        return {'requests': requests, 'records': records,
+                'p50_ms': round(float(p50), 3), 'p99_ms': round(float(p99), 3),
+                'requests_per_s': round(requests / elapsed, 1),
+                'records_per_s': round(records / elapsed, 1)}
+
+
+###############################################################################
+class ScoringServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default (5) makes the clients of bursts of requests wait for a
+    # retry of their connection
+    request_queue_size = 1024
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    # set by serve(): scorer, batcher and stats
+    server_version = 'OULADScoring/1.0'
+
+    def reply(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            stats = dict(self.server.stats.summary(),
+                         batches=self.server.batcher.batches)
+            self.reply(200, stats)
+        elif self.path == '/health':
+            self.reply(200, {'status': 'ok'})
+        else:
+            self.reply(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self.reply(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            records = json.loads(self.rfile.read(length))
+            if isinstance(records, dict):
+                records = records.get('records')
+            if (not isinstance(records, list) or not records or
+                    not all(isinstance(record, dict) for record in records)):
+                raise ValueError("the body must be a non-empty list of "
+                                 "records (objects)")
+            X = self.server.scorer.features(records)
+        except ValueError as error:
+            self.reply(400, {'error': str(error)})
+            return
+        scores = self.server.batcher.submit(X).result()
+        self.server.stats.add(time.perf_counter() - start, len(X))
+        self.reply(200, {'proba_success': scores.tolist()})
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(path, host='127.0.0.1', port=8000, max_batch=256, max_wait=0.002):
+    """
+    Return the (not yet started) HTTP scoring server of a saved model.
+
+    Parameters
+    ----------
+    path : str
+        The directory of the model
+    host : str, default '127.0.0.1'
+    port : int, default 8000
+        The port (0 for any free port)
+    max_batch : int, default 256
+        The maximum number of records scored at once
+    max_wait : float, default 0.002
+        The time (s) a batch waits for other requests
+
+    Returns
+    ----------
+    ScoringServer
+        The server (server.serve_forever() to start it)
+    """
+    server = ScoringServer((host, port), ScoringHandler)
+    server.scorer = Scorer(path)
+    server.batcher = MicroBatcher(server.scorer, max_batch, max_wait)
+    server.stats = LatencyStats()
+    return server
+
+
+###############################################################################
+def benchmark(url, records, n_requests=1000, batch_size=1, concurrency=16):
+    """
+    Send n_requests requests of batch_size records to a running service from
+    concurrency threads.
+
+    Parameters
+    ----------
+    url : str
+        The address of the service (e.g. 'http://127.0.0.1:8000')
+    records : list
+        The records to send (cycled)
+    n_requests : int, default 1000
+    batch_size : int, default 1
+        The number of records per request
+    concurrency : int, default 16
+        The number of concurrent clients
+
+    Returns
+    ----------
+    dict
+        The client-side latencies and throughput (see LatencyStats)
+    """
+    stats = LatencyStats()
+    bodies = [json.dumps([records[(i * batch_size + j) % len(records)]
+                          for j in range(batch_size)]).encode()
+              for i in range(min(n_requests, len(records)))]
+
+    def send(i):
+        start = time.perf_counter()
+        request = Request(url + '/score', data=bodies[i % len(bodies)],
+                          headers={'Content-Type': 'application/json'})
+        with urlopen(request) as response:
+            response.read()
+        stats.add(time.perf_counter() - start, batch_size)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(send, range(n_requests)))
+    return stats.summary()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--model', required=True,
+                        help='directory of the model (see save_model())')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    parser.add_argument('--benchmark', metavar='RECORDS.csv',
+                        help='score these studentInfo records against a '
+                        'local service and print the latencies')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    server = serve(args.model, args.host,
+                   0 if args.benchmark else args.port,
+                   args.max_batch, args.max_wait_ms / 1000)
+    if args.benchmark:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        records = pd.read_csv(args.benchmark).to_dict(orient='records')
+        url = 'http://{}:{}'.format(*server.server_address)
+        client = benchmark(url, records, args.requests, args.batch_size,
+                           args.concurrency)
+        logger.info('client  %s', json.dumps(client))
+        logger.info('server  %s', json.dumps(
+            dict(server.stats.summary(), batches=server.batcher.batches)))
+        server.shutdown()
+        return
+    logger.info('scoring on http://%s:%d', *server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logger.info('%s', json.dumps(server.stats.summary()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,427 @@
+"""
+Synthetic versions of the seven OULAD tables, written as the zipped csv
+files read by 2_script.py (same columns, dtypes, categories and missing
+values, approximate marginals of the original dataset), at any scale of the
+number of enrollments and of their rows (the module presentations, their
+assessments and VLE sites do not scale).
+
+Usage:
+    python 8_synthetic.py OUTPUT_DIR [--scale 1] [--seed 0]
+
+Functions:
+    generate()
+    main()
+"""
+
+import argparse
+import io
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from oulad import load_script
+
+data = load_script('2_script.py')
+
+# rows of studentInfo.csv at scale 1 (32,593 in OULAD)
+base_enrollments = 32593
+
+# module presentations of OULAD and their length (days)
+courses = [('AAA', '2013J', 268), ('AAA', '2014J', 269),
+           ('BBB', '2013B', 240), ('BBB', '2013J', 268),
+           ('BBB', '2014B', 234), ('BBB', '2014J', 262),
+           ('CCC', '2014B', 241), ('CCC', '2014J', 269),
+           ('DDD', '2013B', 240), ('DDD', '2013J', 261),
+           ('DDD', '2014B', 241), ('DDD', '2014J', 262),
+           ('EEE', '2013J', 268), ('EEE', '2014B', 241),
+           ('EEE', '2014J', 269), ('FFF', '2013B', 240),
+           ('FFF', '2013J', 268), ('FFF', '2014B', 241),
+           ('FFF', '2014J', 269), ('GGG', '2013J', 261),
+           ('GGG', '2014B', 241), ('GGG', '2014J', 269)]
+
+# assessments per module: (TMA, CMA), and one exam
+module_assessments = {'AAA': (5, 0), 'BBB': (5, 6), 'CCC': (4, 4),
+                      'DDD': (6, 0), 'EEE': (4, 0), 'FFF': (5, 7),
+                      'GGG': (3, 6)}
+
+# marker of the missing values of each table in OULAD (left empty otherwise)
+missing_markers = {'studentAssessment.csv': '?'}
+
+# proportions of the categories in OULAD
+marginals = {
+    'gender': {'M': 0.548, 'F': 0.452},
+    'region': {'Scotland': 0.108, 'East Anglian Region': 0.104,
+               'London Region': 0.099, 'South Region': 0.096,
+               'North Western Region': 0.088, 'West Midlands Region': 0.078,
+               'South West Region': 0.074, 'East Midlands Region': 0.072,
+               'South East Region': 0.066, 'Wales': 0.064,
+               'Yorkshire Region': 0.063, 'North Region': 0.055,
+               'Ireland': 0.033},
+    'highest_education': {'A Level or Equivalent': 0.430,
+                          'Lower Than A Level': 0.404,
+                          'HE Qualification': 0.145,
+                          'No Formal quals': 0.011,
+                          'Post Graduate Qualification': 0.010},
+    'age_band': {'0-35': 0.704, '35-55': 0.289, '55<=': 0.007},
+    'disability': {'N': 0.903, 'Y': 0.097},
+    'num_of_prev_attempts': {0: 0.872, 1: 0.111, 2: 0.014, 3: 0.003},
+    'studied_credits': {60: 0.52, 120: 0.21, 30: 0.12, 90: 0.08,
+                        75: 0.03, 150: 0.02, 180: 0.02},
+    'final_result': {'Pass': 0.379, 'Withdrawn': 0.312, 'Fail': 0.216,
+                     'Distinction': 0.093},
+    # VLE sites and share of the clicks of each activity type
+    'activity_type': {'resource': 0.42, 'subpage': 0.17, 'oucontent': 0.16,
+                      'url': 0.14, 'forumng': 0.03, 'quiz': 0.02,
+                      'page': 0.016, 'oucollaborate': 0.013,
+                      'questionnaire': 0.01, 'ouelluminate': 0.009,
+                      'ouwiki': 0.008, 'glossary': 0.005, 'dataplus': 0.004,
+                      'externalquiz': 0.004, 'homepage': 0.0035,
+                      'dualpane': 0.003, 'repeatactivity': 0.001,
+                      'folder': 0.001, 'htmlactivity': 0.0005,
+                      'sharedsubpage': 0.0005},
+    'clicks': {'homepage': 0.19, 'forumng': 0.18, 'oucontent': 0.17,
+               'subpage': 0.11, 'resource': 0.05, 'quiz': 0.12, 'url': 0.04,
+               'ouwiki': 0.03, 'oucollaborate': 0.01, 'page': 0.01,
+               'questionnaire': 0.01, 'externalquiz': 0.01,
+               'ouelluminate': 0.005, 'glossary': 0.005, 'dataplus': 0.005,
+               'dualpane': 0.005, 'repeatactivity': 0.002, 'folder': 0.002,
+               'htmlactivity': 0.002, 'sharedsubpage': 0.002},
+}
+
+# effect of the profile of a student on each final result, and mean number
+# of rows of studentVle.csv per enrollment with each final result
+result_effect = {'Pass': 0.5, 'Withdrawn': -0.5, 'Fail': -0.3,
+                 'Distinction': 1.0}
+vle_rows = {'Pass': 460, 'Withdrawn': 110, 'Fail': 250, 'Distinction': 700}
+
+SITES_PER_COURSE = 289
+
+
+###############################################################################
+def choice(rng, distribution, size):
+    values = list(distribution)
+    p = np.array(list(distribution.values()), dtype='float64')
+    return np.array(values, dtype=object)[
+        rng.choice(len(values), size=size, p=p / p.sum())]
+
+
+def check_categories(table, file_name):
+    # the values must be the categories declared by schemas in 2_script.py
+    for column, dtype in data.schemas[file_name].items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            unknown = (set(pd.unique(table[column].dropna())) -
+                       set(dtype.categories))
+            if unknown:
+                raise ValueError("undeclared categories in {} {}: {}".format(
+                    file_name, column, ', '.join(map(str, unknown))))
+
+
+def course_table():
+    table = pd.DataFrame(courses, columns=['code_module', 'code_presentation',
+                                           'module_presentation_length'])
+    check_categories(table, 'courses.csv')
+    return table
+
+
+def assessment_table():
+    rows = []
+    id_assessment = 1752
+    for code_module, code_presentation, length in courses:
+        n_tma, n_cma = module_assessments[code_module]
+        n = n_tma + n_cma
+        dates = np.linspace(length / (n + 1), length - 20, n).round()
+        # the TMAs weigh 100 in total (the CMAs too when there is no TMA)
+        weights = ([100 / n_tma] * n_tma if n_tma else []) + (
+            [0.0] * n_cma if n_tma else [100 / n_cma] * n_cma)
+        kinds = ['TMA'] * n_tma + ['CMA'] * n_cma
+        order = np.argsort(np.r_[np.arange(n_tma) * 2,
+                                 np.arange(n_cma) * 2 + 1], kind='stable')
+        for date, kind, weight in zip(dates, np.array(kinds)[order],
+                                      np.array(weights)[order]):
+            rows.append((code_module, code_presentation, id_assessment, kind,
+                         int(date), round(float(weight), 1)))
+            id_assessment += 1
+        rows.append((code_module, code_presentation, id_assessment, 'Exam',
+                     np.nan, 100.0))
+        id_assessment += 1
+    table = pd.DataFrame(rows, columns=['code_module', 'code_presentation',
+                                        'id_assessment', 'assessment_type',
+                                        'date', 'weight'])
+    table['date'] = table['date'].astype('Int16')
+    check_categories(table, 'assessments.csv')
+    return table
+
+
+def vle_table(rng):
+    n = len(courses) * SITES_PER_COURSE
+    course = np.repeat(np.arange(len(courses)), SITES_PER_COURSE)
+    table = pd.DataFrame({
+        'id_site': 526721 + np.arange(n),
+        'code_module': [courses[c][0] for c in course],
+        'code_presentation': [courses[c][1] for c in course],
+        'activity_type': choice(rng, marginals['activity_type'], n)})
+    # weeks planned for 18% of the sites
+    planned = rng.random(n) < 0.18
+    week = rng.integers(1, 38, n)
+    table['week_from'] = pd.array(np.where(planned, week, 0), dtype='Int16')
+    table['week_to'] = pd.array(np.where(planned, week + rng.integers(0, 2, n),
+                                         0), dtype='Int16')
+    table.loc[~planned, ['week_from', 'week_to']] = pd.NA
+    check_categories(table, 'vle.csv')
+    return table
+
+
+def student_tables(rng, n):
+    # 88% of the enrollments are the first one of a student, the others
+    # re-enroll a student in another module presentation
+    n_students = int(round(n * 0.88))
+    # distinct ids drawn without building the range of the candidates (the
+    # draw of a small sample of a large range only keeps the sample)
+    ids = (rng.choice(100 * n, size=n_students, replace=False) +
+           6516).astype('int32')
+    first = rng.integers(0, len(courses), n_students)
+    again = rng.choice(n_students, size=n - n_students, replace=False)
+    student = np.r_[np.arange(n_students), again]
+    course = np.r_[first, (first[again] + rng.integers(1, len(courses),
+                                                       len(again)))
+                   % len(courses)]
+
+    profile = {column: choice(rng, marginals[column], n_students)[student]
+               for column in ['gender', 'region', 'highest_education',
+                              'age_band', 'disability']}
+    imd = rng.integers(0, len(data.imd_bands), n_students)[student]
+    prev = choice(rng, marginals['num_of_prev_attempts'], n).astype(int)
+
+    # final result drawn with the OULAD proportions, shifted towards success
+    # for higher education, higher IMD and first attempts
+    education = pd.Index(data.educations).get_indexer(
+        profile['highest_education'])
+    z = (0.4 * (education - 1.6) + 0.6 * (imd - 4.5) / 4.5 - 0.5 * prev +
+         rng.normal(0, 0.5, n))
+    results = list(marginals['final_result'])
+    weights = np.array([marginals['final_result'][r] *
+                        np.exp(result_effect[r] * z) for r in results]).T
+    cumulative = np.cumsum(weights / weights.sum(axis=1, keepdims=True),
+                           axis=1)
+    result = np.array(results, dtype=object)[
+        (rng.random(n)[:, None] > cumulative).sum(axis=1).clip(0, 3)]
+
+    info = pd.DataFrame({
+        'code_module': [courses[c][0] for c in course],
+        'code_presentation': [courses[c][1] for c in course],
+        'id_student': ids[student], **profile,
+        'imd_band': np.array(data.imd_bands, dtype=object)[imd],
+        'num_of_prev_attempts': prev,
+        'studied_credits': choice(rng, marginals['studied_credits'], n)
+        .astype(int),
+        'final_result': result})
+    info = info[['code_module', 'code_presentation', 'id_student', 'gender',
+                 'region', 'highest_education', 'imd_band', 'age_band',
+                 'num_of_prev_attempts', 'studied_credits', 'disability',
+                 'final_result']]
+    info.loc[rng.random(n) < 0.034, 'imd_band'] = np.nan
+    check_categories(info, 'studentInfo.csv')
+
+    length = np.array([c[2] for c in courses])[course]
+    registration = pd.DataFrame({
+        'code_module': info['code_module'],
+        'code_presentation': info['code_presentation'],
+        'id_student': info['id_student'],
+        'date_registration': pd.array(
+            -np.minimum(rng.gamma(2.0, 35.0, n).round(), 322).astype(int),
+            dtype='Int16'),
+        'date_unregistration': pd.array(
+            rng.integers(-30, length), dtype='Int16')})
+    registration.loc[rng.random(n) < 0.0014, 'date_registration'] = pd.NA
+    registration.loc[result != 'Withdrawn', 'date_unregistration'] = pd.NA
+    return info, registration, course
+
+
+def student_assessment_table(rng, info, registration, course, assessments):
+    # assessments of each module presentation, in course order
+    assessments = assessments.assign(course=pd.MultiIndex.from_frame(
+        assessments[['code_module', 'code_presentation']].astype(str))
+        .map({(m, p): i for i, (m, p, _) in enumerate(courses)}))
+    by_course = [group for _, group in assessments.groupby('course')]
+    counts = np.array([len(group) for group in by_course])
+    n = len(info)
+
+    row = np.repeat(np.arange(n), counts[course])
+    position = np.arange(len(row)) - np.repeat(np.cumsum(counts[course]) -
+                                               counts[course], counts[course])
+    table = pd.concat(by_course).reset_index(drop=True)
+    start = np.r_[0, np.cumsum(counts)[:-1]]
+    assessment = table.iloc[start[course[row]] + position]
+
+    result = info['final_result'].to_numpy()[row]
+    kind = assessment['assessment_type'].to_numpy()
+    date = assessment['date'].to_numpy(dtype='float64', na_value=np.nan)
+    length = np.array([c[2] for c in courses])[course[row]]
+    date = np.where(np.isnan(date), length - 3, date)
+    unregistration = registration['date_unregistration'].to_numpy(
+        dtype='float64', na_value=np.inf)[row]
+
+    p_submit = pd.Series(result).map({'Pass': 0.93, 'Distinction': 0.97,
+                                      'Fail': 0.65, 'Withdrawn': 0.5})
+    submitted = ((rng.random(len(row)) < p_submit.to_numpy()) &
+                 (date < unregistration) &
+                 ((kind != 'Exam') | (result != 'Withdrawn')))
+    mean = pd.Series(result).map({'Pass': 74, 'Distinction': 90, 'Fail': 55,
+                                  'Withdrawn': 60}).to_numpy()
+    score = np.clip(rng.normal(mean, 14), 0, 100).round()
+    table = pd.DataFrame({
+        'id_assessment': assessment['id_assessment'].to_numpy(),
+        'id_student': info['id_student'].to_numpy()[row],
+        'date_submitted': (date + rng.normal(-2, 5, len(row)).round())
+        .astype(int),
+        'is_banked': (rng.random(len(row)) < 0.01).astype(int),
+        'score': pd.array(score, dtype='Int16')})[submitted]
+    table.loc[rng.random(len(table)) < 0.001, 'score'] = pd.NA
+    return table
+
+
+def student_vle_chunks(rng, info, registration, course, vle, chunk_size):
+    # sites of each module presentation and their share of the clicks
+    weight = (vle['activity_type'].map(marginals['clicks']).to_numpy() /
+              vle['activity_type'].map(marginals['activity_type']).to_numpy())
+    site_course = np.repeat(np.arange(len(courses)), SITES_PER_COURSE)
+    cumulative = np.zeros(len(vle))
+    for c in range(len(courses)):
+        in_course = site_course == c
+        cumulative[in_course] = c + np.cumsum(weight[in_course]) / weight[
+            in_course].sum()
+
+    n_rows = rng.poisson(info['final_result'].map(vle_rows).to_numpy())
+    length = np.array([c[2] for c in courses])[course]
+    end = registration['date_unregistration'].to_numpy(
+        dtype='float64', na_value=np.nan)
+    end = np.where(np.isnan(end), length, np.clip(end, -9, length))
+    start = registration['date_registration'].to_numpy(
+        dtype='float64', na_value=-25.0).clip(-25, 0)
+
+    # enrollments per chunk so that a chunk has about chunk_size rows
+    bounds = np.searchsorted(np.cumsum(n_rows),
+                             np.arange(chunk_size, n_rows.sum(), chunk_size))
+    for block in np.split(np.arange(len(info)), np.unique(bounds)):
+        if not len(block):
+            continue
+        row = np.repeat(block, n_rows[block])
+        site = np.searchsorted(cumulative,
+                               course[row] + rng.random(len(row)))
+        site = np.minimum(site, len(vle) - 1)
+        date = (start[row] + rng.random(len(row)) *
+                (end[row] - start[row] + 1)).astype(int)
+        yield pd.DataFrame({
+            'code_module': info['code_module'].to_numpy()[row],
+            'code_presentation': info['code_presentation'].to_numpy()[row],
+            'id_student': info['id_student'].to_numpy()[row],
+            'id_site': vle['id_site'].to_numpy()[site],
+            'date': date,
+            'sum_click': rng.geometric(0.27, len(row))})
+
+
+def write_table(output_dir, file_name, chunks):
+    # streamed into the zip archive (zip64 for the largest tables), with the
+    # fastest compression level (level 6 takes as long as writing the csv)
+    path = os.path.join(output_dir, file_name + '.zip')
+    tmp = path + '.tmp'
+    rows = 0
+    with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED,
+                         compresslevel=1) as zf:
+        with zf.open(file_name, 'w', force_zip64=True) as raw:
+            with io.TextIOWrapper(raw, encoding='utf-8', newline='') as f:
+                for i, chunk in enumerate(chunks):
+                    if i == 0:
+                        f.write(','.join(chunk.columns) + '\n')
+                    write_csv(chunk, f, missing_markers.get(file_name, ''))
+                    rows += len(chunk)
+    os.replace(tmp, path)
+    return rows
+
+
+def write_csv(chunk, f, na_rep):
+    # pyarrow writes a chunk without missing values ~10 times faster
+    if data.pyarrow_available() and not chunk.isna().any().any():
+        import pyarrow
+        import pyarrow.csv
+
+        f.flush()
+        pyarrow.csv.write_csv(
+            pyarrow.Table.from_pandas(chunk, preserve_index=False),
+            f.buffer, pyarrow.csv.WriteOptions(include_header=False,
+                                               quoting_style='none'))
+    else:
+        chunk.to_csv(f, header=False, index=False, na_rep=na_rep,
+                     lineterminator='\n')
+
+
+def generate(output_dir, scale=1.0, seed=0, chunk_size=1000000):
+    """
+    Write synthetic zipped csv files of the seven OULAD tables.
+
+    Parameters
+    ----------
+    output_dir : str
+        The directory of the files (created if needed), to use as DATA_PATH
+    scale : float, default 1.0
+        The number of enrollments (and of their rows) relative to OULAD
+    seed : int, default 0
+        The seed of the random generator
+    chunk_size : int, default 1000000
+        The number of rows of studentVle.csv generated at once
+
+    Returns
+    ----------
+    dict
+        The number of rows of each file
+
+    Raises
+    ------
+    ValueError
+        If scale is not positive
+    """
+    if scale <= 0:
+        raise ValueError("scale must be positive")
+    output_dir = os.path.expanduser(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n = max(int(round(base_enrollments * scale)), 2 * len(courses))
+
+    course = course_table()
+    assessments = assessment_table()
+    vle = vle_table(rng)
+    info, registration, enrolled = student_tables(rng, n)
+    student_assessment = student_assessment_table(rng, info, registration,
+                                                  enrolled, assessments)
+    rows = {}
+    for file_name, table in [('courses.csv', course),
+                             ('assessments.csv', assessments),
+                             ('vle.csv', vle),
+                             ('studentInfo.csv', info),
+                             ('studentRegistration.csv', registration),
+                             ('studentAssessment.csv', student_assessment)]:
+        rows[file_name] = write_table(output_dir, file_name, [table])
+    rows['studentVle.csv'] = write_table(
+        output_dir, 'studentVle.csv',
+        student_vle_chunks(rng, info, registration, enrolled, vle,
+                           chunk_size))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('output_dir')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='number of enrollments relative to OULAD '
+                        '(e.g. 1, 10, 100)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    for file_name, n in generate(args.output_dir, args.scale,
+                                 args.seed).items():
+        print('{:<26}{:>12,}'.format(file_name, n))
+
+
+if __name__ == '__main__':
+    main()
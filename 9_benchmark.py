@@ -0,0 +1,405 @@
+"""
+Benchmark of the public functions of 2_script.py to 5_prediction.py on
+synthetic data (see 8_synthetic.py): the wall time (best of --repeat runs)
+and the peak memory allocated (tracemalloc) of each function, stored as JSON
+and compared to a saved baseline.
+
+Usage:
+    python 9_benchmark.py --data-dir DIR [--scale 1] [--output results.json]
+    python 9_benchmark.py --data-dir DIR --baseline baseline.json
+
+The data is generated in --data-dir at --scale if it is not there yet. The
+exit code is 1 when a function is slower or allocates more memory than in
+the baseline by more than --threshold.
+
+Functions:
+    benchmark_cases()
+    run_benchmarks()
+    compare()
+    main()
+"""
+
+import argparse
+import contextlib
+import datetime
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from oulad import load_script
+
+
+###############################################################################
+def benchmark_cases(data_dir, work_dir):
+    """
+    Return the functions to time, each called without arguments on the data
+    of data_dir.
+
+    The inputs of the functions (tables, prepared datasets, a trained model)
+    are computed once, before the timings.
+
+    Parameters
+    ----------
+    data_dir : str
+        The directory of the zipped csv files
+    work_dir : str
+        A directory for the files written by the functions
+
+    Returns
+    ----------
+    dict
+        The function of each case name ('<script>.<function>[variant]')
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    data = load_script('2_script.py')
+    statistics = load_script('3_basic_statistics.py')
+    preprocessing = load_script('4_preprocessing.py')
+    prediction = load_script('5_prediction.py')
+    population = load_script('population.py')
+    clicks = load_script('clicks.py')
+
+    data.DATA_PATH = os.path.join(data_dir, '')
+    data.CACHE_PATH = os.path.join(work_dir, 'cache', '')
+    data.build_cache('studentInfo.csv')
+    data.build_cache('studentVle.csv')
+
+    info = data.read_data('studentInfo.csv')
+    courses = data.read_data('courses.csv')
+    tables = {name: data.read_data(name + '.csv') for name in
+              ['studentRegistration', 'studentAssessment', 'assessments']}
+    protected = ['gender', 'imd_band']
+    raw = preprocessing.prepare_dataset(info)
+    prepared = preprocessing.add_protected_imd(
+        preprocessing.add_protected_gender(raw))
+    filtered = preprocessing.filter_final_result(prepared)
+    encoded = preprocessing.encode_variables(filtered)
+    X_train, X_test, y_train, y_test = preprocessing.split(encoded)
+    model = prediction.train(prediction.rf_model(n_jobs=1),
+                             X_train.drop(columns=protected), y_train)
+    features = X_test.drop(columns=protected)
+    Ypred = prediction.pred(model, features)
+    Yproba = prediction.pred_proba(model, features)
+    groups = X_test[protected]
+    ind_group = X_test.index[X_test['gender'] == 1]
+    encoder = preprocessing.VariableEncoder(
+        [column for column in preprocessing.encodings
+         if column in features]).fit(features)
+    model_dir = os.path.join(work_dir, 'model')
+    forest = prediction.save_model(model_dir, model, encoder,
+                                   list(features.columns))
+    enrollments = info.drop_duplicates(subset=data.enrollment)
+    enrolled = preprocessing.encode_variables(
+        preprocessing.filter_final_result(
+            enrollments[['num_of_prev_attempts', 'studied_credits',
+                         'disability', 'highest_education', 'age_band',
+                         'region', 'final_result']]))
+    matrix_path = os.path.join(work_dir, 'features.npy')
+    cube_dir = os.path.join(work_dir, 'clicks')
+    cube = data.build_click_cube(cube_dir)
+    cohort = enrollments[enrollments['code_module'] == 'BBB']
+    timeline = preprocessing.AssessmentTimeline(
+        tables['studentAssessment'], tables['assessments'], courses)
+    static = preprocessing.encode_variables(
+        preprocessing.filter_final_result(preprocessing.add_protected_imd(
+            preprocessing.add_protected_gender(enrollments[[
+                'gender', 'region', 'highest_education', 'imd_band',
+                'age_band', 'num_of_prev_attempts', 'studied_credits',
+                'disability', 'final_result']]))))
+    static_keys = enrollments.loc[static.index]
+    cutoffs = [14, 30, 60]
+
+    def fresh(function, *args, **kwargs):
+        # without the population memoized by a previous run
+        def run():
+            population.invalidate_population()
+            return function(*args, **kwargs)
+        return run
+
+    def quiet(function, *args, **kwargs):
+        # without printing the tables nor keeping the figures
+        def run():
+            population.invalidate_population()
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = function(*args, **kwargs)
+            plt.close('all')
+            return result
+        return run
+
+    def report():
+        output = tempfile.mkdtemp(dir=work_dir)
+        statistics.render_report(info, output, formats=('png',), n_jobs=1)
+        shutil.rmtree(output)
+
+    def feature_matrix():
+        return preprocessing.write_feature_matrix(
+            matrix_path, enrolled.drop(columns=['final_result']),
+            enrollments.loc[enrolled.index], courses,
+            data.stream_data('studentVle.csv'))
+
+    def incremental():
+        X, _ = preprocessing.write_feature_matrix(
+            matrix_path, enrolled.drop(columns=['final_result']),
+            enrollments.loc[enrolled.index], courses)
+        y = enrolled['final_result'].to_numpy()
+        rows, _ = preprocessing.split_rows(len(y))
+        return prediction.train_incremental(
+            prediction.incremental_model(), X, y, rows, n_epochs=1)
+
+    return {
+        '2_script.read_data[csv]': lambda: data.read_data('studentInfo.csv',
+                                                          cache=False),
+        '2_script.read_data[cache]': lambda: data.read_data('studentVle.csv'),
+        '2_script.stream_data': lambda: sum(
+            len(chunk) for chunk in data.stream_data('studentVle.csv')),
+        '2_script.aggregate_student_vle': data.aggregate_student_vle,
+        '2_script.load_all': data.load_all,
+        '2_script.build_click_cube': lambda: data.build_click_cube(cube_dir),
+        'clicks.load_cube': lambda: clicks.load_cube(cube_dir),
+        'clicks.ClickCube.range_sum': lambda: cube.range_sum(0, 30),
+        'clicks.ClickCube.range_sum[cohort]': lambda: cube.range_sum(
+            0, 30, rows=cohort),
+        'clicks.ClickCube.window_sums': lambda: cube.window_sums(0, 60),
+        'clicks.ClickCube.activity_mix': lambda: cube.activity_mix(None, 14),
+        '3_basic_statistics.dataset_population': fresh(
+            statistics.dataset_population, info),
+        '3_basic_statistics.count_cube': fresh(statistics.count_cube, info),
+        '3_basic_statistics.how_many': fresh(statistics.how_many,
+                                             'id_student', info),
+        '3_basic_statistics.ratio': quiet(statistics.ratio, 'region', info),
+        '3_basic_statistics.disability_per_gender': quiet(
+            statistics.disability_per_gender, info),
+        '3_basic_statistics.imd_per_region': quiet(statistics.imd_per_region,
+                                                   info),
+        '3_basic_statistics.ed_per_age': quiet(statistics.ed_per_age, info),
+        '3_basic_statistics.render_report': report,
+        '4_preprocessing.prepare_dataset': fresh(
+            preprocessing.prepare_dataset, info),
+        '4_preprocessing.prepare_enrollment_dataset': lambda: (
+            preprocessing.prepare_enrollment_dataset(
+                info, tables['studentRegistration'],
+                tables['studentAssessment'], tables['assessments'],
+                courses)),
+        '4_preprocessing.add_protected_gender': lambda: (
+            preprocessing.add_protected_gender(raw)),
+        '4_preprocessing.add_protected_imd': lambda: (
+            preprocessing.add_protected_imd(raw)),
+        '4_preprocessing.filter_final_result': lambda: (
+            preprocessing.filter_final_result(prepared)),
+        '4_preprocessing.encode_variables': lambda: (
+            preprocessing.encode_variables(filtered)),
+        '4_preprocessing.split': lambda: preprocessing.split(encoded),
+        '4_preprocessing.write_feature_matrix': feature_matrix,
+        '4_preprocessing.AssessmentTimeline': lambda: (
+            preprocessing.AssessmentTimeline(
+                tables['studentAssessment'], tables['assessments'], courses)),
+        '4_preprocessing.early_features': lambda: (
+            preprocessing.early_features(static, static_keys, courses, 30,
+                                         timeline, cube)),
+        '5_prediction.train': lambda: prediction.train(
+            prediction.rf_model(n_jobs=1), X_train.drop(columns=protected),
+            y_train),
+        '5_prediction.pred': lambda: prediction.pred(model, features),
+        '5_prediction.pred_proba': lambda: prediction.pred_proba(model,
+                                                                 features),
+        '5_prediction.FlatForest.predict_proba': lambda: (
+            forest.predict_proba(features.to_numpy())),
+        '5_prediction.load_model': lambda: prediction.load_model(model_dir),
+        '5_prediction.train_incremental': incremental,
+        '5_prediction.run_cutoffs': lambda: prediction.run_cutoffs(
+            {cutoff: preprocessing.early_features(
+                static, static_keys, courses, cutoff, timeline, cube)
+             for cutoff in cutoffs}, prediction.rf_model(n_jobs=1)),
+        '5_prediction.accuracy': lambda: prediction.accuracy(y_test, Ypred),
+        '5_prediction.metric_group': lambda: [
+            function(ind_group, y_test, Ypred) for function in
+            [prediction.accuracy_per_group, prediction.recall_per_group,
+             prediction.precision_per_group,
+             prediction.demog_parity_per_group]],
+        '5_prediction.group_metrics': lambda: prediction.group_metrics(
+            y_test, Ypred, groups),
+        '5_prediction.subgroup_audit': lambda: prediction.subgroup_audit(
+            y_test, Ypred, X_test[protected + ['age_band', 'disability']]),
+        '5_prediction.bootstrap_group_metrics': lambda: (
+            prediction.bootstrap_group_metrics(y_test, Ypred, groups,
+                                               n_boot=200, n_jobs=1)),
+        '5_prediction.group_threshold_curves': lambda: (
+            prediction.group_threshold_curves(y_test, Yproba, groups)),
+        '5_prediction.group_outcome_probas': lambda: (
+            prediction.group_outcome_probas(
+                prediction.predicted_proba_success(y_test, Yproba),
+                X_test['gender'], y_test)),
+    }
+
+
+def measure(function, repeat):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    # memory in a separate run (tracemalloc slows the allocations down)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'median_seconds': float(np.median(times)),
+            'repeat': repeat, 'peak_mb': peak / 2 ** 20}
+
+
+def run_benchmarks(data_dir, repeat=3, only=None, log=None):
+    """
+    Time every case of benchmark_cases().
+
+    Parameters
+    ----------
+    data_dir : str
+        The directory of the zipped csv files
+    repeat : int, default 3
+        The number of timed runs per case
+    only : str, optional
+        Run only the cases whose name contains this string
+    log : callable, optional
+        Called with each case name and its measures
+
+    Returns
+    ----------
+    dict
+        The 'meta' data of the run and the 'results' of each case
+    """
+    work_dir = tempfile.mkdtemp(prefix='oulad-benchmark-')
+    try:
+        cases = benchmark_cases(os.path.expanduser(data_dir), work_dir)
+        info = load_script('2_script.py').read_data('studentInfo.csv')
+        results = {}
+        for name, function in cases.items():
+            if only is not None and only not in name:
+                continue
+            results[name] = measure(function, repeat)
+            if log is not None:
+                log(name, results[name])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    import sklearn
+    meta = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'enrollments': len(info), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__,
+            'sklearn': sklearn.__version__, 'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+    return {'meta': meta, 'results': results}
+
+
+def compare(results, baseline, threshold=0.25, min_seconds=0.002,
+            min_mb=1.0):
+    """
+    Return the changes of every case between a baseline and results.
+
+    A case is a regression when its time (or peak memory) grew by more than
+    threshold and by more than min_seconds (or min_mb), under which the
+    differences are noise.
+
+    Parameters
+    ----------
+    results : dict
+        The results of run_benchmarks()
+    baseline : dict
+        The results of a previous run_benchmarks()
+    threshold : float, default 0.25
+        The relative growth flagged as regression
+    min_seconds : float, default 0.002
+        The smallest time difference flagged
+    min_mb : float, default 1.0
+        The smallest memory difference flagged
+
+    Returns
+    ----------
+    pd.DataFrame
+        One row per case and measure (seconds, peak_mb), with the baseline,
+        the current value, the relative change and whether it is a regression
+    """
+    rows = []
+    for name, current in results['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        for measure_name, floor in [('seconds', min_seconds),
+                                    ('peak_mb', min_mb)]:
+            old, new = before[measure_name], current[measure_name]
+            change = (new - old) / old if old else np.inf
+            rows.append((name, measure_name, old, new, change,
+                         change > threshold and new - old > floor))
+    return pd.DataFrame(rows, columns=['case', 'measure', 'baseline',
+                                       'current', 'change', 'regression'])
+
+
+###############################################################################
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--data-dir', required=True,
+                        help='directory of the zipped csv files (generated '
+                        'if missing)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='scale of the generated data (e.g. 1, 10, 100)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--filter', help='run only the cases whose name '
+                        'contains this string')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='JSON file of the results')
+    parser.add_argument('--baseline', help='JSON file of previous results')
+    parser.add_argument('--threshold', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(os.path.join(os.path.expanduser(args.data_dir),
+                                       'studentInfo.csv.zip')):
+        print('generating the data at scale {}'.format(args.scale))
+        load_script('8_synthetic.py').generate(args.data_dir, args.scale)
+
+    def log(name, result):
+        print('{:<48}{:>10.4f}s{:>10.1f}MB'.format(name, result['seconds'],
+                                                   result['peak_mb']))
+
+    results = run_benchmarks(args.data_dir, args.repeat, args.filter, log)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.baseline is None:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['meta'].get('enrollments') != results['meta']['enrollments']:
+        print('warning: the baseline was run on {} enrollments, these results'
+              ' on {}'.format(baseline['meta'].get('enrollments'),
+                              results['meta']['enrollments']))
+    changes = compare(results, baseline, args.threshold)
+    regressions = changes[changes['regression']]
+    from tabulate import tabulate
+    print(tabulate(changes.assign(change=changes['change'].map(
+        '{:+.1%}'.format)), headers='keys', showindex=False,
+        floatfmt='.4f'))
+    if len(regressions):
+        print('{} regression(s): {}'.format(
+            len(regressions), ', '.join(
+                regressions['case'] + ' (' + regressions['measure'] + ')')))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
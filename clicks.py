@@ -0,0 +1,411 @@
+"""
+Functions:
+    build_cube()
+    load_cube()
+    ClickCube
+
+Sparse cube of the clicks of the click log ('studentVle.csv') per
+enrollment x day x activity type, built once and stored on disk as a CSR
+matrix (one row per enrollment, one column per (day, activity type)) that
+is memory-mapped when loaded.
+
+The columns of a row are ordered by day, then by activity type, and the
+running sums of the clicks are stored along the matrix, so that the clicks
+of any range of days of many enrollments are found by binary search without
+reading their clicks (see ClickCube.range_sum()). Finer queries (per window
+of days, per activity type) only read the clicks of the asked days of the
+asked enrollments.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from enrollment import enrollment_key
+from instrument import instrumented
+
+cube_arrays = ['indptr', 'indices', 'data', 'cumsum', 'keys']
+
+
+###############################################################################
+def fold(cells, clicks):
+    # sum the clicks of the same cells
+    cells, inverse = np.unique(np.concatenate(cells), return_inverse=True)
+    clicks = np.bincount(inverse, weights=np.concatenate(clicks))
+    return cells, clicks
+
+
+@instrumented
+def build_cube(path, vle_chunks, vle, courses, first_day=-25, last_day=269):
+    """
+    Build the click cube of a click log and save it in a directory (.npy
+    arrays and a cube.json with its axes).
+
+    The click log is read chunk by chunk: memory holds one chunk and the
+    clicks per cell of the cube.
+
+    Parameters
+    ----------
+    path : str
+        The directory of the cube (created if needed)
+    vle_chunks : iterable
+        The chunks of 'studentVle.csv' (see stream_data() in 2_script.py)
+    vle : pd.DataFrame
+        The 'vle.csv' data table (activity type of each site)
+    courses : pd.DataFrame
+        The 'courses.csv' data table (one row per module presentation)
+    first_day : int, default -25
+        The first day of the cube
+    last_day : int, default 269
+        The last day of the cube
+
+    Returns
+    ----------
+    ClickCube
+        The saved cube (memory-mapped)
+
+    Raises
+    ------
+    ValueError
+        If a click is out of the days of the cube, on a site missing from vle
+        or in a module presentation missing from courses
+    """
+    activity = vle['activity_type'].astype('category')
+    activity_types = [str(value) for value in activity.cat.categories]
+    sites = pd.Index(vle['id_site'])
+    n_types = len(activity_types)
+    n_days = last_day - first_day + 1
+    n_columns = n_days * n_types
+
+    cells, clicks = [], []
+    size, limit = 0, 0
+    for chunk in vle_chunks:
+        site = sites.get_indexer(chunk['id_site'])
+        if (site == -1).any():
+            raise ValueError("sites missing from vle: {}".format(', '.join(
+                map(str, pd.unique(chunk['id_site'].to_numpy()[site == -1])))))
+        day = chunk['date'].to_numpy('int64')
+        if len(day) and (day.min() < first_day or day.max() > last_day):
+            raise ValueError("days must be included in [{}, {}]".format(
+                first_day, last_day))
+        column = (day - first_day) * n_types + activity.cat.codes.to_numpy()[
+            site]
+        cell, inverse = np.unique(
+            enrollment_key(chunk, courses) * n_columns + column,
+            return_inverse=True)
+        cells.append(cell)
+        clicks.append(np.bincount(inverse, weights=chunk['sum_click']
+                                  .to_numpy('float64')))
+        size += len(cell)
+        # compact the partial sums when they doubled since the last time
+        if size > limit:
+            cell, click = fold(cells, clicks)
+            cells, clicks = [cell], [click]
+            size = len(cell)
+            limit = max(limit, 2 * size)
+
+    if cells:
+        cell, click = fold(cells, clicks)
+    else:
+        cell, click = np.zeros(0, dtype='int64'), np.zeros(0)
+    keys, starts = np.unique(cell // n_columns, return_index=True)
+    data = click.astype('int32')
+    arrays = {'indptr': np.append(starts, len(cell)).astype('int64'),
+              'indices': (cell % n_columns).astype('int32'),
+              'data': data,
+              'cumsum': np.concatenate([[0], np.cumsum(data, dtype='int64')]),
+              'keys': keys.astype('int64')}
+
+    os.makedirs(path, exist_ok=True)
+    for name in cube_arrays:
+        np.save(os.path.join(path, name + '.npy'), arrays[name])
+    meta = {'first_day': first_day, 'last_day': last_day,
+            'activity_types': activity_types,
+            'courses': courses[['code_module', 'code_presentation']].astype(
+                str).to_numpy().tolist(),
+            'n_enrollments': len(keys), 'n_cells': len(cell)}
+    tmp = os.path.join(path, 'cube.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, os.path.join(path, 'cube.json'))
+    return load_cube(path)
+
+
+@instrumented
+def load_cube(path, mmap_mode='r'):
+    """
+    Load a cube saved by build_cube().
+
+    Parameters
+    ----------
+    path : str
+        The directory of the cube
+    mmap_mode : str or None, default 'r'
+        The mode of np.load() (None loads the arrays in memory)
+
+    Returns
+    ----------
+    ClickCube
+        The loaded cube
+    """
+    with open(os.path.join(path, 'cube.json')) as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(path, name + '.npy'),
+                            mmap_mode=mmap_mode)
+              for name in cube_arrays}
+    return ClickCube(arrays, meta['first_day'], meta['last_day'],
+                     meta['activity_types'], meta['courses'])
+
+
+###############################################################################
+class ClickCube:
+    """
+    Clicks per enrollment x day x activity type, as a CSR matrix.
+
+    The queries take the enrollments as row positions (see rows(), -1 for an
+    enrollment without clicks) or as a dataframe with 'id_student',
+    'code_module' and 'code_presentation' (a cohort), all the enrollments of
+    the cube by default. Days are ranges start <= date < stop, the whole cube
+    by default.
+
+    Parameters
+    ----------
+    arrays : dict
+        The arrays of cube_arrays: the CSR matrix (indptr, indices, data),
+        the running sums of data (cumsum, starting at 0) and the enrollment
+        key of each row (keys, sorted)
+    first_day : int
+        The first day of the cube
+    last_day : int
+        The last day of the cube
+    activity_types : list
+        The activity types, in the order of the columns
+    courses : list
+        The (code_module, code_presentation) of the enrollment keys
+    """
+
+    def __init__(self, arrays, first_day, last_day, activity_types, courses):
+        for name in cube_arrays:
+            setattr(self, name, arrays[name])
+        self.first_day = first_day
+        self.last_day = last_day
+        self.activity_types = list(activity_types)
+        self.courses = [tuple(pair) for pair in courses]
+        # the module presentations as a courses table, for enrollment_key()
+        self.course_table = pd.DataFrame(
+            self.courses, columns=['code_module', 'code_presentation'])
+
+    def __repr__(self):
+        return 'ClickCube(enrollments={}, days=[{}, {}], activity_types={})' \
+            .format(len(self.keys), self.first_day, self.last_day,
+                    len(self.activity_types))
+
+    @property
+    def shape(self):
+        return (len(self.keys), self.last_day - self.first_day + 1,
+                len(self.activity_types))
+
+    def rows(self, enrollments):
+        """
+        Return the row of each enrollment of a dataframe (-1 for the
+        enrollments without clicks).
+
+        Parameters
+        ----------
+        enrollments : pd.DataFrame
+            A dataframe with 'id_student', 'code_module' and
+            'code_presentation'
+
+        Returns
+        ----------
+        np.array
+            The rows
+
+        Raises
+        ------
+        ValueError
+            If a module presentation is not in the courses of the cube
+        """
+        key = enrollment_key(enrollments, self.course_table)
+        row = np.searchsorted(self.keys, key)
+        found = row < len(self.keys)
+        found[found] = self.keys[row[found]] == key[found]
+        return np.where(found, row, -1)
+
+    def select(self, rows):
+        if rows is None:
+            return np.arange(len(self.keys))
+        if isinstance(rows, pd.DataFrame):
+            return self.rows(rows)
+        return np.asarray(rows, dtype='int64')
+
+    def column(self, day):
+        # first column of a day (clipped to the days of the cube)
+        day = np.clip(day, self.first_day, self.last_day + 1)
+        return (day - self.first_day) * len(self.activity_types)
+
+    def search(self, rows, column):
+        """
+        Return the position in indices of the first cell of each row whose
+        column is >= column (binary search of all rows at once).
+        """
+        valid = rows >= 0
+        lo = np.where(valid, self.indptr[np.where(valid, rows, 0)], 0)
+        hi = np.where(valid, self.indptr[np.where(valid, rows + 1, 0)], 0)
+        active = np.flatnonzero(lo < hi)
+        while len(active):
+            mid = (lo[active] + hi[active]) // 2
+            before = self.indices[mid] < column
+            lo[active[before]] = mid[before] + 1
+            hi[active[~before]] = mid[~before]
+            active = active[lo[active] < hi[active]]
+        return lo
+
+    def cells(self, rows, start, stop):
+        # the (owner, column, clicks) of the cells of the rows in the days
+        lo = self.search(rows, self.column(start))
+        hi = self.search(rows, self.column(stop))
+        lengths = hi - lo
+        owner = np.repeat(np.arange(len(rows)), lengths)
+        position = (np.arange(lengths.sum()) +
+                    np.repeat(lo - np.cumsum(lengths) + lengths, lengths))
+        return owner, self.indices[position], self.data[position]
+
+    def type_codes(self, activity_types):
+        unknown = set(activity_types) - set(self.activity_types)
+        if unknown:
+            raise ValueError("activity_types must be included in:"
+                             " {}".format(', '.join(self.activity_types)))
+        return [self.activity_types.index(value) for value in activity_types]
+
+    @instrumented
+    def range_sum(self, start=None, stop=None, activity_types=None,
+                  rows=None):
+        """
+        Return the clicks of each enrollment in a range of days.
+
+        Parameters
+        ----------
+        start : int, optional
+            The first day of the range
+        stop : int, optional
+            The day after the range
+        activity_types : list, optional
+            The activity types to count (all by default)
+        rows : np.array or pd.DataFrame, optional
+            The enrollments (all by default)
+
+        Returns
+        ----------
+        np.array
+            The clicks (int64)
+
+        Raises
+        ------
+        ValueError
+            If an activity type is not in the cube
+        """
+        rows = self.select(rows)
+        start = self.first_day if start is None else start
+        stop = self.last_day + 1 if stop is None else stop
+        if activity_types is None:
+            # difference of the running sums, without reading the clicks
+            return (self.cumsum[self.search(rows, self.column(stop))] -
+                    self.cumsum[self.search(rows, self.column(start))])
+        codes = self.type_codes(activity_types)
+        owner, column, clicks = self.cells(rows, start, stop)
+        keep = np.isin(column % len(self.activity_types), codes)
+        return np.bincount(owner[keep], weights=clicks[keep],
+                           minlength=len(rows)).astype('int64')
+
+    @instrumented
+    def window_sums(self, start=None, stop=None, width=7,
+                    activity_types=None, rows=None):
+        """
+        Return the clicks of each enrollment per window of width days
+        (e.g. per week), from start.
+
+        Parameters
+        ----------
+        start : int, optional
+            The first day of the first window
+        stop : int, optional
+            The day after the last window (which can be shorter)
+        width : int, default 7
+            The number of days per window
+        activity_types : list, optional
+            The activity types to count (all by default)
+        rows : np.array or pd.DataFrame, optional
+            The enrollments (all by default)
+
+        Returns
+        ----------
+        np.array
+            The clicks, one row per enrollment and one column per window
+            (int64)
+
+        Raises
+        ------
+        ValueError
+            If width is not positive or an activity type is not in the cube
+        """
+        if width < 1:
+            raise ValueError("width must be positive")
+        rows = self.select(rows)
+        start = self.first_day if start is None else start
+        stop = self.last_day + 1 if stop is None else stop
+        n_windows = max(-(-(stop - start) // width), 0)
+        owner, column, clicks = self.cells(rows, start, stop)
+        if activity_types is not None:
+            keep = np.isin(column % len(self.activity_types),
+                           self.type_codes(activity_types))
+            owner, column, clicks = owner[keep], column[keep], clicks[keep]
+        day = column // len(self.activity_types) + self.first_day
+        cell = owner * n_windows + (day - start) // width
+        return np.bincount(cell, weights=clicks,
+                           minlength=len(rows) * n_windows).astype(
+            'int64').reshape(len(rows), n_windows)
+
+    @instrumented
+    def activity_mix(self, start=None, stop=None, rows=None):
+        """
+        Return the clicks of each enrollment per activity type in a range of
+        days.
+
+        Parameters
+        ----------
+        start : int, optional
+            The first day of the range
+        stop : int, optional
+            The day after the range
+        rows : np.array or pd.DataFrame, optional
+            The enrollments (all by default)
+
+        Returns
+        ----------
+        pd.DataFrame
+            The clicks, one row per enrollment and one column per activity
+            type
+        """
+        rows = self.select(rows)
+        start = self.first_day if start is None else start
+        stop = self.last_day + 1 if stop is None else stop
+        n_types = len(self.activity_types)
+        owner, column, clicks = self.cells(rows, start, stop)
+        counts = np.bincount(owner * n_types + column % n_types,
+                             weights=clicks, minlength=len(rows) * n_types)
+        return pd.DataFrame(counts.astype('int64').reshape(len(rows), n_types),
+                            columns=self.activity_types)
+
+    def to_csr(self):
+        """
+        Return the cube as a scipy.sparse CSR matrix of shape (enrollments,
+        days * activity types), sharing the arrays of the cube.
+        """
+        from scipy import sparse
+
+        n_enrollments, n_days, n_types = self.shape
+        return sparse.csr_matrix((self.data, self.indices, self.indptr),
+                                 shape=(n_enrollments, n_days * n_types))
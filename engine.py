@@ -0,0 +1,147 @@
+"""
+Functions:
+    set_engine()
+    get_engine()
+    use_engine()
+
+Execution engine of the statistics and preprocessing functions: 'pandas'
+(default) or 'polars' (multithreaded, on Arrow memory, with lazy query
+plans). The engine is chosen per call (engine argument), with
+set_engine()/use_engine(), or with the OULAD_ENGINE environment variable.
+
+With the polars engine, a pandas dataframe gives the same pandas result as
+the pandas engine (same index, columns and dtypes). A polars DataFrame or
+LazyFrame (e.g. from scan_data() in 2_script.py) always runs on polars and
+gives a polars result of the same kind, so that the functions can be chained
+in one lazy query plan (the values are only checked when it is collected).
+"""
+
+import contextlib
+import os
+
+import numpy as np
+
+engines = ['pandas', 'polars']
+settings = {'engine': os.environ.get('OULAD_ENGINE', 'pandas')}
+
+# column of the positions of the rows in the initial dataframe
+INDEX = '__index__'
+
+
+def get_engine(engine=None):
+    """
+    Return the engine to use (the current one if engine is None).
+
+    Raises
+    ------
+    ValueError
+        If engine is not in engines
+    ImportError
+        If the polars engine is asked for and polars is not installed
+    """
+    engine = settings['engine'] if engine is None else engine
+    if engine not in engines:
+        raise ValueError("engine must be included in:"
+                         " {}".format(', '.join(engines)))
+    if engine == 'polars':
+        try:
+            import polars  # noqa: F401
+        except ImportError:
+            raise ImportError("the polars engine requires polars "
+                              "(pip install polars)")
+    return engine
+
+
+def set_engine(engine):
+    """
+    Set the engine used when a function is called without engine.
+
+    Parameters
+    ----------
+    engine : str
+        'pandas' or 'polars'
+
+    Returns
+    ----------
+    None
+    """
+    settings['engine'] = get_engine(engine)
+
+
+@contextlib.contextmanager
+def use_engine(engine):
+    """
+    Use an engine in a with block.
+    """
+    previous = settings['engine']
+    set_engine(engine)
+    try:
+        yield
+    finally:
+        settings['engine'] = previous
+
+
+def is_polars(frame):
+    return type(frame).__module__.split('.')[0] == 'polars'
+
+
+def is_lazy(frame):
+    return is_polars(frame) and type(frame).__name__ == 'LazyFrame'
+
+
+def use_polars(frame, engine=None):
+    # polars frames can only run on polars
+    return is_polars(frame) or get_engine(engine) == 'polars'
+
+
+def column_names(frame):
+    if is_lazy(frame):
+        return frame.collect_schema().names()
+    return list(frame.columns)
+
+
+def lazy(frame):
+    """
+    Return a polars LazyFrame of a pandas or polars frame, with the positions
+    of its rows in the INDEX column.
+    """
+    import polars as pl
+
+    if not is_polars(frame):
+        frame = pl.from_pandas(frame, include_index=False)
+    return frame.lazy().with_row_index(INDEX)
+
+
+def finish(query, frame, changed=()):
+    """
+    Return the result of a query on lazy(frame), of the kind of frame: a
+    LazyFrame, a polars DataFrame or a pandas dataframe with the index and
+    dtypes of frame (except for the changed columns).
+    """
+    if is_lazy(frame):
+        return query.drop(INDEX)
+    result = query.collect()
+    if is_polars(frame):
+        return result.drop(INDEX)
+
+    import pandas as pd
+
+    # categorical columns are recoded into the categories of frame's dtypes
+    positions = result[INDEX].to_numpy()
+    result = result.drop(INDEX).to_pandas()
+    result.index = frame.index.take(positions)
+    for column in result.columns:
+        if column not in frame or column in changed:
+            continue
+        dtype = frame[column].dtype
+        values = result[column]
+        if isinstance(dtype, pd.CategoricalDtype) and isinstance(
+                values.dtype, pd.CategoricalDtype):
+            codes = values.cat.codes.to_numpy()
+            mapping = np.append(dtype.categories.get_indexer(
+                values.cat.categories), -1)  # code -1 (missing) kept
+            result[column] = pd.Categorical.from_codes(mapping[codes],
+                                                       dtype=dtype)
+        else:
+            result[column] = values.astype(dtype)
+    return result
@@ -0,0 +1,70 @@
+"""
+Functions:
+    enrollment_key()
+    course_index()
+
+Integer keys of the enrollments (a student in a module presentation), shared
+by the preprocessing (4_preprocessing.py) and the click cube (clicks.py) to
+join the tables instead of merging them on their 3 key columns.
+"""
+
+import pandas as pd
+
+
+###############################################################################
+def enrollment_key(dataframe, courses):
+    """
+    Return an integer key per row identifying the enrollment
+    (id_student, code_module, code_presentation).
+
+    Parameters
+    ----------
+    dataframe : pd.DataFrame
+        A dataframe with 'id_student', 'code_module' and 'code_presentation'
+    courses : pd.DataFrame
+        The 'courses.csv' data table (one row per module presentation)
+
+    Returns
+    ----------
+    np.array
+        The int64 keys
+
+    Raises
+    ------
+    ValueError
+        If a module presentation is not in courses
+    """
+    course = course_index(dataframe, courses)
+    return dataframe['id_student'].to_numpy('int64') * len(courses) + course
+
+
+def course_index(dataframe, courses):
+    """
+    Return the position in courses of the module presentation of each row.
+
+    Parameters
+    ----------
+    dataframe : pd.DataFrame
+        A dataframe with 'code_module' and 'code_presentation'
+    courses : pd.DataFrame
+        The 'courses.csv' data table (one row per module presentation)
+
+    Returns
+    ----------
+    np.array
+        The positions
+
+    Raises
+    ------
+    ValueError
+        If a module presentation is not in courses
+    """
+    index = pd.MultiIndex.from_arrays(
+        [courses['code_module'].astype(str),
+         courses['code_presentation'].astype(str)])
+    course = index.get_indexer(pd.MultiIndex.from_arrays(
+        [dataframe['code_module'].astype(str),
+         dataframe['code_presentation'].astype(str)]))
+    if (course == -1).any():
+        raise ValueError("module presentations missing from courses")
+    return course
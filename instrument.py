@@ -0,0 +1,228 @@
+"""
+Functions:
+    configure()
+    instrumented()
+    stage()
+
+Opt-in instrumentation of the functions of the scripts: when enabled, each
+call of an instrumented function (or each stage() block) is written as one
+JSON line with its wall time, CPU time, peak memory allocated (tracemalloc),
+maximum resident memory of the process and the rows of its input and output.
+One stage can also be profiled with cProfile.
+
+It is enabled by configure() or by environment variables read at import:
+
+    OULAD_TRACE=events.jsonl     (or '-' for stderr)
+    OULAD_PROFILE=4_preprocessing.encode_variables
+    OULAD_PROFILE_DIR=profiles
+    OULAD_TRACE_MEMORY=0         (no tracemalloc, which slows allocations)
+
+When disabled, an instrumented function only checks one flag before calling
+the function.
+
+tracemalloc traces the whole process: it is started by configure() and its
+peak is only reset by a stage when no stage of another thread is running.
+The peak memory of stages running at the same time in several threads thus
+includes the allocations of the other threads (an upper bound).
+"""
+
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+settings = {'enabled': False, 'stream': None, 'memory': True,
+            'profile': None, 'profile_dir': '.', 'tracing': False}
+lock = threading.Lock()
+local = threading.local()  # stack of the running stages of each thread
+running = {'stages': 0}  # running stages of all threads
+
+
+def configure(path=None, profile=None, profile_dir='.', memory=True):
+    """
+    Enable (or disable) the instrumentation.
+
+    Parameters
+    ----------
+    path : str, optional
+        The JSON lines file the events are appended to ('-' for stderr), the
+        instrumentation is disabled if None
+    profile : str, optional
+        The name of a stage to profile with cProfile (e.g.
+        '4_preprocessing.encode_variables')
+    profile_dir : str, default '.'
+        The directory of the '<stage>.prof' files
+    memory : bool, default True
+        Whether to trace the memory allocations (tracemalloc slows them down)
+
+    Returns
+    ----------
+    None
+    """
+    with lock:
+        stream = settings['stream']
+        if stream is not None and stream is not sys.stderr:
+            stream.close()
+        if path is None:
+            stream = None
+        elif path == '-':
+            stream = sys.stderr
+        else:
+            stream = open(path, 'a')
+        settings.update(enabled=path is not None, stream=stream,
+                        memory=memory, profile=profile,
+                        profile_dir=profile_dir)
+        # tracemalloc runs from here on, and is only stopped by configure()
+        # if it was started by configure()
+        if settings['enabled'] and memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                settings['tracing'] = True
+        elif settings['tracing']:
+            tracemalloc.stop()
+            settings['tracing'] = False
+
+
+def rows(value):
+    # number of rows of a dataframe, series or array (of each one in a tuple)
+    shape = getattr(value, 'shape', None)
+    if shape:
+        return int(shape[0])
+    if isinstance(value, (tuple, list)) and value and all(
+            getattr(item, 'shape', None) for item in value):
+        return [int(item.shape[0]) for item in value]
+    return None
+
+
+def emit(event):
+    line = json.dumps(event, default=str)
+    with lock:
+        stream = settings['stream']
+        if stream is not None:
+            stream.write(line + '\n')
+            stream.flush()
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None):
+    """
+    Record the block as a stage named name (when enabled).
+
+    The yielded dict can receive 'rows_out' (or other fields) to record.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage
+    rows_in : int, optional
+        The number of input rows
+
+    Yields
+    ----------
+    dict
+        The event of the stage
+    """
+    if not settings['enabled']:
+        yield {}
+        return
+
+    stack = getattr(local, 'stack', None)
+    if stack is None:
+        stack = local.stack = []
+    event = {'event': 'stage', 'name': name, 'depth': len(stack),
+             'parent': stack[-1]['name'] if stack else None,
+             'start': time.time(), 'rows_in': rows_in, 'rows_out': None,
+             'pid': os.getpid(), 'thread': threading.current_thread().name}
+    memory = settings['memory'] and tracemalloc.is_tracing()
+    with lock:
+        # the peak is only reset when the other running stages (if any) are
+        # the enclosing stages of this thread
+        alone = running['stages'] == len(stack)
+        running['stages'] += 1
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if alone:
+                if stack:
+                    # keep the peak of the enclosing stage before resetting
+                    stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+                tracemalloc.reset_peak()
+            event['peak'] = 0
+            event['memory_start'] = current
+    stack.append(event)
+
+    profiler = None
+    if name == settings['profile']:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    wall, cpu = time.perf_counter(), time.process_time()
+    error = None
+    try:
+        yield event
+    except BaseException as exception:
+        error = type(exception).__name__
+        raise
+    finally:
+        event['wall_s'] = time.perf_counter() - wall
+        event['cpu_s'] = time.process_time() - cpu
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(settings['profile_dir'], exist_ok=True)
+            event['profile'] = os.path.join(settings['profile_dir'],
+                                            name + '.prof')
+            profiler.dump_stats(event['profile'])
+        stack.pop()
+        with lock:
+            running['stages'] -= 1
+        if memory:
+            peak = max(tracemalloc.get_traced_memory()[1], event.pop('peak'))
+            event['peak_mb'] = (peak - event.pop('memory_start')) / 2 ** 20
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        if resource is not None:
+            # kilobytes on Linux, bytes on macOS
+            scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+            event['max_rss_mb'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / scale
+        event['error'] = error
+        emit(event)
+
+
+def instrumented(function):
+    """
+    Decorate a function so that its calls are recorded as stages named
+    '<script>.<function>' (when enabled), with the rows of its first
+    dataframe or array argument and of its result.
+    """
+    script = os.path.splitext(os.path.basename(
+        function.__code__.co_filename))[0]
+    name = script + '.' + function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not settings['enabled']:
+            return function(*args, **kwargs)
+        rows_in = next((rows(value) for value in
+                        list(args) + list(kwargs.values())
+                        if getattr(value, 'shape', None)), None)
+        with stage(name, rows_in) as event:
+            result = function(*args, **kwargs)
+            event['rows_out'] = rows(result)
+        return result
+
+    return wrapper
+
+
+if os.environ.get('OULAD_TRACE'):
+    configure(os.environ['OULAD_TRACE'], os.environ.get('OULAD_PROFILE'),
+              os.environ.get('OULAD_PROFILE_DIR', '.'),
+              os.environ.get('OULAD_TRACE_MEMORY', '1') != '0')
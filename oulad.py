@@ -0,0 +1,79 @@
+"""
+Functions:
+    load_script()
+
+Importable entry point of the project: the numbered scripts are loaded as
+attributes of this module on first access, e.g.
+
+    import oulad
+    oulad.data.read_data('studentInfo.csv')     # 2_script.py
+    oulad.statistics.ratio('gender', df)         # 3_basic_statistics.py
+    oulad.preprocessing.prepare_dataset(df)      # 4_preprocessing.py
+    oulad.prediction.rf_model()                  # 5_prediction.py
+    oulad.pipeline.run_pipeline()                # 6_pipeline.py
+    oulad.synthetic.generate('/tmp/oulad', 10)   # 8_synthetic.py
+
+Importing oulad (or a script) does not import matplotlib, tabulate nor
+scikit-learn: they are imported by the functions using them, on their first
+call.
+"""
+
+import importlib.util
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+scripts = {'data': '2_script.py',
+           'statistics': '3_basic_statistics.py',
+           'preprocessing': '4_preprocessing.py',
+           'prediction': '5_prediction.py',
+           'pipeline': '6_pipeline.py',
+           'serving': '7_serving.py',
+           'synthetic': '8_synthetic.py',
+           'benchmark': '9_benchmark.py'}
+
+
+def load_script(file_name):
+    """
+    Return a numbered script of the project (e.g. '2_script.py') as a module,
+    registered in sys.modules so that its objects can be pickled.
+
+    Parameters
+    ----------
+    file_name : str
+        The file name of the script
+
+    Returns
+    ----------
+    module
+        The module of the script (loaded once)
+    """
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)  # for the modules imported by the scripts
+    name = os.path.splitext(file_name)[0]
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            name, os.path.join(HERE, file_name))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[name]
+            raise
+    return sys.modules[name]
+
+
+def __getattr__(name):
+    if name not in scripts:
+        raise AttributeError("module 'oulad' has no attribute '{}' (scripts "
+                             "must be included in: {})".format(
+                                 name, ', '.join(scripts)))
+    module = load_script(scripts[name])
+    globals()[name] = module
+    return module
+
+
+def __dir__():
+    return sorted(list(globals()) + list(scripts))
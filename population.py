@@ -0,0 +1,133 @@
+"""
+Functions:
+    distinct_students()
+    invalidate_population()
+    population_cache_info()
+
+Memoization of the population of distinct students, shared by the
+statistics (3_basic_statistics.py) and preprocessing (4_preprocessing.py)
+functions.
+"""
+
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize',
+                                     'currsize'])
+
+MAXSIZE = 8
+
+cache = OrderedDict()  # key -> (weak reference to the frame, population)
+counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+# reentrant: the garbage collector can run the callback of forget() in a
+# thread holding the lock
+lock = threading.RLock()
+
+
+def frame_key(dataframe0):
+    # identity of the frame, its shape and columns, and an optional version
+    # to bump after modifying values in place (dataframe0.attrs['version'])
+    return (id(dataframe0), dataframe0.shape, tuple(dataframe0.columns),
+            dataframe0.attrs.get('version'))
+
+
+def forget(key):
+    # callback removing the entry of a frame once it is garbage collected
+    def callback(ref):
+        with lock:
+            entry = cache.get(key)
+            if entry is not None and entry[0] is ref:
+                cache.pop(key, None)
+    return callback
+
+
+def distinct_students(dataframe0):
+    """
+    Return the first row of each student of a dataframe (all columns),
+    computed once per dataframe.
+
+    The result is kept in a LRU cache of MAXSIZE dataframes, keyed on the
+    identity, shape, columns and attrs['version'] of dataframe0. A frame
+    modified in place without changing its shape must be invalidated (see
+    invalidate_population()) or have its attrs['version'] changed.
+
+    Parameters
+    ----------
+    dataframe0 : pd.DataFrame
+        The initial dataframe
+
+    Returns
+    ----------
+    pd.DataFrame
+        The distinct students (shared between calls: not to be modified in
+        place)
+    """
+    key = frame_key(dataframe0)
+    with lock:
+        if key in cache:
+            ref, population = cache[key]
+            # the id of a deleted frame can be reused by a new one
+            if ref() is dataframe0:
+                cache.move_to_end(key)
+                counters['hits'] += 1
+                return population
+            del cache[key]
+        counters['misses'] += 1
+
+    # drop rows when same students' id (redundant students' info)
+    population = dataframe0.drop_duplicates(subset=['id_student'],
+                                            keep='first')
+    with lock:
+        cache[key] = (weakref.ref(dataframe0, forget(key)), population)
+        while len(cache) > MAXSIZE:
+            cache.popitem(last=False)
+            counters['evictions'] += 1
+    return population
+
+
+def invalidate_population(dataframe0=None):
+    """
+    Remove the population of a dataframe (of all dataframes by default) from
+    the cache.
+
+    Parameters
+    ----------
+    dataframe0 : pd.DataFrame, optional
+        The initial dataframe
+
+    Returns
+    ----------
+    None
+    """
+    with lock:
+        if dataframe0 is None:
+            cache.clear()
+        else:
+            for key in [key for key, (ref, _) in cache.items()
+                        if ref() is dataframe0]:
+                del cache[key]
+
+
+def population_cache_info(reset=False):
+    """
+    Return the hits, misses and evictions of the cache since the start (or the
+    last reset), its maximum size and its current size.
+
+    Parameters
+    ----------
+    reset : bool, default False
+        Whether to set the counters back to 0 after reading them
+
+    Returns
+    ----------
+    CacheInfo
+        The counters of the cache
+    """
+    with lock:
+        info = CacheInfo(counters['hits'], counters['misses'],
+                         counters['evictions'], MAXSIZE, len(cache))
+        if reset:
+            for name in counters:
+                counters[name] = 0
+    return info
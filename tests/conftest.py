@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the scripts import the modules of the project (instrument.py, engine.py...)
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
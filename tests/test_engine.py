@@ -0,0 +1,177 @@
+"""
+Parity of the pandas and polars engines (engine.py) on a small synthetic
+studentInfo table.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import engine
+from oulad import load_script
+
+pl = pytest.importorskip('polars')
+
+data = load_script('2_script.py')
+statistics = load_script('3_basic_statistics.py')
+preprocessing = load_script('4_preprocessing.py')
+
+
+@pytest.fixture
+def student_info():
+    # 300 enrollments of 200 students, with missing IMD bands, in a shuffled
+    # order with a non-default index
+    rng = np.random.default_rng(0)
+    n_rows = 300
+    columns = {'id_student': rng.integers(0, 200, n_rows),
+               'num_of_prev_attempts': rng.integers(0, 4, n_rows),
+               'studied_credits': rng.integers(30, 240, n_rows)}
+    for column, dtype in data.schemas['studentInfo.csv'].items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            columns[column] = rng.choice(list(dtype.categories), n_rows)
+    dataframe = pd.DataFrame(columns)
+    dataframe.loc[rng.random(n_rows) < 0.1, 'imd_band'] = None
+    dataframe.index = rng.permutation(n_rows) * 10
+    return dataframe[list(data.schemas['studentInfo.csv'])].astype(
+        data.schemas['studentInfo.csv'])
+
+
+@pytest.fixture
+def prepared(student_info):
+    return preprocessing.filter_final_result(
+        preprocessing.prepare_dataset(student_info))
+
+
+def both(function, *args, **kwargs):
+    return (function(*args, engine='pandas', **kwargs),
+            function(*args, engine='polars', **kwargs))
+
+
+def test_dataset_population(student_info):
+    pd.testing.assert_frame_equal(
+        *both(statistics.dataset_population, student_info))
+
+
+@pytest.mark.parametrize('column', ['id_student', 'code_module',
+                                    'code_presentation', 'gender'])
+def test_how_many(student_info, column):
+    expected, result = both(statistics.how_many, column, student_info)
+    assert result == expected
+    assert statistics.how_many(column, pl.from_pandas(student_info)) == \
+        expected
+
+
+def test_count_cube(student_info):
+    expected, result = both(statistics.count_cube, student_info)
+    np.testing.assert_array_equal(result.counts, expected.counts)
+    assert list(result.axes) == list(expected.axes)
+    for column in expected.axes:
+        pd.testing.assert_index_equal(result.axes[column],
+                                      expected.axes[column])
+
+
+@pytest.mark.parametrize('name', ['pandas', 'polars'])
+def test_count_cube_order(student_info, name):
+    # counts and order of the former value_counts() and unique() loops on
+    # the population (ties in order of first appearance)
+    population = statistics.dataset_population(student_info).astype(object)
+    cube = statistics.count_cube(student_info, engine=name)
+    for column in ['region', 'imd_band', 'age_band']:
+        pd.testing.assert_series_equal(
+            cube.value_counts(column), population[column].value_counts(),
+            check_names=False, check_index_type=False)
+    lines = cube.lines('region', 'imd_band')
+    assert list(lines.index) == list(population['region'].unique())
+    for region in lines.index:
+        counts = population.loc[population['region'] == region,
+                                'imd_band'].value_counts().sort_index()
+        row = lines.loc[region]
+        assert row[row > 0].sort_index().to_dict() == counts.to_dict()
+
+
+def test_prepare_dataset(student_info):
+    pd.testing.assert_frame_equal(
+        *both(preprocessing.prepare_dataset, student_info))
+
+
+def test_filter_final_result(student_info):
+    prepared = preprocessing.prepare_dataset(student_info)
+    pd.testing.assert_frame_equal(
+        *both(preprocessing.filter_final_result, prepared))
+
+
+def test_encode_variables(prepared):
+    pd.testing.assert_frame_equal(
+        *both(preprocessing.encode_variables, prepared))
+
+
+def test_lazy_chain(student_info, prepared):
+    # a LazyFrame runs on polars and stays lazy until collected
+    query = preprocessing.encode_variables(preprocessing.filter_final_result(
+        preprocessing.prepare_dataset(pl.from_pandas(student_info).lazy())))
+    assert engine.is_lazy(query)
+    expected = preprocessing.encode_variables(prepared)
+    result = query.collect().to_pandas().set_axis(expected.index)
+    for column in expected.columns:
+        np.testing.assert_array_equal(
+            result[column].astype(object).fillna('nan').astype(str),
+            expected[column].astype(object).fillna('nan').astype(str))
+
+
+def test_use_engine(student_info):
+    expected = statistics.dataset_population(student_info)
+    with engine.use_engine('polars'):
+        assert engine.get_engine() == 'polars'
+        result = statistics.dataset_population(student_info)
+    assert engine.get_engine() == 'pandas'
+    pd.testing.assert_frame_equal(result, expected)
+
+
+###############################################################################
+def test_unknown_engine(student_info):
+    with pytest.raises(ValueError, match='engine must be included in'):
+        statistics.dataset_population(student_info, engine='spark')
+    with pytest.raises(ValueError, match='engine must be included in'):
+        engine.set_engine('spark')
+
+
+def encode_error(dataframe, name):
+    with pytest.raises(ValueError) as error:
+        preprocessing.encode_variables(dataframe, engine=name)
+    return str(error.value)
+
+
+def test_encode_unseen_values(student_info, prepared):
+    # same errors on both engines
+    unfiltered = preprocessing.prepare_dataset(student_info)
+    message = encode_error(unfiltered, 'pandas')
+    assert message.startswith('missing or unseen values in column '
+                              'final_result: ')
+    assert encode_error(unfiltered, 'polars') == message
+    unknown = prepared.assign(region='x')
+    message = encode_error(unknown, 'pandas')
+    assert message == 'missing or unseen values in column region: x'
+    assert encode_error(unknown, 'polars') == message
+
+
+@pytest.mark.parametrize('name', ['pandas', 'polars'])
+def test_encode_missing_column(prepared, name):
+    with pytest.raises(ValueError,
+                       match='column region is not in the dataframe'):
+        preprocessing.encode_variables(prepared.drop(columns=['region']),
+                                       engine=name)
+
+
+@pytest.mark.parametrize('name', ['pandas', 'polars'])
+def test_how_many_errors(student_info, name):
+    with pytest.raises(NameError, match='col_name argument must be included'):
+        statistics.how_many('region', student_info, engine=name)
+    with pytest.raises(TypeError, match='dataframe type must be'):
+        statistics.how_many('id_student', student_info.to_dict(),
+                            engine=name)
+
+
+@pytest.mark.parametrize('name', ['pandas', 'polars'])
+def test_count_cube_type_error(name):
+    with pytest.raises(TypeError, match='dataframe type must be'):
+        statistics.count_cube([1, 2], engine=name)
@@ -0,0 +1,45 @@
+"""
+Cold start of the analysis scripts: importing them must not import the heavy
+dependencies, and must stay within a time budget.
+"""
+
+import json
+import subprocess
+import sys
+
+from conftest import ROOT
+
+# seconds spent importing the project on top of numpy and pandas
+IMPORT_BUDGET = 0.5
+
+HEAVY = ['sklearn', 'matplotlib', 'tabulate', 'joblib', 'scipy', 'polars']
+
+CHECK = """
+import json, sys, time
+import numpy, pandas
+start = time.perf_counter()
+import oulad
+for name in ['data', 'statistics', 'preprocessing', 'prediction']:
+    getattr(oulad, name)
+import clicks, engine, population
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed,
+                  'modules': [name for name in %r if name in sys.modules]}))
+"""
+
+
+def cold_import():
+    output = subprocess.run([sys.executable, '-c', CHECK % HEAVY], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.splitlines()[-1])
+
+
+def test_no_heavy_dependency_imported():
+    assert cold_import()['modules'] == []
+
+
+def test_import_time_budget():
+    # best of 3 cold processes, to be robust to a busy machine
+    elapsed = min(cold_import()['elapsed'] for _ in range(3))
+    assert elapsed < IMPORT_BUDGET, \
+        'importing the scripts took {:.3f}s'.format(elapsed)
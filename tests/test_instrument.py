@@ -0,0 +1,60 @@
+"""
+Stages recorded by instrument.py from several threads.
+"""
+
+import json
+import threading
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import instrument
+
+
+@pytest.fixture
+def events(tmp_path):
+    path = tmp_path / 'events.jsonl'
+    instrument.configure(str(path))
+    yield lambda: [json.loads(line) for line in path.read_text().split('\n')
+                   if line]
+    instrument.configure(None)
+
+
+def work(name, started, release, size):
+    with instrument.stage(name):
+        values = np.ones(size)
+        started.wait()
+        release.wait()
+        with instrument.stage(name + '.inner'):
+            values = values + 1
+    return values
+
+
+def test_stages_of_threads(events):
+    # the stages of 4 threads overlap and end in any order
+    started = threading.Barrier(4)
+    releases = [threading.Event() for _ in range(4)]
+    threads = [threading.Thread(target=work, args=(
+        'stage{}'.format(i), started, release, 2 ** 20))
+        for i, release in enumerate(releases)]
+    for thread in threads:
+        thread.start()
+    for release, thread in zip(releases, threads):
+        release.set()
+        thread.join()
+    assert tracemalloc.is_tracing()
+
+    recorded = events()
+    assert len(recorded) == 8
+    for event in recorded:
+        # at least the array of the stage (8 MB), the others may be counted
+        assert event['peak_mb'] >= 7.9
+        assert event['error'] is None
+    assert instrument.running['stages'] == 0
+
+
+def test_configure_stops_tracing(events):
+    assert tracemalloc.is_tracing()
+    instrument.configure(None)
+    assert not tracemalloc.is_tracing()
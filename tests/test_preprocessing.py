@@ -0,0 +1,73 @@
+"""
+Features of enrollments without submission or click (4_preprocessing.py).
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from oulad import load_script
+
+preprocessing = load_script('4_preprocessing.py')
+
+keys = ['id_student', 'code_module', 'code_presentation']
+
+
+@pytest.fixture
+def tables():
+    # student 1 submitted an assessment and clicked, student 2 did neither
+    courses = pd.DataFrame({'code_module': ['AAA'],
+                            'code_presentation': ['2013J'],
+                            'module_presentation_length': [268]})
+    student_info = pd.DataFrame({
+        'code_module': 'AAA', 'code_presentation': '2013J',
+        'id_student': [1, 2], 'gender': ['M', 'F'],
+        'region': 'Wales', 'highest_education': 'HE Qualification',
+        'imd_band': '10-20%', 'age_band': '0-35',
+        'num_of_prev_attempts': 0, 'studied_credits': 60,
+        'disability': 'N', 'final_result': ['Pass', 'Fail']})
+    student_registration = pd.DataFrame({
+        'code_module': 'AAA', 'code_presentation': '2013J',
+        'id_student': [1, 2], 'date_registration': [-10, np.nan]})
+    assessments = pd.DataFrame({
+        'code_module': 'AAA', 'code_presentation': '2013J',
+        'id_assessment': [10], 'assessment_type': ['TMA'], 'date': [20],
+        'weight': [10.0]})
+    student_assessment = pd.DataFrame({
+        'id_assessment': [10], 'id_student': [1], 'date_submitted': [18],
+        'is_banked': [0], 'score': [0.0]})
+    vle_activity = pd.DataFrame({
+        'code_module': ['AAA'], 'code_presentation': ['2013J'],
+        'id_student': [1], 'total_clicks': [5], 'active_days': [1],
+        'first_date': [0], 'last_date': [0], 'clicks_quiz': [5]})
+    return (student_info, student_registration, student_assessment,
+            assessments, courses, vle_activity)
+
+
+def test_prepare_enrollment_dataset_missing(tables):
+    dataframe = preprocessing.prepare_enrollment_dataset(*tables)
+    active, inactive = dataframe.iloc[0], dataframe.iloc[1]
+    # a score of 0 and a click on day 0 are not missing values
+    assert active['mean_score'] == 0 and active['first_date'] == 0
+    for column in ['n_assessments', 'n_late', 'n_banked', 'total_clicks',
+                   'active_days', 'clicks_quiz']:
+        assert inactive[column] == 0
+    for column in ['date_registration', 'mean_score', 'weighted_score',
+                   'mean_delay', 'first_date', 'last_date']:
+        assert np.isnan(inactive[column])
+
+
+def test_early_features_missing(tables):
+    student_info, _, student_assessment, assessments, courses, _ = tables
+    timeline = preprocessing.AssessmentTimeline(student_assessment,
+                                                assessments, courses)
+    static = student_info[['studied_credits']]
+    before, after = (
+        preprocessing.early_features(static, student_info[keys], courses,
+                                     cutoff, timeline)
+        for cutoff in [14, 30])
+    assert (before['n_assessments'] == 0).all()
+    assert before[['mean_score', 'weighted_score', 'mean_delay']] \
+        .isna().all().all()
+    assert after['mean_score'].tolist()[0] == 0
+    assert np.isnan(after['mean_score'].tolist()[1])
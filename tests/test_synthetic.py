@@ -0,0 +1,36 @@
+"""
+Smoke check of the synthetic generator (8_synthetic.py) at the largest scale
+of the benchmarks.
+"""
+
+import tracemalloc
+
+import numpy as np
+
+from oulad import load_script
+
+synthetic = load_script('8_synthetic.py')
+
+SCALE = 100
+
+# bytes allocated at once by student_tables() at SCALE (the range of the
+# candidate ids alone took ~2.6 GB)
+MEMORY_BUDGET = 1.5 * 2 ** 30
+
+
+def test_student_tables_scale():
+    n = int(round(synthetic.base_enrollments * SCALE))
+    tracemalloc.start()
+    try:
+        info, registration, course = synthetic.student_tables(
+            np.random.default_rng(0), n)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < MEMORY_BUDGET
+    assert len(info) == len(registration) == len(course) == n
+    ids = info['id_student'].to_numpy()
+    assert ids.min() >= 6516 and ids.max() < 6516 + 100 * n
+    # one enrollment per student and module presentation
+    assert not info.duplicated(
+        ['id_student', 'code_module', 'code_presentation']).any()